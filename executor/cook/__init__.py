@@ -10,6 +10,9 @@ section at http://mesos.apache.org/documentation/latest/app-framework-developmen
 DAEMON_GRACE_SECS = 1
 TERMINATE_GRACE_SECS = 0.1
 
+RUNTIME_ASYNCIO = 'asyncio'
+RUNTIME_THREADS = 'threads'
+
 REASON_CONTAINER_LIMITATION_MEMORY = 'REASON_CONTAINER_LIMITATION_MEMORY'
 REASON_EXECUTOR_TERMINATED = 'REASON_EXECUTOR_TERMINATED'
 REASON_TASK_INVALID = 'REASON_TASK_INVALID'
@@ -7,18 +7,28 @@ This module configures logging and starts the executor's driver thread.
 import logging
 import signal
 import sys
-from threading import Event, Timer
+from threading import Event
 
 import os
 
+import cook.startup as cst
+
+# the imports below are timed when the startup is profiled
+if cst.is_profiling_requested(sys.argv):
+    cst.enable_profiling()
+
 # CPython bug: including the idna encoding registers it,
 # the encoding is loaded with the built-in frozen importer
 # https://github.com/pyinstaller/pyinstaller/issues/1113
 import encodings.idna
 
+import cook
 import cook.config as cc
 import cook.executor as ce
 import cook.io_helper as cio
+import cook.metrics as cmet
+import cook.timers as ct
+import cook.tracing as ctr
 import cook.util as cu
 import pymesos as pm
 
@@ -30,6 +40,8 @@ def main(args=None):
         print(__version__)
         sys.exit(0)
 
+    cst.mark('main')
+
     cio.print_out('Cook Executor version {}'.format(__version__), flush=True)
 
     environment = os.environ
@@ -43,21 +55,42 @@ def main(args=None):
     logging.info('Log level is {}'.format(log_level))
 
     config = cc.initialize_config(environment)
-
-    def print_memory_usage_task():
-        cu.print_memory_usage()
-        timer = Timer(config.memory_usage_interval_secs, print_memory_usage_task)
-        timer.daemon = True
-        timer.start()
-    print_memory_usage_task()
-
-    stop_signal = Event()
+    cst.mark('config')
+    if config.trace_file_path:
+        ctr.enable(config.trace_file_path)
+
+    runtime = None
+    if config.runtime == cook.RUNTIME_ASYNCIO:
+        # imported lazily as importing asyncio adds to the startup time of the threads runtime
+        import cook.aio as ca
+        # the task is managed by coroutines, and deadline and periodic work runs, on a single event loop thread
+        runtime = ca.AsyncRuntime()
+        runtime.start()
+        timer_service = runtime.timer_service
+    else:
+        # all deadline and periodic work in the executor runs on a single timer thread
+        timer_service = ct.TimerService()
+        timer_service.start()
+    timer_service.schedule_periodic(config.memory_usage_interval_secs, cu.print_memory_usage, 'memory-usage',
+                                    initial_delay_secs=0)
+    # output is buffered between explicit flush points, e.g. task start and exit, for at most the flush interval
+    cio.set_flush_interval(config.output_flush_interval_ms)
+    if config.output_flush_interval_ms > 0:
+        timer_service.schedule_periodic(config.output_flush_interval_ms / 1000.0, cio.flush_outputs_if_due,
+                                        'output-flush')
+
+    metrics_server = None
+    if config.metrics_socket_path:
+        metrics_server = cmet.MetricsServer(config.metrics_socket_path, cmet.enable())
+        metrics_server.start()
+
+    stop_signal = cu.NotifyingEvent()
     non_zero_exit_signal = Event()
 
     def handle_interrupt(interrupt_code, _):
         logging.info('Executor interrupted with code {}'.format(interrupt_code))
         cio.print_and_log('Received kill for task {} with grace period of {}'.format(
-            executor_id, config.shutdown_grace_period))
+            executor_id, config.shutdown_grace_period), flush=True)
         stop_signal.set()
         non_zero_exit_signal.set()
         cu.print_memory_usage()
@@ -66,11 +99,18 @@ def main(args=None):
     signal.signal(signal.SIGTERM, handle_interrupt)
 
     try:
-        executor = ce.CookExecutor(stop_signal, config)
+        if runtime:
+            executor = ca.AsyncCookExecutor(stop_signal, config, runtime)
+        elif config.multi_task:
+            # a long-lived executor that runs the tasks it receives concurrently until it is shut down or idle
+            executor = ce.MultiTaskCookExecutor(stop_signal, config, timer_service=timer_service)
+        else:
+            executor = ce.CookExecutor(stop_signal, config, timer_service=timer_service)
         driver = pm.MesosExecutorDriver(executor)
 
         logging.info('MesosExecutorDriver is starting...')
         driver.start()
+        cst.mark('driver-started')
 
         executor.await_completion()
 
@@ -84,7 +124,15 @@ def main(args=None):
         stop_signal.set()
         non_zero_exit_signal.set()
 
+    timer_service.stop()
+    if metrics_server:
+        metrics_server.stop()
+    ctr.close()
+    if runtime:
+        runtime.stop(cook.TERMINATE_GRACE_SECS)
     cu.print_memory_usage()
+    cst.report(cio.print_err)
+    cio.flush_outputs()
     exit_code = 1 if non_zero_exit_signal.isSet() else 0
     logging.info('Executor exiting with code {}'.format(exit_code))
     sys.exit(exit_code)
@@ -0,0 +1,536 @@
+"""This module provides an opt-in asyncio runtime for the executor.
+Instead of a thread per concern (task management, progress tracking, message sending and timers), the task is
+managed by coroutines and callbacks running on a single event loop thread.
+The process exit is detected using a pidfd (falling back to polling), progress locations are tailed by waiting
+for the inotify file descriptor to become readable and framework messages are sent between other work on the loop.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import signal
+import time
+from threading import Event, Thread
+
+import cook
+import cook.executor as ce
+import cook.inotify as ci
+import cook.io_helper as cio
+import cook.messaging as cm
+import cook.metrics as cmet
+import cook.progress as cp
+import cook.sampler as csa
+import cook.subprocess as cs
+import cook.timers as ct
+import cook.tracing as ctr
+import cook.util as cu
+
+
+class LoopTimerService(ct.TimerService):
+    """TimerService which runs the scheduled and periodic callbacks on an asyncio event loop instead of a thread.
+    Callbacks can be scheduled from any thread.
+    """
+
+    def __init__(self, loop, name='loop-timer-service'):
+        """
+        Parameters
+        ----------
+        loop: asyncio.AbstractEventLoop
+            The event loop running the callbacks.
+        name: string
+            The name used when logging the timing statistics.
+        """
+        super().__init__(name=name)
+        self.loop = loop
+
+    def start(self):
+        """The callbacks run on the event loop, there is no thread to start."""
+        pass
+
+    def enqueue(self, task):
+        """Schedules the task to run on the event loop once its deadline expires."""
+        self.loop.call_soon_threadsafe(self.__call_at_deadline, task)
+        return task
+
+    def __call_at_deadline(self, task):
+        self.loop.call_later(max(task.deadline - time.monotonic(), 0), self.__run_task_unless_cancelled, task)
+
+    def __run_task_unless_cancelled(self, task):
+        if not self.stopped and not task.cancelled:
+            self.run_task(task)
+
+    def stop(self):
+        """Stops the service, callbacks that have not run yet are dropped."""
+        with self.condition:
+            if self.stopped:
+                return
+            self.stopped = True
+        self.log_statistics()
+
+
+class AsyncRuntime(object):
+    """Runs an asyncio event loop on a single thread, the coroutines managing tasks and the timer callbacks run on it."""
+
+    def __init__(self, name='executor-runtime'):
+        """
+        Parameters
+        ----------
+        name: string
+            The name of the thread running the event loop.
+        """
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.timer_service = LoopTimerService(self.loop)
+        self.thread = None
+
+    def start(self):
+        """Starts the thread running the event loop."""
+        self.thread = Thread(target=self.__run, args=(), name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Schedules the coroutine to run on the event loop.
+        Using this method is thread-safe.
+
+        Returns
+        -------
+        The concurrent.futures.Future of the coroutine's result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self, timeout_secs=None):
+        """Stops the timer service and the event loop, coroutines that have not completed are abandoned."""
+        self.timer_service.stop()
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread is not None:
+            self.thread.join(timeout_secs)
+        if not self.loop.is_running():
+            self.loop.close()
+
+
+def watch_stop_signal(process, stop_signal, shutdown_grace_period_ms, timer_service):
+    """Watches the stop_signal, on timer_service, to kill the process if stop_signal is set.
+
+    Parameters
+    ----------
+    process: subprocess.Popen
+        The process to kill.
+    stop_signal: cook.util.NotifyingEvent
+        Event that determines if the process was requested to terminate
+    shutdown_grace_period_ms: int
+        Grace period before forceful kill
+    timer_service: cook.timers.TimerService
+        The service used to watch the stop_signal and to escalate the kill after the grace period.
+        The stop_signal, a cook.util.NotifyingEvent, wakes up the service once it is set.
+
+    Returns
+    -------
+    A tuple of the ScheduledTask watching the stop_signal and the list of the scheduled kill escalations,
+    both are passed to complete_stop_signal_watch once the process has terminated.
+    """
+    kill_escalations = []
+
+    def process_stop_signal():
+        if cs.is_process_running(process):
+            logging.info('Executor has been instructed to terminate running task')
+            kill_escalations.append(cs.terminate_process(process, shutdown_grace_period_ms, timer_service))
+
+    stop_signal_watch = timer_service.watch_event(stop_signal, process_stop_signal, 'stop-signal-watch')
+    return stop_signal_watch, kill_escalations
+
+
+def complete_stop_signal_watch(process, stop_signal_watch, kill_escalations):
+    """Stops watching the stop_signal and cancels the pending kill escalations of the terminated process.
+
+    Returns
+    -------
+    Nothing.
+    """
+    stop_signal_watch.cancel()
+    if kill_escalations:
+        for kill_escalation in kill_escalations:
+            if kill_escalation:
+                kill_escalation.cancel()
+        ce.output_termination_signal(process)
+
+
+async def await_process_exit(process):
+    """Waits, without blocking the event loop, for the process to exit and reaps it.
+    The exit is detected when the pidfd of the process becomes readable; when a pidfd cannot be opened,
+    waitid blocks in the default executor of the loop instead.
+
+    Returns
+    -------
+    The return code of the process.
+    """
+    pidfd = cs.open_pidfd(process.pid) if process.returncode is None else None
+    loop = asyncio.get_running_loop()
+    if pidfd is None:
+        await loop.run_in_executor(None, cs.await_process_exit, process)
+        return process.wait()
+    exited = loop.create_future()
+
+    def on_exit():
+        if not exited.done():
+            exited.set_result(None)
+
+    try:
+        loop.add_reader(pidfd, on_exit)
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+    finally:
+        os.close(pidfd)
+    # the process has exited, wait only reaps it
+    return process.wait()
+
+
+async def await_process_completion(process, stop_signal, shutdown_grace_period_ms, timer_service):
+    """Asynchronous equivalent of cook.executor.await_process_completion.
+
+    Returns
+    -------
+    Nothing.
+    """
+    stop_signal_watch, kill_escalations = watch_stop_signal(process, stop_signal, shutdown_grace_period_ms,
+                                                            timer_service)
+    try:
+        await await_process_exit(process)
+    finally:
+        complete_stop_signal_watch(process, stop_signal_watch, kill_escalations)
+
+
+async def await_notifier_change(notifier, timeout_ms=None):
+    """Asynchronous equivalent of notifier.await_change.
+    It waits for the file descriptors of the notifier to become readable, or sleeps for the poll interval
+    when the notifier has none, and then consumes the changes without blocking.
+    """
+    loop = asyncio.get_running_loop()
+    wait_fds = notifier.wait_fds()
+    timeout_secs = notifier.wait_timeout_ms(timeout_ms) / 1000.0
+    if wait_fds:
+        changed = loop.create_future()
+
+        def on_change():
+            if not changed.done():
+                changed.set_result(None)
+
+        for fd in wait_fds:
+            loop.add_reader(fd, on_change)
+        try:
+            await asyncio.wait_for(changed, timeout_secs)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for fd in wait_fds:
+                loop.remove_reader(fd)
+    else:
+        await asyncio.sleep(timeout_secs)
+    notifier.await_change(timeout_ms=0)
+
+
+class AsyncProgressTracker(cp.MultiplexedProgressTracker):
+    """MultiplexedProgressTracker which tracks the progress locations in a coroutine on the event loop."""
+
+    def __init__(self, loop, config, stop_signal, task_completed_signal, counter, progress_updater,
+                 progress_termination_signal, locations, os_error_handler):
+        """Creates the watchers for all locations, the tracking coroutine is launched by start().
+        The remaining parameters are the same as those of MultiplexedProgressTracker.
+
+        Parameters
+        ----------
+        loop: asyncio.AbstractEventLoop
+            The event loop running the tracking coroutine.
+        """
+        super().__init__(config, stop_signal, task_completed_signal, counter, progress_updater,
+                         progress_termination_signal, locations, os_error_handler)
+        self.loop = loop
+        self.tracker_task = None
+
+    def start(self):
+        """Launches a coroutine that starts monitoring all the progress locations for progress messages."""
+        logging.info('Starting progress monitoring from %s', self.location_tags())
+        self.tracker_task = self.loop.create_task(self.track_progress_async())
+
+    async def wait_async(self, timeout=None):
+        """Waits for the tracking coroutine to run to completion."""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.tracker_task), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self.progress_complete_event.is_set():
+            logging.info('Progress monitoring complete %s', self.location_tags())
+        else:
+            logging.info('Progress monitoring did not complete %s', self.location_tags())
+
+    async def track_progress_async(self):
+        """Asynchronous equivalent of track_progress, other coroutines run while waiting for new content.
+        It sets the progress_complete_event before returning."""
+        notifier = None
+        try:
+            notifier = ci.create_notifier(self.tail_mode, cp.TAIL_SLEEP_TIME_MS)
+            self.notifier = notifier
+            active_watchers = self.create_progress_states(notifier)
+            while active_watchers:
+                active_watchers, should_wait = self.track_available_progress(active_watchers)
+                if should_wait:
+                    await await_notifier_change(notifier, timeout_ms=self.change_timeout_ms(active_watchers))
+                    for watcher, _ in active_watchers:
+                        watcher.wakeup_count = notifier.wakeup_count
+                else:
+                    # allow other coroutines to run between passes over locations with new content
+                    await asyncio.sleep(0)
+        except Exception as exception:
+            if cu.is_out_of_memory_error(exception):
+                self.os_error_handler(exception)
+            else:
+                logging.exception('Exception while tracking progress %s', self.location_tags())
+        finally:
+            self.notifier = None
+            if notifier is not None:
+                notifier.close()
+            self.progress_complete_event.set()
+
+
+class AsyncMessageSender(cm.MessageSender):
+    """MessageSender which sends the queued messages from a coroutine on the event loop instead of a thread.
+    The queueing, coalescing and dropping of messages is unchanged, messages can be queued from any thread.
+    """
+
+    def __init__(self, send_message_fn, max_queue_size, loop):
+        """
+        Parameters
+        ----------
+        send_message_fn: function(message)
+            The helper function used to send a message, it returns whether the message was successfully sent.
+        max_queue_size: int
+            The number of queued messages after which new progress messages are dropped.
+        loop: asyncio.AbstractEventLoop
+            The event loop running the sending coroutine.
+        """
+        super().__init__(send_message_fn, max_queue_size)
+        self.loop = loop
+        self.sender_task = None
+
+    def start(self):
+        """Messages are sent by a coroutine started on demand, there is no thread to start."""
+        pass
+
+    def send(self, message, on_failure=None):
+        """Queues the message and ensures the sending coroutine is running.
+        Using this method is thread-safe.
+
+        Returns
+        -------
+        True if the message was queued, else False.
+        """
+        queued = super().send(message, on_failure=on_failure)
+        if queued:
+            self.loop.call_soon_threadsafe(self.__ensure_sending)
+        return queued
+
+    def __ensure_sending(self):
+        if self.sender_task is None or self.sender_task.done():
+            self.sender_task = self.loop.create_task(self.__send_queued_messages())
+
+    async def __send_queued_messages(self):
+        """Sends the queued messages, yielding to other coroutines between messages, until the queue is empty."""
+        while True:
+            with self.condition:
+                if not self.queue:
+                    return
+                batch = self.take_batch()
+            try:
+                for entry in batch:
+                    self.send_batch([entry])
+                    await asyncio.sleep(0)
+            except Exception:
+                logging.exception('Error in sending queued messages')
+                with self.condition:
+                    self.in_flight_count = 0
+                    self.condition.notify_all()
+
+    async def flush_async(self, timeout_secs=None):
+        """Waits until all queued messages have been sent or the timeout expires.
+
+        Returns
+        -------
+        True if all queued messages have been sent, else False.
+        """
+        self.__ensure_sending()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.sender_task), timeout_secs)
+        except asyncio.TimeoutError:
+            pass
+        with self.condition:
+            return not self.queue and self.in_flight_count == 0
+
+    async def stop_async(self, timeout_secs=None):
+        """Stops accepting new messages and waits for the queued messages to be sent.
+
+        Returns
+        -------
+        True if all queued messages have been sent, else False.
+        """
+        with self.condition:
+            already_stopped = self.stopped
+            self.stopped = True
+        flushed = await self.flush_async(timeout_secs)
+        if not already_stopped:
+            self.log_statistics()
+        return flushed
+
+
+async def manage_task(driver, task, stop_signal, completed_signal, config, timer_service):
+    """Asynchronous equivalent of cook.executor.manage_task.
+       The task, its progress locations and the framework messages are all managed on the running event loop.
+       Deadline and periodic work (e.g. killing the task, sampling) runs on timer_service, which is expected to
+       run its callbacks on the same event loop.
+
+    Returns
+    -------
+    Nothing
+    """
+    loop = asyncio.get_running_loop()
+    launched_process = None
+    resource_sampler = None
+    task_id = ce.get_task_id(task)
+    cio.print_and_log('Starting task {}'.format(task_id), flush=True)
+    task_span = ctr.start_span('manage-task', task_id=task_id)
+    status_updater = ce.StatusUpdater(driver, task_id)
+
+    inner_os_error_handler = functools.partial(ce.os_error_handler, stop_signal, status_updater)
+    message_sender = AsyncMessageSender(functools.partial(ce.send_message, driver, inner_os_error_handler),
+                                        config.message_queue_size, loop)
+    message_sender.start()
+    message_timeout_secs = config.shutdown_grace_period_ms / 1000.0
+    try:
+        # not yet started to run the task
+        status_updater.update_status(cook.TASK_STARTING)
+
+        sandbox_message = {'sandbox-directory': config.sandbox_directory, 'task-id': task_id, 'type': 'directory'}
+        message_sender.send(sandbox_message)
+
+        environment = ce.retrieve_process_environment(config, os.environ)
+        launched_process = ce.launch_task(task, environment)
+        if launched_process:
+            # task has begun running successfully
+            status_updater.update_status(cook.TASK_RUNNING)
+            cio.print_and_log('Forked command at {}'.format(launched_process.pid), flush=True)
+        else:
+            # task launch failed, report an error
+            logging.error('Error in launching task')
+            status_updater.update_status(cook.TASK_ERROR, reason=cook.REASON_TASK_INVALID)
+            return
+
+        if config.resource_sample_interval_secs > 0:
+            resource_sampler = csa.ResourceSampler(task_id, launched_process.pid, config, message_sender.send)
+            resource_sampler.start(timer_service)
+
+        task_completed_signal = Event() # event to track task execution completion
+        sequence_counter = cp.ProgressSequenceCounter()
+
+        def send_progress_message(message):
+            return message_sender.send(message, on_failure=progress_updater.handle_send_failure)
+
+        progress_updater = ce.create_progress_updater(task_id, config, send_progress_message)
+        progress_termination_signal = Event()
+
+        progress_locations = {config.progress_output_name: 'progress',
+                              config.stderr_file(): 'stderr',
+                              config.stdout_file(): 'stdout'}
+        logging.info('Progress will be tracked from {} locations'.format(len(progress_locations)))
+        progress_tracker = AsyncProgressTracker(loop, config, stop_signal, task_completed_signal, sequence_counter,
+                                                progress_updater, progress_termination_signal,
+                                                list(progress_locations.items()), inner_os_error_handler)
+        progress_tracker.start()
+        cmet.register_collector(task_id, functools.partial(ce.collect_task_metrics, task_id,
+                                                           progress_tracker.watchers, progress_updater,
+                                                           message_sender))
+
+        def terminate_progress_tracker():
+            progress_termination_signal.set()
+            progress_tracker.wake_up()
+
+        with ctr.start_span('await-process', task_id=task_id):
+            await await_process_completion(launched_process, stop_signal, config.shutdown_grace_period_ms,
+                                           timer_service)
+        task_completed_signal.set()
+        progress_tracker.wake_up()
+
+        progress_termination_task = timer_service.schedule(config.shutdown_grace_period_ms / 1000.0,
+                                                           terminate_progress_tracker, 'progress-termination')
+
+        # propagate the exit code
+        exit_code = launched_process.returncode
+        cio.print_and_log('Command exited with status {} (pid: {})'.format(exit_code, launched_process.pid), flush=True)
+
+        exit_message = {'exit-code': exit_code, 'task-id': task_id}
+        message_sender.send(exit_message)
+
+        if resource_sampler:
+            resource_sampler.stop()
+
+        # await progress updater termination if executor is terminating normally
+        if not stop_signal.is_set():
+            logging.info('Awaiting completion of progress updaters')
+            await progress_tracker.wait_async()
+            logging.info('Progress updaters completed')
+        progress_termination_task.cancel()
+
+        # force send the latest progress state if available, progress that failed to be delivered is sent again
+        await message_sender.flush_async(message_timeout_secs)
+        progress_tracker.force_send_progress_update()
+        progress_updater.log_statistics()
+
+        # deliver the exit code and progress messages before the terminal task state
+        await message_sender.stop_async(message_timeout_secs)
+
+        # task either completed successfully or aborted with an error
+        task_state = ce.get_task_state(exit_code)
+        ce.output_task_completion(task_id, task_state)
+        status_updater.update_status(task_state)
+
+    except Exception as exception:
+        if cu.is_out_of_memory_error(exception):
+            inner_os_error_handler(exception)
+        else:
+            # task aborted with an error
+            logging.exception('Error in executing task')
+            ce.output_task_completion(task_id, cook.TASK_FAILED)
+            status_updater.update_status(cook.TASK_FAILED, reason=cook.REASON_EXECUTOR_TERMINATED)
+
+    finally:
+        if resource_sampler:
+            resource_sampler.stop()
+        await message_sender.stop_async(message_timeout_secs)
+        cmet.unregister_collector(task_id)
+        task_span.finish()
+        ctr.flush()
+        # ensure completed_signal is set so driver can stop
+        completed_signal.set()
+        if launched_process and cs.is_process_running(launched_process):
+            cs.send_signal(launched_process.pid, signal.SIGKILL)
+        cio.flush_outputs()
+
+
+class AsyncCookExecutor(ce.CookExecutor):
+    """CookExecutor which manages the task as a coroutine on the event loop of an AsyncRuntime.
+    The driver callbacks are unchanged, only launchTask differs by not creating a thread for the task."""
+
+    def __init__(self, stop_signal, config, runtime):
+        super().__init__(stop_signal, config, timer_service=runtime.timer_service)
+        self.runtime = runtime
+
+    def launchTask(self, driver, task):
+        logging.info('Driver {} launching task {}'.format(driver, task))
+        self.runtime.submit(manage_task(driver, task, self.stop_signal, self.completed_signal, self.config,
+                                        self.timer_service))
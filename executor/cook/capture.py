@@ -0,0 +1,279 @@
+"""This module captures the stdout and stderr of the task through pipes owned by the executor.
+The captured output is copied to the executor's stdout and stderr (i.e. the sandbox files) and is scanned for
+progress messages while it is in flight, instead of being written to disk and re-read by tailing the files.
+"""
+
+import collections
+import logging
+import os
+import select
+import sys
+from threading import Event, Lock, Thread
+
+import cook.io_helper as cio
+import cook.progress as cp
+import cook.tracing as ctr
+import cook.util as cu
+
+OUTPUT_CAPTURE_MODE_INHERIT = 'inherit'
+OUTPUT_CAPTURE_MODE_PIPE = 'pipe'
+
+
+def write_stdout(data):
+    """Buffers the captured data for stdout atomically with respect to the executor's own messages."""
+    cio.print_out(data, newline=False)
+
+
+def write_stderr(data):
+    """Buffers the captured data for stderr."""
+    cio.print_err(data, newline=False)
+
+
+def is_captured_location(location, config):
+    """Returns true if location refers to the sandbox stdout or stderr files, i.e. the destinations of captured output.
+
+    Parameters
+    ----------
+    location: string
+        The progress location.
+    config: cook.config.ExecutorConfig
+        The current executor config.
+    """
+    if location in [config.stdout_file(), config.stderr_file()]:
+        return True
+    try:
+        location_stat = os.stat(location)
+        return any(os.path.samestat(location_stat, os.fstat(stream.fileno())) for stream in [sys.stdout, sys.stderr])
+    except (OSError, ValueError):
+        return False
+
+
+class CapturedStream(object):
+    """An output pipe of the task whose data is copied to a destination and split into fragments in memory.
+    The fragments are scanned for progress messages by the stream's ProgressWatcher.
+    """
+
+    def __init__(self, pipe, write_fn, watcher, max_bytes_per_fragment, chunk_size=cp.TAIL_CHUNK_SIZE_BYTES):
+        """
+        Parameters
+        ----------
+        pipe: file object
+            The pipe to read the task's output from.
+        write_fn: function(bytes)
+            The function used to copy the output to its destination.
+        watcher: cook.progress.ProgressWatcher
+            The watcher used to match progress messages in the output.
+        max_bytes_per_fragment: int
+            The max length of any fragment scanned for progress messages.
+        chunk_size: int
+            The number of bytes requested from the pipe in each read.
+        """
+        self.pipe = pipe
+        self.fd = pipe.fileno()
+        self.write = write_fn
+        self.watcher = watcher
+        self.max_bytes_per_fragment = max_bytes_per_fragment
+        self.chunk_size = max(chunk_size, max_bytes_per_fragment)
+        self.pending_fragments = collections.deque()
+        self.remainder = b''
+        self.closed = False
+        self.byte_count = 0
+        self.progress_states = watcher.retrieve_progress_states(fragments=self.__fragments())
+
+    def __fragments(self):
+        """Generates the fragments read so far, None is generated whenever all of them have been consumed."""
+        linesep_bytes = os.linesep.encode()
+        while True:
+            while self.pending_fragments:
+                fragment = self.pending_fragments.popleft()
+                self.watcher.fragment_count += 1
+                if fragment.endswith(linesep_bytes):
+                    self.watcher.line_count += 1
+                yield fragment
+            if self.closed:
+                return
+            yield None
+
+    def read(self):
+        """Reads the data available in the pipe, copies it to the destination and splits it into fragments.
+
+        Returns
+        -------
+        False if the pipe has been closed by the task, else True.
+        """
+        chunk = os.read(self.fd, self.chunk_size)
+        if chunk:
+            self.write(chunk)
+            self.byte_count += len(chunk)
+        else:
+            self.closed = True
+        # a partial line is only deferred when the read filled the chunk, similar to FragmentReader
+        fragments, self.remainder = cp.split_fragments(self.remainder + chunk, self.max_bytes_per_fragment,
+                                                       len(chunk) == self.chunk_size)
+        self.pending_fragments.extend(fragments)
+        return not self.closed
+
+    def close(self):
+        """Closes the pipe, subsequent writes by the task's processes fail."""
+        self.closed = True
+        self.pipe.close()
+
+
+class OutputCapture(object):
+    """Copies the stdout and stderr pipes of the task to the executor's stdout and stderr using a single thread.
+    Progress messages are matched while the output is in flight and sent using the progress updater.
+    The thread sleeps until output arrives, coalesced progress is due or wake_up() is invoked.
+    """
+
+    def __init__(self, process, config, stop_signal, task_completed_signal, counter, progress_updater,
+                 progress_termination_signal, os_error_handler):
+        """Creates the captured streams, the capturing thread is launched by start().
+
+        Parameters
+        ----------
+        process: subprocess.Popen
+            The process launched with its stdout and stderr captured.
+        config: cook.config.ExecutorConfig
+            The current executor config.
+        stop_signal: cook.util.NotifyingEvent
+            Event that determines if an interrupt was sent
+        task_completed_signal: threading.Event
+            Event that tracks task execution completion
+        counter: ProgressSequenceCounter
+            The sequence counter
+        progress_updater: ProgressUpdater
+            The progress updater used to send the progress messages
+        progress_termination_signal: threading.Event
+            Event that determines if capturing should be terminated
+        os_error_handler: fn(os_error)
+            OSError exception handler for out of memory situations."""
+        self.os_error_handler = os_error_handler
+        self.progress_complete_event = Event()
+        self.progress_termination_signal = progress_termination_signal
+        self.updater = progress_updater
+        is_progress_update_due = progress_updater.is_progress_update_due \
+            if config.progress_coalesce else None
+
+        def create_stream(pipe, location_tag, write_fn):
+            watcher = cp.ProgressWatcher('<{} pipe>'.format(location_tag), location_tag, counter,
+                                         config.max_bytes_read_per_line, config.progress_regex_string, stop_signal,
+                                         task_completed_signal, progress_termination_signal,
+                                         is_progress_update_due=is_progress_update_due,
+                                         progress_format=config.progress_format)
+            return CapturedStream(pipe, write_fn, watcher, config.max_bytes_read_per_line)
+
+        self.streams = [create_stream(process.stdout, 'stdout', write_stdout),
+                        create_stream(process.stderr, 'stderr', write_stderr)]
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
+        os.set_blocking(self.wake_read_fd, False)
+        os.set_blocking(self.wake_write_fd, False)
+        self.closed = False
+        self.lock = Lock()
+
+    def location_tags(self):
+        """Returns the tags of all captured streams."""
+        return [stream.watcher.location_tag for stream in self.streams]
+
+    def start(self):
+        """Launches a thread that copies the captured streams and monitors them for progress messages."""
+        logging.info('Starting output capture from %s', self.location_tags())
+        capture_thread = Thread(target=self.capture_output, args=(), name='output-capture')
+        capture_thread.daemon = True
+        capture_thread.start()
+
+    def wake_up(self):
+        """Wakes up the capturing thread so that it can observe changes to the termination signal."""
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.wake_write_fd, b'\0')
+            except BlockingIOError:
+                # the pipe is full, i.e. a wake up is already pending
+                pass
+
+    def __close_wakeup_pipe(self):
+        """Releases the pipe used to wake up the capturing thread."""
+        with self.lock:
+            self.closed = True
+            os.close(self.wake_read_fd)
+            os.close(self.wake_write_fd)
+
+    def wait(self, timeout=None):
+        """Waits for the capturing thread to run to completion."""
+        with ctr.start_span('output-capture-wait', locations=self.location_tags()):
+            self.progress_complete_event.wait(timeout=timeout)
+        if self.progress_complete_event.is_set():
+            logging.info('Output capture complete %s', self.location_tags())
+        else:
+            logging.info('Output capture did not complete %s', self.location_tags())
+
+    def __track_stream_progress(self, stream):
+        """Sends the progress updates available from the fragments read so far.
+
+        Returns
+        -------
+        False when the stream's progress has been completely processed, else True.
+        """
+        try:
+            for current_progress in stream.progress_states:
+                if current_progress is None:
+                    return True
+                self.updater.send_progress_update(current_progress)
+        except Exception as exception:
+            if cu.is_out_of_memory_error(exception):
+                self.os_error_handler(exception)
+            else:
+                logging.exception('Exception while tracking progress [tag=%s]', stream.watcher.location_tag)
+        return False
+
+    def capture_output(self):
+        """Copies the output from the pipes until the task closes them or capturing is terminated.
+        It sets the progress_complete_event before returning."""
+        try:
+            poller = select.poll()
+            poller.register(self.wake_read_fd, select.POLLIN)
+            open_streams = {}
+            for stream in self.streams:
+                poller.register(stream.fd, select.POLLIN)
+                open_streams[stream.fd] = stream
+            tracked_streams = list(self.streams)
+            while (open_streams or tracked_streams) and not self.progress_termination_signal.is_set():
+                timeout_ms = None
+                pending_percents = [stream.watcher.pending_percent() for stream in tracked_streams
+                                    if stream.watcher.pending_progress is not None]
+                if pending_percents:
+                    # wake up in time to send the coalesced progress, including any backoff or wait for a token
+                    timeout_ms = min(self.updater.time_until_next_update_ms(percent) for percent in pending_percents)
+                for fd, _ in poller.poll(timeout_ms) if open_streams else []:
+                    if fd == self.wake_read_fd:
+                        try:
+                            os.read(fd, 4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    stream = open_streams[fd]
+                    if not stream.read():
+                        poller.unregister(fd)
+                        del open_streams[fd]
+                tracked_streams = [stream for stream in tracked_streams if self.__track_stream_progress(stream)]
+            if self.progress_termination_signal.is_set():
+                logging.info('Output capture short-circuiting due to progress termination')
+        except Exception as exception:
+            if cu.is_out_of_memory_error(exception):
+                self.os_error_handler(exception)
+            else:
+                logging.exception('Exception while capturing output %s', self.location_tags())
+        finally:
+            cio.flush_outputs()
+            self.__close_wakeup_pipe()
+            for stream in self.streams:
+                stream.close()
+                logging.info('%s bytes, %s fragments and %s lines captured [tag=%s]', stream.byte_count,
+                             stream.watcher.fragment_count, stream.watcher.line_count, stream.watcher.location_tag)
+            self.progress_complete_event.set()
+
+    def force_send_progress_update(self):
+        """Retrieves the latest progress message from each stream and attempts to force send it to the scheduler."""
+        for stream in self.streams:
+            self.updater.send_progress_update(stream.watcher.current_progress(), force_send=True)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
+import copy
 import logging
 import os
 
 from pymesos.utils import parse_duration
 
+import cook
+import cook.capture as ccap
+import cook.inotify as ci
+import cook.io_helper as cio
+import cook.messaging as cm
+import cook.progress as cp
+
 DEFAULT_PROGRESS_FILE_ENV_VARIABLE = 'EXECUTOR_PROGRESS_OUTPUT_FILE'
 
 
@@ -35,21 +43,57 @@ class ExecutorConfig(object):
                  max_bytes_read_per_line=1024,
                  max_message_length=512,
                  memory_usage_interval_secs=15,
+                 message_queue_size=cm.DEFAULT_MAX_QUEUE_SIZE,
+                 metrics_socket_path='',
+                 multi_task=False,
+                 multi_task_idle_timeout_secs=60,
+                 output_capture_mode=ccap.OUTPUT_CAPTURE_MODE_INHERIT,
+                 output_flush_interval_ms=cio.DEFAULT_EXECUTOR_FLUSH_INTERVAL_MS,
                  progress_output_env_variable=DEFAULT_PROGRESS_FILE_ENV_VARIABLE,
                  progress_output_name='stdout',
                  progress_regex_string='',
+                 progress_coalesce=True,
+                 progress_format=cp.PROGRESS_FORMAT_REGEX,
+                 progress_max_sample_interval_ms=30000,
+                 progress_max_updates_per_sec=0,
+                 progress_min_percent_delta=0,
                  progress_sample_interval_ms=100,
+                 progress_tail_mode=ci.TAIL_MODE_INOTIFY,
+                 resource_report_interval_secs=300,
+                 resource_sample_buffer_size=360,
+                 resource_sample_interval_secs=0,
+                 resource_sample_source='process-tree',
+                 runtime=cook.RUNTIME_THREADS,
                  sandbox_directory='',
-                 shutdown_grace_period='1secs'):
+                 shutdown_grace_period='1secs',
+                 trace_file_path=''):
         self.max_bytes_read_per_line = max_bytes_read_per_line
         self.max_message_length = max_message_length
         self.memory_usage_interval_secs = memory_usage_interval_secs
+        self.message_queue_size = message_queue_size
+        self.metrics_socket_path = metrics_socket_path
+        self.multi_task = multi_task
+        self.multi_task_idle_timeout_secs = multi_task_idle_timeout_secs
+        self.output_capture_mode = output_capture_mode
+        self.output_flush_interval_ms = output_flush_interval_ms
         self.progress_output_env_variable = progress_output_env_variable
         self.progress_output_name = progress_output_name
         self.progress_regex_string = progress_regex_string
+        self.progress_coalesce = progress_coalesce
+        self.progress_format = progress_format
+        self.progress_max_sample_interval_ms = progress_max_sample_interval_ms
+        self.progress_max_updates_per_sec = progress_max_updates_per_sec
+        self.progress_min_percent_delta = progress_min_percent_delta
         self.progress_sample_interval_ms = progress_sample_interval_ms
+        self.progress_tail_mode = progress_tail_mode
+        self.resource_report_interval_secs = resource_report_interval_secs
+        self.resource_sample_buffer_size = resource_sample_buffer_size
+        self.resource_sample_interval_secs = resource_sample_interval_secs
+        self.resource_sample_source = resource_sample_source
+        self.runtime = runtime
         self.sandbox_directory = sandbox_directory
         self.shutdown_grace_period_ms = ExecutorConfig.parse_time_ms(shutdown_grace_period)
+        self.trace_file_path = trace_file_path
 
     def sandbox_file(self, file):
         return os.path.join(self.sandbox_directory, file)
@@ -60,6 +104,13 @@ class ExecutorConfig(object):
     def stdout_file(self):
         return self.sandbox_file('stdout')
 
+    def task_config(self, task_id):
+        """Returns a copy of the config for a task run by a multi-task executor.
+        Tasks share the sandbox, hence each task is given its own progress output file."""
+        config = copy.copy(self)
+        config.progress_output_name = self.sandbox_file('{}.progress'.format(task_id))
+        return config
+
 
 def initialize_config(environment):
     """Initializes the config using the environment.
@@ -83,27 +134,121 @@ def initialize_config(environment):
     max_bytes_read_per_line = max(int(environment.get('EXECUTOR_MAX_BYTES_READ_PER_LINE', 4 * 1024)), 128)
     max_message_length = max(int(environment.get('EXECUTOR_MAX_MESSAGE_LENGTH', 512)), 64)
     memory_usage_interval_secs = max(int(environment.get('EXECUTOR_MEMORY_USAGE_INTERVAL_SECS', 3600)), 30)
+    message_queue_size = max(int(environment.get('EXECUTOR_MESSAGE_QUEUE_SIZE', cm.DEFAULT_MAX_QUEUE_SIZE)), 1)
+    metrics_socket_path = environment.get('EXECUTOR_METRICS_SOCKET', '')
+    if metrics_socket_path and sandbox_directory:
+        metrics_socket_path = os.path.join(sandbox_directory, metrics_socket_path)
+    multi_task = environment.get('EXECUTOR_MULTI_TASK', 'false').lower() == 'true'
+    multi_task_idle_timeout_secs = max(int(environment.get('EXECUTOR_MULTI_TASK_IDLE_TIMEOUT_SECS', 60)), 0)
+    output_capture_mode = environment.get('EXECUTOR_OUTPUT_CAPTURE_MODE', ccap.OUTPUT_CAPTURE_MODE_INHERIT)
+    if output_capture_mode not in [ccap.OUTPUT_CAPTURE_MODE_INHERIT, ccap.OUTPUT_CAPTURE_MODE_PIPE]:
+        logging.info('Unknown output capture mode {}, defaulting to {}'.format(
+            output_capture_mode, ccap.OUTPUT_CAPTURE_MODE_INHERIT))
+        output_capture_mode = ccap.OUTPUT_CAPTURE_MODE_INHERIT
+    if multi_task and output_capture_mode != ccap.OUTPUT_CAPTURE_MODE_PIPE:
+        # tasks share the sandbox stdout and stderr files, their progress can only be told apart in flight
+        logging.info('Multi-task mode requires the {} output capture mode'.format(ccap.OUTPUT_CAPTURE_MODE_PIPE))
+        output_capture_mode = ccap.OUTPUT_CAPTURE_MODE_PIPE
+    output_flush_interval_ms = max(int(environment.get('EXECUTOR_OUTPUT_FLUSH_INTERVAL_MS',
+                                                   cio.DEFAULT_EXECUTOR_FLUSH_INTERVAL_MS)), 0)
+    progress_coalesce = environment.get('EXECUTOR_PROGRESS_COALESCE', 'true').lower() == 'true'
+    progress_format = environment.get('EXECUTOR_PROGRESS_FORMAT', cp.PROGRESS_FORMAT_REGEX)
+    if progress_format not in [cp.PROGRESS_FORMAT_JSON, cp.PROGRESS_FORMAT_REGEX]:
+        logging.info('Unknown progress format {}, defaulting to {}'.format(progress_format, cp.PROGRESS_FORMAT_REGEX))
+        progress_format = cp.PROGRESS_FORMAT_REGEX
+    progress_max_updates_per_sec = max(float(environment.get('EXECUTOR_PROGRESS_MAX_UPDATES_PER_SEC', 0)), 0)
+    progress_min_percent_delta = max(int(environment.get('EXECUTOR_PROGRESS_MIN_PERCENT_DELTA', 0)), 0)
     progress_output_name = environment.get(progress_output_env_variable, default_progress_output_file)
     progress_regex_string = environment.get('PROGRESS_REGEX_STRING', 'progress: ([0-9]*\.?[0-9]+), (.*)')
     progress_sample_interval_ms = max(int(environment.get('PROGRESS_SAMPLE_INTERVAL_MS', 1000)), 100)
+    progress_max_sample_interval_ms = max(int(environment.get('EXECUTOR_PROGRESS_MAX_SAMPLE_INTERVAL_MS', 30000)),
+                                          progress_sample_interval_ms)
+    progress_tail_mode = environment.get('EXECUTOR_PROGRESS_TAIL_MODE', ci.TAIL_MODE_INOTIFY)
+    if progress_tail_mode not in [ci.TAIL_MODE_INOTIFY, ci.TAIL_MODE_POLL]:
+        logging.info('Unknown progress tail mode {}, defaulting to {}'.format(progress_tail_mode,
+                                                                           ci.TAIL_MODE_INOTIFY))
+        progress_tail_mode = ci.TAIL_MODE_INOTIFY
+    resource_report_interval_secs = max(int(environment.get('EXECUTOR_RESOURCE_REPORT_INTERVAL_SECS', 300)), 0)
+    resource_sample_buffer_size = max(int(environment.get('EXECUTOR_RESOURCE_SAMPLE_BUFFER_SIZE', 360)), 2)
+    resource_sample_interval_secs = max(int(environment.get('EXECUTOR_RESOURCE_SAMPLE_INTERVAL_SECS', 10)), 0)
+    resource_sample_source = environment.get('EXECUTOR_RESOURCE_SAMPLE_SOURCE', 'process-tree')
+    if resource_sample_source not in ['cgroup', 'process-tree']:
+        logging.info('Unknown resource sample source {}, defaulting to process-tree'.format(resource_sample_source))
+        resource_sample_source = 'process-tree'
+    runtime = environment.get('EXECUTOR_RUNTIME', cook.RUNTIME_THREADS)
+    if runtime not in [cook.RUNTIME_ASYNCIO, cook.RUNTIME_THREADS]:
+        logging.info('Unknown runtime {}, defaulting to {}'.format(runtime, cook.RUNTIME_THREADS))
+        runtime = cook.RUNTIME_THREADS
+    if multi_task and runtime != cook.RUNTIME_THREADS:
+        logging.info('Multi-task mode requires the {} runtime'.format(cook.RUNTIME_THREADS))
+        runtime = cook.RUNTIME_THREADS
+    if output_capture_mode == ccap.OUTPUT_CAPTURE_MODE_PIPE and runtime != cook.RUNTIME_THREADS:
+        # the captured pipes are copied by OutputCapture's thread which the asyncio runtime does not run
+        logging.info('The {} output capture mode requires the {} runtime'.format(ccap.OUTPUT_CAPTURE_MODE_PIPE,
+                                                                                cook.RUNTIME_THREADS))
+        runtime = cook.RUNTIME_THREADS
     sandbox_directory = environment.get('MESOS_SANDBOX', '')
     shutdown_grace_period = environment.get('MESOS_EXECUTOR_SHUTDOWN_GRACE_PERIOD', '2secs')
+    trace_file_path = environment.get('EXECUTOR_TRACE_FILE', '')
+    if trace_file_path and sandbox_directory:
+        trace_file_path = os.path.join(sandbox_directory, trace_file_path)
 
     logging.info('Max bytes read per line is {}'.format(max_bytes_read_per_line))
     logging.info('Memory usage will be logged every {} secs'.format(memory_usage_interval_secs))
+    logging.info('Message queue size is {}'.format(message_queue_size))
+    if metrics_socket_path:
+        logging.info('Metrics will be served on {}'.format(metrics_socket_path))
+    if multi_task:
+        logging.info('Multi-task mode is enabled with an idle timeout of {} secs'.format(multi_task_idle_timeout_secs))
+    logging.info('Output capture mode is {}'.format(output_capture_mode))
+    logging.info('Output flush interval is {} ms'.format(output_flush_interval_ms))
     logging.info('Progress message length is limited to {}'.format(max_message_length))
+    logging.info('Progress coalescing is {}'.format('enabled' if progress_coalesce else 'disabled'))
+    logging.info('Progress format is {}'.format(progress_format))
     logging.info('Progress output file is {}'.format(progress_output_name))
     logging.info('Progress regex is {}'.format(progress_regex_string))
     logging.info('Progress sample interval is {}'.format(progress_sample_interval_ms))
+    if progress_min_percent_delta > 0:
+        logging.info('Progress updates changing the percent by less than {} back off up to {} ms'.format(
+            progress_min_percent_delta, progress_max_sample_interval_ms))
+    if progress_max_updates_per_sec > 0:
+        logging.info('Progress updates are limited to {} per sec'.format(progress_max_updates_per_sec))
+    logging.info('Progress tail mode is {}'.format(progress_tail_mode))
+    if resource_sample_interval_secs > 0:
+        logging.info('Resource usage of the task will be sampled every {} secs from the {}, and reported every {} secs'
+                     .format(resource_sample_interval_secs, resource_sample_source, resource_report_interval_secs))
+    else:
+        logging.info('Resource usage of the task will not be sampled')
+    logging.info('Runtime is {}'.format(runtime))
     logging.info('Sandbox location is {}'.format(sandbox_directory))
     logging.info('Shutdown grace period is {}'.format(shutdown_grace_period))
+    if trace_file_path:
+        logging.info('Task lifecycle will be traced to {}'.format(trace_file_path))
 
     return ExecutorConfig(max_bytes_read_per_line=max_bytes_read_per_line,
                           max_message_length=max_message_length,
                           memory_usage_interval_secs=memory_usage_interval_secs,
+                          message_queue_size=message_queue_size,
+                          metrics_socket_path=metrics_socket_path,
+                          multi_task=multi_task,
+                          multi_task_idle_timeout_secs=multi_task_idle_timeout_secs,
+                          output_capture_mode=output_capture_mode,
+                          output_flush_interval_ms=output_flush_interval_ms,
                           progress_output_env_variable=progress_output_env_variable,
                           progress_output_name=progress_output_name,
+                          progress_coalesce=progress_coalesce,
+                          progress_format=progress_format,
+                          progress_max_sample_interval_ms=progress_max_sample_interval_ms,
+                          progress_max_updates_per_sec=progress_max_updates_per_sec,
+                          progress_min_percent_delta=progress_min_percent_delta,
                           progress_regex_string=progress_regex_string,
                           progress_sample_interval_ms=progress_sample_interval_ms,
+                          progress_tail_mode=progress_tail_mode,
+                          resource_report_interval_secs=resource_report_interval_secs,
+                          resource_sample_buffer_size=resource_sample_buffer_size,
+                          resource_sample_interval_secs=resource_sample_interval_secs,
+                          resource_sample_source=resource_sample_source,
+                          runtime=runtime,
                           sandbox_directory=sandbox_directory,
-                          shutdown_grace_period=shutdown_grace_period)
+                          shutdown_grace_period=shutdown_grace_period,
+                          trace_file_path=trace_file_path)
@@ -3,17 +3,27 @@ import json
 import logging
 import signal
 import time
-from threading import Event, Lock, Thread, Timer
+from threading import Event, Lock, Thread
 
 import os
 import pymesos as pm
 
 import cook
+import cook.capture as ccap
 import cook.io_helper as cio
+import cook.messaging as cm
+import cook.metrics as cmet
 import cook.progress as cp
+import cook.sampler as csa
+import cook.startup as cst
 import cook.subprocess as cs
+import cook.timers as ct
+import cook.tracing as ctr
 import cook.util as cu
 
+# The max time in secs between checks of the idle timeout of a multi-task executor
+MULTI_TASK_IDLE_CHECK_INTERVAL_SECS = 1
+
 
 def get_task_id(task):
     """Retrieves the id of the task.
@@ -90,8 +100,12 @@ class StatusUpdater(object):
             try:
                 logging.info('Updating task state to {}'.format(task_state))
                 status = self.create_status(task_state, reason=reason)
-                self.driver.sendStatusUpdate(status)
+                with ctr.start_span('update-status', state=task_state, task_id=self.task_id):
+                    self.driver.sendStatusUpdate(status)
                 self.terminal_status_sent = is_terminal_status
+                if task_state == cook.TASK_RUNNING:
+                    cst.mark('task-running')
+                    cst.report(functools.partial(cio.print_err, flush=True))
                 return True
             except Exception:
                 logging.exception('Unable to send task state {}'.format(task_state))
@@ -117,19 +131,24 @@ def send_message(driver, error_handler, message):
     whether the message was successfully sent
     """
     try:
-        logging.info('Sending framework message {}'.format(message))
-        message_string = json.dumps(message).encode('utf8')
-        encoded_message = pm.encode_data(message_string)
-        driver.sendFrameworkMessage(encoded_message)
+        if cm.is_progress_message(message):
+            # progress messages are frequent, ProgressUpdater logs them with rate limiting
+            logging.debug('Sending framework message %s', message)
+        else:
+            logging.info('Sending framework message %s', message)
+        with ctr.start_span('send-message', progress=cm.is_progress_message(message), task_id=message.get('task-id')):
+            message_string = json.dumps(message).encode('utf8')
+            encoded_message = pm.encode_data(message_string)
+            driver.sendFrameworkMessage(encoded_message)
         return True
     except Exception as exception:
         if cu.is_out_of_memory_error(exception):
             error_handler(exception)
         else:
-            logging.exception('Exception while sending message {}'.format(message))
+            logging.exception('Exception while sending message %s', message)
         return False
 
-def launch_task(task, environment):
+def launch_task(task, environment, capture_output=False):
     """Launches the task using the command available in the json map from the data field.
 
     Parameters
@@ -138,6 +157,8 @@ def launch_task(task, environment):
         The task to execute.
     environment: dictionary
         The task environment.
+    capture_output: boolean
+        Whether the stdout and stderr of the task are pipes read by the executor.
 
     Returns
     -------
@@ -149,40 +170,43 @@ def launch_task(task, environment):
         data_json = json.loads(data_string)
         command = str(data_json['command']).strip()
         logging.info('Command: {}'.format(command))
-        return cs.launch_process(command, environment)
+        with ctr.start_span('launch-task', task_id=get_task_id(task)):
+            return cs.launch_process(command, environment, capture_output=capture_output)
     except Exception:
         logging.exception('Error in launch_task')
         return None
 
 
+def output_termination_signal(process):
+    """Prints and logs the signal that terminated the process, if any."""
+    if process.returncode < 0:
+        signal_description = signal.strsignal(-process.returncode)
+        cio.print_and_log('Command terminated with signal {} (pid: {})'.format(signal_description, process.pid),
+                          flush=True)
+
+
 def await_process_completion(process, stop_signal, shutdown_grace_period_ms):
-    """Awaits process completion. Also sets up the thread that will kill the process if stop_signal is set.
+    """Awaits process completion. Also watches the stop_signal to kill the process if stop_signal is set.
+    Waiting for the exit, watching the stop_signal and escalating the kill all happen on the calling thread.
 
     Parameters
     ----------
     process: subprocess.Popen
         The process to whose termination to wait on.
-    stop_signal: Event
-        Event that determines if the process was requested to terminate
+    stop_signal: cook.util.NotifyingEvent
+        Event that determines if the process was requested to terminate, it wakes up the wait once it is set
     shutdown_grace_period_ms: int
         Grace period before forceful kill
 
     Returns
     -------
-    True if the process was killed, False if it terminated naturally.
+    The time at which the exit of the process was detected.
     """
-    def process_stop_signal():
-        stop_signal.wait() # wait indefinitely for the stop_signal to be set
-        if cs.is_process_running(process):
-            logging.info('Executor has been instructed to terminate running task')
-            cs.kill_process(process, shutdown_grace_period_ms)
-
-    kill_thread = Thread(target=process_stop_signal, args=())
-    kill_thread.daemon = True
-    kill_thread.start()
-
-    # wait indefinitely for process to terminate (either normally or by being killed)
-    process.wait()
+    exit_waiter = cs.ProcessExitWaiter(process, stop_signal, shutdown_grace_period_ms)
+    exit_time = exit_waiter.wait()
+    if exit_waiter.terminated():
+        output_termination_signal(process)
+    return exit_time
 
 
 def get_task_state(exit_code):
@@ -241,7 +265,57 @@ def retrieve_process_environment(config, os_environ):
 
 def output_task_completion(task_id, task_state):
     """Prints and logs the executor completion message."""
-    cio.print_and_log('Executor completed execution of {} (state={})'.format(task_id, task_state))
+    cio.print_and_log('Executor completed execution of {} (state={})'.format(task_id, task_state), flush=True)
+
+
+def create_progress_updater(task_id, config, send_progress_message):
+    """Creates the progress updater of the task using the progress sampling settings in config.
+    The token bucket limiting the rate of progress updates is shared by all tasks run by the executor."""
+    token_bucket = None
+    if config.progress_max_updates_per_sec > 0:
+        token_bucket = cp.get_update_token_bucket(config.progress_max_updates_per_sec)
+    return cp.ProgressUpdater(task_id, config.max_message_length, config.progress_sample_interval_ms,
+                              send_progress_message, min_percent_delta=config.progress_min_percent_delta,
+                              max_poll_interval_ms=config.progress_max_sample_interval_ms, token_bucket=token_bucket)
+
+
+def collect_task_metrics(task_id, watchers, progress_updater, message_sender):
+    """Returns the metric samples of the task, they are read from the counters maintained by its components.
+
+    Parameters
+    ----------
+    task_id: string
+        The task id, it is used as a label of all samples.
+    watchers: list of cook.progress.ProgressWatcher
+        The watchers of all progress locations of the task.
+    progress_updater: cook.progress.ProgressUpdater
+        The progress updater of the task.
+    message_sender: cook.messaging.MessageSender
+        The sender of the task's framework messages.
+
+    Returns
+    -------
+    a list of cook.metrics.Sample.
+    """
+    task_labels = [('task_id', task_id)]
+    samples = []
+    for watcher in watchers:
+        labels = task_labels + [('location', watcher.location_tag)]
+        for name, count in [('progress_fragments_read', watcher.fragment_count),
+                            ('progress_lines_read', watcher.line_count),
+                            ('progress_lines_matched', watcher.match_count),
+                            ('progress_fragments_skipped', watcher.skipped_fragment_count),
+                            ('progress_tailer_wakeups', watcher.wakeup_count)]:
+            samples.append(cmet.Sample(name, cmet.METRIC_TYPE_COUNTER, labels, count))
+    for outcome, count in progress_updater.counters.snapshot().items():
+        samples.append(cmet.Sample('progress_updates', cmet.METRIC_TYPE_COUNTER,
+                                   task_labels + [('outcome', outcome)], count))
+    for outcome in ['dropped', 'failed', 'sent', 'superseded']:
+        count = message_sender.counters.get(outcome)
+        samples.append(cmet.Sample('messages', cmet.METRIC_TYPE_COUNTER, task_labels + [('outcome', outcome)], count))
+    samples.append(cmet.Sample('message_queue_depth', cmet.METRIC_TYPE_GAUGE, task_labels,
+                               message_sender.queue_depth()))
+    return samples
 
 
 def os_error_handler(stop_signal, status_updater, os_error):
@@ -249,7 +323,7 @@ def os_error_handler(stop_signal, status_updater, os_error):
 
     Parameters
     ----------
-    stop_signal: threading.Event
+    stop_signal: cook.util.NotifyingEvent
         Event that determines if the process was requested to terminate.
     status_updater: StatusUpdater
         Wrapper object that sends task status messages.
@@ -267,86 +341,142 @@ def os_error_handler(stop_signal, status_updater, os_error):
     cu.print_memory_usage()
 
 
-def manage_task(driver, task, stop_signal, completed_signal, config):
+def manage_task(driver, task, stop_signal, completed_signal, config, timer_service=None):
     """Manages the execution of a task waiting for it to terminate normally or be killed.
        It also sends the task status updates, sandbox location and exit code back to the scheduler.
        Progress updates are tracked on a separate thread and are also sent to the scheduler.
-       Setting the stop_signal will trigger termination of the task and associated cleanup.
+       Setting the stop_signal, a cook.util.NotifyingEvent, will trigger termination of the task and associated
+       cleanup.
+       Deadline and periodic work (e.g. killing the task, sampling) runs on timer_service, a service owned by
+       manage_task is used if it is not provided.
 
     Returns
     -------
     Nothing
     """
     launched_process = None
+    output_capture = None
+    resource_sampler = None
     task_id = get_task_id(task)
-    cio.print_and_log('Starting task {}'.format(task_id))
+    cio.print_and_log('Starting task {}'.format(task_id), flush=True)
+    task_span = ctr.start_span('manage-task', task_id=task_id)
+    owns_timer_service = timer_service is None
+    if owns_timer_service:
+        timer_service = ct.TimerService()
+        timer_service.start()
     status_updater = StatusUpdater(driver, task_id)
 
     inner_os_error_handler = functools.partial(os_error_handler, stop_signal, status_updater)
+    # framework messages are sent on a separate thread to avoid blocking on slow connections to the agent
+    message_sender = cm.MessageSender(functools.partial(send_message, driver, inner_os_error_handler),
+                                      config.message_queue_size)
+    message_sender.start()
+    message_timeout_secs = config.shutdown_grace_period_ms / 1000.0
     try:
         # not yet started to run the task
         status_updater.update_status(cook.TASK_STARTING)
 
         sandbox_message = {'sandbox-directory': config.sandbox_directory, 'task-id': task_id, 'type': 'directory'}
-        send_message(driver, inner_os_error_handler, sandbox_message)
+        message_sender.send(sandbox_message)
 
         environment = retrieve_process_environment(config, os.environ)
-        launched_process = launch_task(task, environment)
+        capture_output = config.output_capture_mode == ccap.OUTPUT_CAPTURE_MODE_PIPE
+        launch_time = time.time()
+        launched_process = launch_task(task, environment, capture_output=capture_output)
         if launched_process:
             # task has begun running successfully
             status_updater.update_status(cook.TASK_RUNNING)
-            cio.print_and_log('Forked command at {}'.format(launched_process.pid))
+            cio.print_and_log('Forked command at {}'.format(launched_process.pid), flush=True)
         else:
             # task launch failed, report an error
             logging.error('Error in launching task')
             status_updater.update_status(cook.TASK_ERROR, reason=cook.REASON_TASK_INVALID)
             return
 
+        if config.resource_sample_interval_secs > 0:
+            resource_sampler = csa.ResourceSampler(task_id, launched_process.pid, config, message_sender.send)
+            resource_sampler.start(timer_service)
+
         task_completed_signal = Event() # event to track task execution completion
         sequence_counter = cp.ProgressSequenceCounter()
 
-        send_progress_message = functools.partial(send_message, driver, inner_os_error_handler)
-        max_message_length = config.max_message_length
-        sample_interval_ms = config.progress_sample_interval_ms
-        progress_updater = cp.ProgressUpdater(task_id, max_message_length, sample_interval_ms, send_progress_message)
-        progress_termination_signal = Event()
+        def send_progress_message(message):
+            return message_sender.send(message, on_failure=progress_updater.handle_send_failure)
 
-        def launch_progress_tracker(progress_location, location_tag):
-            logging.info('Location {} tagged as [tag={}]'.format(progress_location, location_tag))
-            progress_tracker = cp.ProgressTracker(config, stop_signal, task_completed_signal, sequence_counter,
-                                                  progress_updater, progress_termination_signal, progress_location,
-                                                  location_tag, inner_os_error_handler)
-            progress_tracker.start()
-            return progress_tracker
+        progress_updater = create_progress_updater(task_id, config, send_progress_message)
+        progress_termination_signal = Event()
 
         progress_locations = {config.progress_output_name: 'progress',
                               config.stderr_file(): 'stderr',
                               config.stdout_file(): 'stdout'}
+        if capture_output:
+            # captured output is scanned in flight, only the other locations need to be tailed
+            output_capture = ccap.OutputCapture(launched_process, config, stop_signal, task_completed_signal,
+                                                sequence_counter, progress_updater, progress_termination_signal,
+                                                inner_os_error_handler)
+            output_capture.start()
+            progress_locations = {location: location_tag for location, location_tag in progress_locations.items()
+                                  if not ccap.is_captured_location(location, config)}
         logging.info('Progress will be tracked from {} locations'.format(len(progress_locations)))
-        progress_trackers = [launch_progress_tracker(l, progress_locations[l]) for l in progress_locations]
-
-        await_process_completion(launched_process, stop_signal, config.shutdown_grace_period_ms)
+        for progress_location, location_tag in progress_locations.items():
+            logging.info('Location {} tagged as [tag={}]'.format(progress_location, location_tag))
+        progress_tracker = cp.MultiplexedProgressTracker(config, stop_signal, task_completed_signal, sequence_counter,
+                                                         progress_updater, progress_termination_signal,
+                                                         list(progress_locations.items()), inner_os_error_handler)
+        progress_tracker.start()
+
+        progress_watchers = list(progress_tracker.watchers)
+        if output_capture:
+            progress_watchers.extend(stream.watcher for stream in output_capture.streams)
+        cmet.register_collector(task_id, functools.partial(collect_task_metrics, task_id, progress_watchers,
+                                                           progress_updater, message_sender))
+
+        def terminate_progress_tracker():
+            progress_termination_signal.set()
+            progress_tracker.wake_up()
+            if output_capture:
+                output_capture.wake_up()
+
+        with ctr.start_span('await-process', task_id=task_id):
+            exit_time = await_process_completion(launched_process, stop_signal, config.shutdown_grace_period_ms)
         task_completed_signal.set()
+        progress_tracker.wake_up()
 
-        progress_termination_timer = Timer(config.shutdown_grace_period_ms / 1000.0, progress_termination_signal.set)
-        progress_termination_timer.daemon = True
-        progress_termination_timer.start()
+        progress_termination_task = timer_service.schedule(config.shutdown_grace_period_ms / 1000.0,
+                                                           terminate_progress_tracker, 'progress-termination')
 
         # propagate the exit code
         exit_code = launched_process.returncode
-        cio.print_and_log('Command exited with status {} (pid: {})'.format(exit_code, launched_process.pid))
+        cio.print_and_log('Command exited with status {} (pid: {})'.format(exit_code, launched_process.pid), flush=True)
+        logging.info('Command ran for {:.3f} secs'.format(exit_time - launch_time))
 
         exit_message = {'exit-code': exit_code, 'task-id': task_id}
-        send_message(driver, inner_os_error_handler, exit_message)
+        message_sender.send(exit_message)
+
+        if resource_sampler:
+            resource_sampler.stop()
 
         # await progress updater termination if executor is terminating normally
         if not stop_signal.isSet():
             logging.info('Awaiting completion of progress updaters')
-            [progress_tracker.wait() for progress_tracker in progress_trackers]
+            with ctr.start_span('await-progress', task_id=task_id):
+                progress_tracker.wait()
+                if output_capture:
+                    output_capture.wait()
             logging.info('Progress updaters completed')
+        progress_termination_task.cancel()
 
-        # force send the latest progress state if available
-        [progress_tracker.force_send_progress_update() for progress_tracker in progress_trackers]
+        # force send the latest progress state if available, progress that failed to be delivered is sent again
+        with ctr.start_span('force-send-progress', task_id=task_id):
+            message_sender.flush(message_timeout_secs)
+            progress_tracker.force_send_progress_update()
+            if output_capture:
+                output_capture.force_send_progress_update()
+        progress_updater.log_statistics()
+
+        # deliver the exit code and progress messages before the terminal task state
+        with ctr.start_span('deliver-messages', task_id=task_id):
+            message_sender.stop(message_timeout_secs)
 
         # task either completed successfully or aborted with an error
         task_state = get_task_state(exit_code)
@@ -363,19 +493,29 @@ def manage_task(driver, task, stop_signal, completed_signal, config):
             status_updater.update_status(cook.TASK_FAILED, reason=cook.REASON_EXECUTOR_TERMINATED)
 
     finally:
+        if resource_sampler:
+            resource_sampler.stop()
+        message_sender.stop(message_timeout_secs)
+        cmet.unregister_collector(task_id)
+        if owns_timer_service:
+            timer_service.stop()
+        task_span.finish()
+        ctr.flush()
         # ensure completed_signal is set so driver can stop
         completed_signal.set()
         if launched_process and cs.is_process_running(launched_process):
             cs.send_signal(launched_process.pid, signal.SIGKILL)
+        cio.flush_outputs()
 
 
 class CookExecutor(pm.Executor):
     """This class is responsible for launching the task sent by the scheduler.
     It implements the Executor methods."""
 
-    def __init__(self, stop_signal, config):
+    def __init__(self, stop_signal, config, timer_service=None):
         self.completed_signal = Event()
         self.config = config
+        self.timer_service = timer_service
         self.disconnect_signal = Event()
         self.stop_signal = stop_signal
 
@@ -398,7 +538,8 @@ class CookExecutor(pm.Executor):
         completed_signal = self.completed_signal
         config = self.config
 
-        task_thread = Thread(target=manage_task, args=(driver, task, stop_signal, completed_signal, config))
+        task_thread = Thread(target=manage_task, args=(driver, task, stop_signal, completed_signal, config,
+                                                       self.timer_service))
         task_thread.daemon = True
         task_thread.start()
 
@@ -406,7 +547,8 @@ class CookExecutor(pm.Executor):
         logging.info('Mesos requested executor to kill task {}'.format(task_id))
         task_id_str = task_id['value'] if 'value' in task_id else task_id
         grace_period = os.environ.get('MESOS_EXECUTOR_SHUTDOWN_GRACE_PERIOD', '')
-        cio.print_and_log('Received kill for task {} with grace period of {}'.format(task_id_str, grace_period))
+        cio.print_and_log('Received kill for task {} with grace period of {}'.format(task_id_str, grace_period),
+                          flush=True)
         self.stop_signal.set()
 
     def shutdown(self, driver):
@@ -437,3 +579,91 @@ class CookExecutor(pm.Executor):
             self.disconnect_signal.wait(disconnect_grace_secs)
         if not self.disconnect_signal.isSet():
             logging.info('CookExecutor did not disconnect in {} seconds'.format(disconnect_grace_secs))
+
+
+class MultiTaskCookExecutor(CookExecutor):
+    """This class is responsible for launching the tasks sent by the scheduler to a long-lived executor.
+    Each task has its own stop and completion signals, killTask only stops the specified task.
+    The executor completes once it has been shut down, or has been idle for config.multi_task_idle_timeout_secs,
+    and all its tasks have completed."""
+
+    def __init__(self, stop_signal, config, timer_service=None):
+        super().__init__(stop_signal, config, timer_service=timer_service)
+        self.idle_since = time.time()
+        self.lock = Lock()
+        # task id -> (stop_signal, completed_signal) of the running tasks
+        self.task_signals = {}
+
+    def launchTask(self, driver, task):
+        logging.info('Driver {} launching task {}'.format(driver, task))
+
+        task_id = get_task_id(task)
+        stop_signal = cu.NotifyingEvent()
+        completed_signal = Event()
+        with self.lock:
+            if self.stop_signal.isSet() or task_id in self.task_signals:
+                launch_error = 'executor is stopping' if self.stop_signal.isSet() else 'task is already running'
+            else:
+                launch_error = None
+                self.task_signals[task_id] = (stop_signal, completed_signal)
+        if launch_error:
+            logging.error('Unable to launch task {} as the {}'.format(task_id, launch_error))
+            StatusUpdater(driver, task_id).update_status(cook.TASK_FAILED, reason=cook.REASON_EXECUTOR_TERMINATED)
+            return
+
+        def run_task():
+            try:
+                manage_task(driver, task, stop_signal, completed_signal, self.config.task_config(task_id),
+                            self.timer_service)
+            finally:
+                with self.lock:
+                    del self.task_signals[task_id]
+                    num_running_tasks = len(self.task_signals)
+                    if num_running_tasks == 0:
+                        self.idle_since = time.time()
+                logging.info('Executor is running {} task(s)'.format(num_running_tasks))
+
+        task_thread = Thread(target=run_task, args=())
+        task_thread.daemon = True
+        task_thread.start()
+
+    def killTask(self, driver, task_id):
+        logging.info('Mesos requested executor to kill task {}'.format(task_id))
+        task_id_str = task_id['value'] if 'value' in task_id else task_id
+        grace_period = os.environ.get('MESOS_EXECUTOR_SHUTDOWN_GRACE_PERIOD', '')
+        cio.print_and_log('Received kill for task {} with grace period of {}'.format(task_id_str, grace_period),
+                          flush=True)
+        with self.lock:
+            signals = self.task_signals.get(task_id_str)
+        if signals:
+            signals[0].set()
+        else:
+            logging.info('Task {} is not running'.format(task_id_str))
+
+    def has_idle_timeout_expired(self):
+        """Returns true if no task has been running for config.multi_task_idle_timeout_secs, 0 disables the timeout."""
+        idle_timeout_secs = self.config.multi_task_idle_timeout_secs
+        with self.lock:
+            return idle_timeout_secs > 0 and not self.task_signals and \
+                   time.time() - self.idle_since >= idle_timeout_secs
+
+    def await_completion(self):
+        """
+        Blocks until the executor is stopped, or its idle timeout expires, and all running tasks have completed.
+        The stop signal of every running task is set once the executor is stopped.
+        """
+        logging.info('Waiting for MultiTaskCookExecutor to complete...')
+        while not self.stop_signal.wait(MULTI_TASK_IDLE_CHECK_INTERVAL_SECS):
+            if self.has_idle_timeout_expired():
+                logging.info('MultiTaskCookExecutor has been idle for {} secs'.format(
+                    self.config.multi_task_idle_timeout_secs))
+                self.stop_signal.set()
+        with self.lock:
+            running_task_signals = list(self.task_signals.values())
+        logging.info('Stopping {} running task(s)'.format(len(running_task_signals)))
+        for task_stop_signal, _ in running_task_signals:
+            task_stop_signal.set()
+        for _, task_completed_signal in running_task_signals:
+            task_completed_signal.wait()
+        self.completed_signal.set()
+        logging.info('MultiTaskCookExecutor has completed')
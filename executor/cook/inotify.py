@@ -0,0 +1,296 @@
+"""This module provides notifications of changes to files being tailed by the executor.
+On Linux, changes are detected using inotify (accessed via ctypes) which allows the tailing
+threads to sleep until a file is created or modified.
+On other platforms, or when inotify cannot be initialized, a polling notifier is used instead.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import math
+import os
+import select
+import struct
+import sys
+from threading import Event, Lock
+
+TAIL_MODE_INOTIFY = 'inotify'
+TAIL_MODE_POLL = 'poll'
+
+# The interval at which the inotify notifier wakes up to check the stop and completion signals.
+# Callers are expected to invoke wake() when those signals are set, this timeout is only a safety net.
+INOTIFY_IDLE_TIMEOUT_MS = 1000
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+DIRECTORY_EVENT_MASK = IN_CREATE | IN_MOVED_TO
+FILE_EVENT_MASK = IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF
+
+_event_header = struct.Struct('iIII')
+_libc = None
+_libc_lock = Lock()
+
+
+def _load_libc():
+    """Loads the C library exposing the inotify functions, returns None if they are not available."""
+    global _libc
+    with _libc_lock:
+        if _libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                if all(hasattr(libc, name) for name in ['inotify_init1', 'inotify_add_watch', 'inotify_rm_watch']):
+                    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                    _libc = libc
+                else:
+                    _libc = False
+            except Exception:
+                logging.exception('Unable to load the C library for inotify')
+                _libc = False
+        return _libc or None
+
+
+def is_inotify_available():
+    """Returns true if inotify can be used on the current platform."""
+    return sys.platform.startswith('linux') and _load_libc() is not None
+
+
+class PollingNotifier(object):
+    """Notifier that wakes up at a fixed interval irrespective of any changes to the watched files."""
+
+    def __init__(self, poll_interval_ms):
+        """
+        Parameters
+        ----------
+        poll_interval_ms: int
+            The unit of time in ms to sleep in await_change.
+        """
+        self.poll_interval_secs = poll_interval_ms / 1000.0
+        self.wake_event = Event()
+        self.wakeup_count = 0
+
+    def watch(self, path):
+        """Polling does not need to register the paths to watch, always returns True."""
+        return True
+
+    def wait_fds(self):
+        """Polling has no file descriptors that become readable on changes, always returns an empty list."""
+        return []
+
+    def wait_timeout_ms(self, timeout_ms=None):
+        """Returns the time in ms await_change sleeps for, i.e. poll_interval_ms or timeout_ms if smaller."""
+        poll_interval_ms = self.poll_interval_secs * 1000
+        return poll_interval_ms if timeout_ms is None else min(poll_interval_ms, timeout_ms)
+
+    def await_change(self, timeout_ms=None):
+        """Sleeps for poll_interval_ms (or timeout_ms if smaller) or until wake() is invoked."""
+        self.wake_event.wait(self.wait_timeout_ms(timeout_ms) / 1000.0)
+        self.wake_event.clear()
+        self.wakeup_count += 1
+
+    def wake(self):
+        """Interrupts a thread blocked in await_change."""
+        self.wake_event.set()
+
+    def close(self):
+        """Releases resources held by the notifier."""
+        pass
+
+
+class InotifyNotifier(object):
+    """Notifier that sleeps until one of the watched files is created or modified.
+    It falls back to polling at poll_interval_ms if any path could not be watched.
+    """
+
+    def __init__(self, poll_interval_ms, idle_timeout_ms=INOTIFY_IDLE_TIMEOUT_MS):
+        """
+        Parameters
+        ----------
+        poll_interval_ms: int
+            The unit of time in ms to sleep in await_change when some path could not be watched.
+        idle_timeout_ms: int
+            The max time in ms to sleep in await_change when no changes are reported.
+        """
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = libc
+        self.inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.inotify_fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number))
+        self.wake_read_fd, self.wake_write_fd = os.pipe()
+        os.set_blocking(self.wake_read_fd, False)
+        os.set_blocking(self.wake_write_fd, False)
+        self.poller = select.poll()
+        self.poller.register(self.inotify_fd, select.POLLIN)
+        self.poller.register(self.wake_read_fd, select.POLLIN)
+
+        self.poll_interval_ms = poll_interval_ms
+        self.idle_timeout_ms = max(idle_timeout_ms, poll_interval_ms)
+        self.directory_watches = {}
+        self.file_watches = {}
+        self.pending_files = {}
+        self.polling = False
+        self.wakeup_count = 0
+        self.closed = False
+        self.lock = Lock()
+
+    def __add_watch(self, path, mask):
+        """Adds an inotify watch on path, returns the watch descriptor or None on failure."""
+        watch_descriptor = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(path), mask)
+        if watch_descriptor < 0:
+            error_number = ctypes.get_errno()
+            logging.info('Unable to watch %s: %s', path, os.strerror(error_number))
+            return None
+        return watch_descriptor
+
+    def __watch_file(self, path):
+        """Watches the file at path for modifications, returns True if the watch was added."""
+        watch_descriptor = self.__add_watch(path, FILE_EVENT_MASK)
+        if watch_descriptor is None:
+            return False
+        self.file_watches[watch_descriptor] = path
+        return True
+
+    def watch(self, path):
+        """Registers path to be watched for creation and modifications.
+        The parent directory is watched (before checking for existence to avoid races) so that
+        the file can be watched for modifications as soon as it is created.
+
+        Returns
+        -------
+        True if inotify is watching the path, False if await_change falls back to polling.
+        """
+        directory = os.path.dirname(path) or '.'
+        if directory not in self.directory_watches.values():
+            watch_descriptor = self.__add_watch(directory, DIRECTORY_EVENT_MASK)
+            if watch_descriptor is None:
+                self.polling = True
+                return False
+            self.directory_watches[watch_descriptor] = directory
+        if os.path.exists(path):
+            if not self.__watch_file(path):
+                self.polling = True
+                return False
+        else:
+            self.pending_files.setdefault(directory, set()).add(os.path.basename(path))
+        return True
+
+    def __process_events(self, data):
+        """Processes the raw inotify events, watching any pending files that have been created."""
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            watch_descriptor, mask, _, name_length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = data[offset:offset + name_length].rstrip(b'\0')
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                logging.info('inotify event queue overflowed, re-checking pending files')
+                self.__watch_created_files()
+            elif mask & IN_IGNORED:
+                self.directory_watches.pop(watch_descriptor, None)
+                self.file_watches.pop(watch_descriptor, None)
+            elif watch_descriptor in self.directory_watches and name:
+                directory = self.directory_watches[watch_descriptor]
+                basename = os.fsdecode(name)
+                if basename in self.pending_files.get(directory, ()):
+                    self.pending_files[directory].discard(basename)
+                    if not self.__watch_file(os.path.join(directory, basename)):
+                        self.polling = True
+
+    def __watch_created_files(self):
+        """Watches any pending file which already exists."""
+        for directory, basenames in self.pending_files.items():
+            for basename in list(basenames):
+                path = os.path.join(directory, basename)
+                if os.path.exists(path):
+                    basenames.discard(basename)
+                    if not self.__watch_file(path):
+                        self.polling = True
+
+    def __drain(self, fd):
+        """Reads all available data from the non-blocking fd."""
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def wait_fds(self):
+        """Returns the file descriptors which become readable when a watched file changes or wake() is invoked."""
+        return [self.inotify_fd, self.wake_read_fd]
+
+    def wait_timeout_ms(self, timeout_ms=None):
+        """Returns the max time in ms await_change sleeps for, i.e. the idle timeout (or the poll interval if
+        some path is not watched) unless timeout_ms is smaller."""
+        max_timeout_ms = self.poll_interval_ms if self.polling else self.idle_timeout_ms
+        return max_timeout_ms if timeout_ms is None else min(max_timeout_ms, timeout_ms)
+
+    def await_change(self, timeout_ms=None):
+        """Sleeps until a watched file is created or modified, wake() is invoked or the timeout expires.
+        The timeout is the idle timeout (or the poll interval if some path is not watched) unless timeout_ms is smaller.
+        """
+        ready_events = self.poller.poll(int(math.ceil(self.wait_timeout_ms(timeout_ms))))
+        self.wakeup_count += 1
+        for fd, _ in ready_events:
+            data = self.__drain(fd)
+            if fd == self.inotify_fd:
+                self.__process_events(data)
+
+    def wake(self):
+        """Interrupts a thread blocked in await_change."""
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                os.write(self.wake_write_fd, b'\0')
+            except BlockingIOError:
+                # the pipe is full, i.e. a wake up is already pending
+                pass
+
+    def close(self):
+        """Releases the inotify and pipe file descriptors held by the notifier."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for fd in [self.inotify_fd, self.wake_read_fd, self.wake_write_fd]:
+                os.close(fd)
+
+
+def create_notifier(tail_mode, poll_interval_ms):
+    """Creates the notifier to use while tailing files.
+
+    Parameters
+    ----------
+    tail_mode: string
+        Either TAIL_MODE_INOTIFY or TAIL_MODE_POLL.
+    poll_interval_ms: int
+        The unit of time in ms to sleep when polling.
+
+    Returns
+    -------
+    An InotifyNotifier if requested and available, else a PollingNotifier.
+    """
+    if tail_mode == TAIL_MODE_INOTIFY and is_inotify_available():
+        try:
+            return InotifyNotifier(poll_interval_ms)
+        except OSError:
+            logging.exception('Unable to initialize inotify, falling back to polling')
+    return PollingNotifier(poll_interval_ms)
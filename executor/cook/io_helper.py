@@ -1,25 +1,148 @@
 #!/usr/bin/env python3
 
-"""This module ensures atomic writes to stdout."""
+"""This module ensures atomic writes to stdout and stderr.
+Output is written through buffered writers which batch messages between flushes, each message is written as a whole.
+"""
 
 import logging
 import sys
+import time
 from threading import Lock
 
 import os
 
-__stdout_lock__ = Lock()
+# The default interval after which buffered output is flushed, 0 flushes on every write
+DEFAULT_FLUSH_INTERVAL_MS = 0
+# The flush interval the executor configures by default (see set_flush_interval), the output is then flushed
+# periodically and at the explicit flush points instead of on every write
+DEFAULT_EXECUTOR_FLUSH_INTERVAL_MS = 100
+# Buffered output is flushed once it exceeds this many bytes irrespective of the flush interval
+MAX_BUFFERED_BYTES = 64 * 1024
 
 
-def print_to_buffer(lock, buffer, data, flush=False, newline=True):
-    """Helper function that prints data to the specified buffer in a thread-safe manner using the lock.
+def encode_messages(messages):
+    """Encodes the list of string or bytes messages into a single bytes object.
+    Consecutive string messages are joined and encoded together.
+    """
+    chunks = []
+    strings = []
+    for message in messages:
+        if isinstance(message, str):
+            strings.append(message)
+        else:
+            if strings:
+                chunks.append(''.join(strings).encode())
+                strings = []
+            chunks.append(message)
+    if strings:
+        chunks.append(''.join(strings).encode())
+    return b''.join(chunks)
+
+
+class BufferedWriter(object):
+    """Buffers messages written to a binary buffer and writes them out together on flush.
+    Each message is buffered as a whole and hence is never interleaved with other messages.
+    Writers only hold the lock to append their message, encoding and writing happen when the buffer is flushed:
+    explicitly, once flush_interval_ms has elapsed since the last flush or once max_buffered_bytes are buffered.
+    """
+
+    def __init__(self, buffer_fn, flush_interval_ms=DEFAULT_FLUSH_INTERVAL_MS, max_buffered_bytes=MAX_BUFFERED_BYTES):
+        """
+        Parameters
+        ----------
+        buffer_fn: function()
+            Returns the binary buffer to write to, it is looked up on every flush.
+        flush_interval_ms: int
+            The interval after which buffered messages are flushed, 0 flushes on every write.
+        max_buffered_bytes: int
+            The number of buffered bytes after which messages are flushed irrespective of the interval.
+        """
+        self.buffer_fn = buffer_fn
+        self.flush_interval_secs = flush_interval_ms / 1000.0
+        self.max_buffered_bytes = max_buffered_bytes
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.messages = []
+        self.buffered_bytes = 0
+        self.last_flush_time = time.monotonic()
+        self.write_count = 0
+        self.flush_count = 0
+
+    def write(self, data, flush=False, newline=True):
+        """Buffers data as a single message and flushes if requested or due.
+        Using this method is thread-safe.
+
+        Parameters
+        ----------
+        data: string or bytes
+            The data to output
+        flush: boolean
+            Flag determining whether to flush the buffered messages
+        newline: boolean
+            Flag determining whether to output a newline at the end
+
+        Returns
+        -------
+        Nothing.
+        """
+        if newline:
+            data = data + (os.linesep if isinstance(data, str) else os.linesep.encode())
+        with self.lock:
+            self.messages.append(data)
+            self.buffered_bytes += len(data)
+            self.write_count += 1
+            flush = flush or self.buffered_bytes >= self.max_buffered_bytes or \
+                    time.monotonic() - self.last_flush_time >= self.flush_interval_secs
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered messages, in the order they were written, with a single write and flush."""
+        with self.flush_lock:
+            with self.lock:
+                messages = self.messages
+                self.messages = []
+                self.buffered_bytes = 0
+                self.last_flush_time = time.monotonic()
+            if messages:
+                buffer = self.buffer_fn()
+                buffer.write(encode_messages(messages))
+                buffer.flush()
+                self.flush_count += 1
+
+    def flush_if_due(self):
+        """Flushes the buffered messages if flush_interval_ms has elapsed since the last flush."""
+        if time.monotonic() - self.last_flush_time >= self.flush_interval_secs:
+            self.flush()
+
+
+__stdout_writer__ = BufferedWriter(lambda: sys.stdout.buffer)
+__stderr_writer__ = BufferedWriter(lambda: sys.stderr.buffer)
+
+
+def set_flush_interval(flush_interval_ms):
+    """Sets the interval after which output buffered for stdout and stderr is flushed, 0 flushes on every write."""
+    for writer in [__stdout_writer__, __stderr_writer__]:
+        writer.flush_interval_secs = flush_interval_ms / 1000.0
+
+
+def flush_outputs():
+    """Flushes the output buffered for stdout and stderr."""
+    __stdout_writer__.flush()
+    __stderr_writer__.flush()
+
+
+def flush_outputs_if_due():
+    """Flushes the output buffered for stdout and stderr if the flush interval has elapsed."""
+    __stdout_writer__.flush_if_due()
+    __stderr_writer__.flush_if_due()
+
+
+def print_out(data, flush=False, newline=True):
+    """Wrapper function that prints to stdout in a thread-safe manner, each call is written atomically.
 
     Parameters
     ----------
-    lock: threading.Lock
-        The lock to use
-    buffer: byte buffer
-        The buffer to write to
     data: string or bytes
         The data to output
     flush: boolean
@@ -31,26 +154,18 @@ def print_to_buffer(lock, buffer, data, flush=False, newline=True):
     -------
     Nothing.
     """
-    with lock:
-        if isinstance(data, str):
-            buffer.write(data.encode())
-        else:
-            buffer.write(data)
-        if newline:
-            buffer.write(os.linesep.encode())
-        if flush:
-            buffer.flush()
+    __stdout_writer__.write(data, flush=flush, newline=newline)
 
 
-def print_out(data, flush=False, newline=True):
-    """Wrapper function that prints to stdout in a thread-safe manner using the __stdout_lock__ lock.
+def print_err(data, flush=False, newline=True):
+    """Wrapper function that prints to stderr in a thread-safe manner, each call is written atomically.
 
     Parameters
     ----------
     data: string or bytes
         The data to output
     flush: boolean
-        Flag determining whether to trigger a sys.stdout.flush()
+        Flag determining whether to trigger a sys.stderr.flush()
     newline: boolean
         Flag determining whether to output a newline at the end
 
@@ -58,11 +173,11 @@ def print_out(data, flush=False, newline=True):
     -------
     Nothing.
     """
-    print_to_buffer(__stdout_lock__, sys.stdout.buffer, data, flush=flush, newline=newline)
+    __stderr_writer__.write(data, flush=flush, newline=newline)
 
 
-def print_and_log(string_data, newline=True):
-    """Wrapper function that prints and flushes to stdout in a locally thread-safe manner ensuring newline at the start.
+def print_and_log(string_data, newline=True, flush=False):
+    """Wrapper function that prints to stdout in a locally thread-safe manner ensuring newline at the start.
     The function also outputs the same message via logging.info().
 
     Parameters
@@ -71,10 +186,12 @@ def print_and_log(string_data, newline=True):
         The string to output
     newline: boolean
         Flag determining whether to output a newline at the end
+    flush: boolean
+        Flag determining whether to flush stdout, e.g. at task start, exit or kill
 
     Returns
     -------
     Nothing.
     """
-    print_out('{}{}'.format(os.linesep, string_data), flush=True, newline=newline)
+    print_out('{}{}'.format(os.linesep, string_data), flush=flush, newline=newline)
     logging.info(string_data)
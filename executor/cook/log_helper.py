@@ -0,0 +1,98 @@
+"""This module provides logging helpers for the executor's hot paths.
+Messages are formatted lazily and only when the logger level allows them, high-frequency events are
+either rate-limited or aggregated into counters which are logged as a summary.
+"""
+
+import collections
+import logging
+import time
+from threading import Lock
+
+# The min interval between two rate-limited messages with the same key
+DEFAULT_RATE_LIMIT_INTERVAL_SECS = 10
+
+
+class RateLimitedLogger(object):
+    """Logs at most one message per key every interval_secs.
+    Messages dropped in between are counted and the count is reported with the next logged message.
+    """
+
+    def __init__(self, interval_secs=DEFAULT_RATE_LIMIT_INTERVAL_SECS, logger=None):
+        """
+        Parameters
+        ----------
+        interval_secs: float
+            The min interval between two messages logged with the same key.
+        logger: logging.Logger, optional
+            The logger to use, defaults to the root logger.
+        """
+        self.interval_secs = interval_secs
+        self.logger = logger or logging.getLogger()
+        self.last_logged_times = {}
+        self.suppressed_counts = collections.Counter()
+        self.lock = Lock()
+
+    def log(self, level, key, message, *args):
+        """Logs message % args at level unless a message with the same key was logged in the last interval_secs.
+
+        Parameters
+        ----------
+        level: int
+            The logging level.
+        key: string
+            The key identifying the type of event being logged.
+        message: string
+            The %-style format string, it is only formatted if the message is logged.
+        args: list
+            The arguments of the format string.
+
+        Returns
+        -------
+        True if the message was logged, else False.
+        """
+        if not self.logger.isEnabledFor(level):
+            return False
+        current_time = time.monotonic()
+        with self.lock:
+            last_logged_time = self.last_logged_times.get(key)
+            if last_logged_time is not None and current_time - last_logged_time < self.interval_secs:
+                self.suppressed_counts[key] += 1
+                return False
+            self.last_logged_times[key] = current_time
+            suppressed_count = self.suppressed_counts.pop(key, 0)
+        if suppressed_count:
+            self.logger.log(level, message + ' (%s similar messages suppressed)', *args, suppressed_count)
+        else:
+            self.logger.log(level, message, *args)
+        return True
+
+    def info(self, key, message, *args):
+        """Rate-limited equivalent of logging.info."""
+        return self.log(logging.INFO, key, message, *args)
+
+
+class EventCounters(object):
+    """Thread-safe named counters which replace logging a line for every event."""
+
+    def __init__(self):
+        self.counts = collections.OrderedDict()
+        self.lock = Lock()
+
+    def increment(self, name, delta=1):
+        """Increments the named counter by delta."""
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + delta
+
+    def get(self, name):
+        """Returns the value of the named counter."""
+        with self.lock:
+            return self.counts.get(name, 0)
+
+    def snapshot(self):
+        """Returns a copy of all the counters."""
+        with self.lock:
+            return dict(self.counts)
+
+    def __str__(self):
+        with self.lock:
+            return ', '.join('{}={}'.format(name, count) for name, count in self.counts.items())
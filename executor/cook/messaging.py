@@ -0,0 +1,203 @@
+"""This module sends framework messages to the scheduler on a dedicated thread.
+Progress tracking and task management threads only enqueue messages and are hence never blocked by a slow
+connection to the agent.
+"""
+
+import collections
+import logging
+import time
+from threading import Condition, Thread
+
+import cook.log_helper as clog
+import cook.metrics as cmet
+
+# The default bound on the number of queued messages, only progress messages are dropped when it is reached
+DEFAULT_MAX_QUEUE_SIZE = 64
+
+
+def is_progress_message(message):
+    """Returns true if the message is a progress update, such messages can be superseded by later ones."""
+    return 'progress-sequence' in message
+
+
+class MessageSender(object):
+    """Sends framework messages from a bounded queue on a dedicated sender thread.
+    Messages queued while a send is in progress are sent together in the next batch.
+    A queued progress message is replaced by a later progress message for the same task (it has been superseded),
+    and new progress messages are dropped while the queue is full.
+    Other messages, e.g. the sandbox directory and exit code, are never dropped or replaced.
+    """
+
+    def __init__(self, send_message_fn, max_queue_size=DEFAULT_MAX_QUEUE_SIZE):
+        """
+        Parameters
+        ----------
+        send_message_fn: function(message)
+            The helper function used to send a message, it returns whether the message was successfully sent.
+        max_queue_size: int
+            The number of queued messages after which new progress messages are dropped.
+        """
+        self.send_message = send_message_fn
+        self.max_queue_size = max(max_queue_size, 1)
+        self.condition = Condition()
+        # entries are [message, on_failure, enqueue_time] lists which allow progress messages to be replaced in place
+        self.queue = collections.deque()
+        self.queued_progress_entries = {}
+        self.in_flight_count = 0
+        self.stopped = False
+        self.sender_thread = None
+
+        # messages are counted as 'sent', 'failed', 'superseded' or 'dropped' instead of being logged individually
+        self.counters = clog.EventCounters()
+        self.rate_limited_logger = clog.RateLimitedLogger()
+        self.batch_count = 0
+        self.max_queue_depth = 0
+        self.max_send_latency_ms = 0
+        self.total_send_latency_ms = 0
+
+    def start(self):
+        """Starts the sender thread."""
+        self.sender_thread = Thread(target=self.__send_queued_messages, args=(), name='message-sender')
+        self.sender_thread.daemon = True
+        self.sender_thread.start()
+
+    def queue_depth(self):
+        """Returns the number of messages waiting to be sent."""
+        with self.condition:
+            return len(self.queue)
+
+    def send(self, message, on_failure=None):
+        """Queues the message to be sent by the sender thread.
+        Using this method is thread-safe.
+
+        Parameters
+        ----------
+        message: dictionary
+            The raw message to send.
+        on_failure: function(message), optional
+            Invoked on the sender thread if the message could not be sent.
+
+        Returns
+        -------
+        True if the message was queued, else False (e.g. the progress message was dropped as the queue is full).
+        """
+        with self.condition:
+            if self.stopped:
+                logging.info('Message sender has been stopped, dropping message %s', message)
+                return False
+            if is_progress_message(message):
+                task_id = message.get('task-id')
+                queued_entry = self.queued_progress_entries.get(task_id)
+                if queued_entry is not None:
+                    logging.debug('Replacing superseded progress message %s', queued_entry[0])
+                    queued_entry[0] = message
+                    queued_entry[1] = on_failure
+                    self.counters.increment('superseded')
+                    return True
+                if len(self.queue) >= self.max_queue_size:
+                    self.rate_limited_logger.info('dropped', 'Message queue is full, dropping progress message %s',
+                                                  message)
+                    self.counters.increment('dropped')
+                    return False
+                entry = [message, on_failure, time.time()]
+                self.queued_progress_entries[task_id] = entry
+                self.queue.append(entry)
+            else:
+                self.queue.append([message, on_failure, time.time()])
+            self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+            self.condition.notify_all()
+            return True
+
+    def __handle_failure(self, entry):
+        """Invokes the failure callback of the entry, if any, outside the queue lock."""
+        message, on_failure, _ = entry
+        if on_failure is not None:
+            try:
+                on_failure(message)
+            except Exception:
+                logging.exception('Error in handling failure to send message {}'.format(message))
+
+    def take_batch(self):
+        """Removes all queued messages and returns them as the next batch to send, the caller must hold the condition.
+        The messages are counted as in flight until they are passed to send_batch.
+        """
+        batch = list(self.queue)
+        self.queue.clear()
+        self.queued_progress_entries.clear()
+        self.in_flight_count += len(batch)
+        self.batch_count += 1
+        return batch
+
+    def send_batch(self, batch):
+        """Sends the messages in the batch in order and updates the send statistics."""
+        for entry in batch:
+            message, _, enqueue_time = entry
+            if self.send_message(message):
+                latency_ms = (time.time() - enqueue_time) * 1000
+                self.counters.increment('sent')
+                with self.condition:
+                    self.total_send_latency_ms += latency_ms
+                    self.max_send_latency_ms = max(self.max_send_latency_ms, latency_ms)
+                cmet.observe('message_send_latency_ms', latency_ms)
+            else:
+                self.counters.increment('failed')
+                self.__handle_failure(entry)
+            with self.condition:
+                self.in_flight_count -= 1
+                self.condition.notify_all()
+
+    def __send_queued_messages(self):
+        """Sends batches of queued messages until the sender is stopped and the queue has been drained."""
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                batch = self.take_batch()
+            try:
+                self.send_batch(batch)
+            except Exception:
+                logging.exception('Error in sending queued messages')
+                with self.condition:
+                    self.in_flight_count = 0
+                    self.condition.notify_all()
+
+    def flush(self, timeout_secs=None):
+        """Blocks until all queued messages have been sent or the timeout expires.
+
+        Returns
+        -------
+        True if all queued messages have been sent, else False.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.queue and self.in_flight_count == 0, timeout_secs)
+
+    def stop(self, timeout_secs=None):
+        """Stops accepting new messages and waits for the queued messages to be sent.
+
+        Returns
+        -------
+        True if all queued messages have been sent, else False.
+        """
+        with self.condition:
+            already_stopped = self.stopped
+            self.stopped = True
+            self.condition.notify_all()
+        flushed = self.flush(timeout_secs)
+        if not already_stopped:
+            if self.sender_thread is not None:
+                self.sender_thread.join(timeout_secs)
+            self.log_statistics()
+        return flushed
+
+    def log_statistics(self):
+        """Logs the number of messages handled, the max queue depth and the send latency."""
+        counts = self.counters.snapshot()
+        sent_count = counts.get('sent', 0)
+        with self.condition:
+            average_latency_ms = self.total_send_latency_ms / sent_count if sent_count else 0
+            logging.info('{} messages sent in {} batches ({} failed, {} superseded, {} dropped), max queue depth {}, '
+                         'send latency average {:.2f} ms and max {:.2f} ms'.format(
+                sent_count, self.batch_count, counts.get('failed', 0), counts.get('superseded', 0),
+                counts.get('dropped', 0), self.max_queue_depth, average_latency_ms, self.max_send_latency_ms))
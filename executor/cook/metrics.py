@@ -0,0 +1,252 @@
+"""This module exposes the executor's metrics for scraping by a node-level agent, it is enabled by configuring
+a metrics socket. The metrics are served over HTTP on a Unix domain socket in the sandbox, in the Prometheus
+text format. Counters are read from the executor components when the metrics are scraped, hence the progress
+hot paths do no additional work; only infrequent events, e.g. sending a message or killing the task, are
+recorded in histograms.
+"""
+
+import bisect
+import collections
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from threading import Lock, Thread
+
+METRIC_PREFIX = 'cook_executor_'
+
+METRIC_TYPE_COUNTER = 'counter'
+METRIC_TYPE_GAUGE = 'gauge'
+METRIC_TYPE_HISTOGRAM = 'histogram'
+
+# The upper bounds, in ms, of the histogram buckets
+DEFAULT_BUCKET_BOUNDS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 60000)
+
+# A metric sample, labels is a list of (name, value) tuples
+Sample = collections.namedtuple('Sample', ['name', 'metric_type', 'labels', 'value'])
+
+__registry__ = None
+__start_time__ = time.time()
+
+
+class Histogram(object):
+    """Thread-safe histogram with fixed buckets."""
+
+    def __init__(self, bounds=DEFAULT_BUCKET_BOUNDS_MS):
+        self.bounds = tuple(bounds)
+        self.bucket_counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        """Records the value in the first bucket whose upper bound is at least value."""
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.total += value
+
+    def samples(self, name):
+        """Returns the cumulative bucket counts, sum and count of the histogram as samples."""
+        with self.lock:
+            bucket_counts = list(self.bucket_counts)
+            count = self.count
+            total = self.total
+        samples = []
+        cumulative_count = 0
+        for bound, bucket_count in zip(list(self.bounds) + ['+Inf'], bucket_counts):
+            cumulative_count += bucket_count
+            samples.append(Sample(name + '_bucket', METRIC_TYPE_HISTOGRAM, [('le', str(bound))], cumulative_count))
+        samples.append(Sample(name + '_sum', METRIC_TYPE_HISTOGRAM, [], total))
+        samples.append(Sample(name + '_count', METRIC_TYPE_HISTOGRAM, [], count))
+        return samples
+
+
+class MetricsRegistry(object):
+    """Holds the histograms and the collectors which read the metrics of the executor components when scraped."""
+
+    def __init__(self):
+        self.collectors = collections.OrderedDict()
+        self.histograms = collections.OrderedDict()
+        self.lock = Lock()
+
+    def histogram(self, name):
+        """Returns the histogram with the given name, it is created on first use."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            return histogram
+
+    def register_collector(self, key, collect_fn):
+        """Registers collect_fn, a function returning a list of samples, under key replacing any previous one."""
+        with self.lock:
+            self.collectors[key] = collect_fn
+
+    def unregister_collector(self, key):
+        """Removes the collector registered under key, if any."""
+        with self.lock:
+            self.collectors.pop(key, None)
+
+    def collect(self):
+        """Returns the samples of all collectors and histograms, a failing collector is skipped."""
+        with self.lock:
+            collectors = list(self.collectors.items())
+            histograms = list(self.histograms.items())
+        samples = []
+        for key, collect_fn in collectors:
+            try:
+                samples.extend(collect_fn())
+            except Exception:
+                logging.exception('Error in collecting the {} metrics'.format(key))
+        for name, histogram in histograms:
+            samples.extend(histogram.samples(name))
+        return samples
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        samples_by_metric = collections.OrderedDict()
+        for sample in self.collect():
+            metric_name = sample.name
+            if sample.metric_type == METRIC_TYPE_HISTOGRAM:
+                metric_name = metric_name.rsplit('_', 1)[0]
+            samples_by_metric.setdefault((metric_name, sample.metric_type), []).append(sample)
+        lines = []
+        for (metric_name, metric_type), samples in samples_by_metric.items():
+            lines.append('# TYPE {}{} {}'.format(METRIC_PREFIX, metric_name, metric_type))
+            for sample in samples:
+                labels = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for name, value in sample.labels)
+                lines.append('{}{}{} {}'.format(METRIC_PREFIX, sample.name, '{' + labels + '}' if labels else '',
+                                                sample.value))
+        return '\n'.join(lines) + '\n'
+
+
+def current_rss_bytes():
+    """Returns the resident set size of the executor, the peak resident set size where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # in OSX ru_maxrss is reported in bytes instead of KB
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def collect_process_metrics():
+    """Returns the samples describing the executor process."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return [Sample('cpu_seconds', METRIC_TYPE_COUNTER, [], usage.ru_utime + usage.ru_stime),
+            Sample('resident_memory_bytes', METRIC_TYPE_GAUGE, [], current_rss_bytes()),
+            Sample('threads', METRIC_TYPE_GAUGE, [], threading.active_count()),
+            Sample('uptime_seconds', METRIC_TYPE_GAUGE, [], time.time() - __start_time__)]
+
+
+def enable():
+    """Enables the metrics, the registry is created on the first call and returned."""
+    global __registry__
+    if __registry__ is None:
+        __registry__ = MetricsRegistry()
+        __registry__.register_collector('process', collect_process_metrics)
+    return __registry__
+
+
+def observe(name, value):
+    """Records value in the named histogram, does nothing when the metrics are not enabled."""
+    registry = __registry__
+    if registry is not None:
+        registry.histogram(name).observe(value)
+
+
+def register_collector(key, collect_fn):
+    """Registers collect_fn under key, does nothing when the metrics are not enabled."""
+    registry = __registry__
+    if registry is not None:
+        registry.register_collector(key, collect_fn)
+
+
+def unregister_collector(key):
+    """Removes the collector registered under key, does nothing when the metrics are not enabled."""
+    registry = __registry__
+    if registry is not None:
+        registry.unregister_collector(key)
+
+
+class MetricsServer(object):
+    """Serves the rendered metrics over HTTP on a Unix domain socket from a dedicated thread.
+    The metrics can be scraped using, for example, curl --unix-socket <socket-path> http://localhost/metrics
+    """
+
+    def __init__(self, socket_path, registry):
+        """
+        Parameters
+        ----------
+        socket_path: string
+            The path of the Unix domain socket, an existing file at the path is replaced.
+        registry: MetricsRegistry
+            The registry whose metrics are served.
+        """
+        self.socket_path = socket_path
+        self.registry = registry
+        self.server = None
+
+    def create_server(self):
+        """Creates the HTTP server bound to the socket path."""
+        # imported lazily, the metrics server is optional and importing http.server adds to the startup time
+        import http.server
+        import socketserver
+
+        registry = self.registry
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # clients of a Unix domain socket have no address
+                return 'local'
+
+            def log_message(self, format, *args):
+                logging.debug('Metrics request: ' + format, *args)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        return socketserver.UnixStreamServer(self.socket_path, MetricsRequestHandler)
+
+    def start(self):
+        """Starts serving the metrics, failures are logged as the metrics are not essential to run the task."""
+        try:
+            self.server = self.create_server()
+        except Exception:
+            logging.exception('Unable to serve metrics on {}'.format(self.socket_path))
+            return False
+        server_thread = Thread(target=self.server.serve_forever, args=(), name='metrics-server')
+        server_thread.daemon = True
+        server_thread.start()
+        logging.info('Serving metrics on {}'.format(self.socket_path))
+        return True
+
+    def stop(self):
+        """Stops serving the metrics and removes the socket."""
+        server = self.server
+        if server is None:
+            return
+        self.server = None
+        server.shutdown()
+        server.server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
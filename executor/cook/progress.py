@@ -1,22 +1,322 @@
+import collections
+import io
+import itertools
+import json
 import logging
 import os
 import re
 import time
 from threading import Event, Lock, Thread
 
+import cook.inotify as ci
+import cook.log_helper as clog
+import cook.tracing as ctr
 import cook.util as cu
 
+# The unit of time in ms to sleep while polling for new content in the progress locations
+TAIL_SLEEP_TIME_MS = 50
+# The number of bytes requested from the file in each read while tailing
+TAIL_CHUNK_SIZE_BYTES = 64 * 1024
+
+FILE_STATE_MISSING = 'missing'
+FILE_STATE_ROTATED = 'rotated'
+FILE_STATE_TRUNCATED = 'truncated'
+FILE_STATE_UNCHANGED = 'unchanged'
+
+PROGRESS_FORMAT_JSON = 'json'
+PROGRESS_FORMAT_REGEX = 'regex'
+# The key which must be present in a json progress line, it is also used to skip other lines cheaply
+JSON_PROGRESS_PERCENT_KEY = 'percent'
+
+# An immutable progress state matched in the task's output.
+# The message is the raw bytes matched by the regex or the string from a json progress line, metrics are optional.
+ProgressState = collections.namedtuple('ProgressState', ['message', 'percent', 'sequence', 'metrics'])
+ProgressState.__new__.__defaults__ = (None,)
+
+
 class ProgressSequenceCounter:
-    """Utility class that supports atomically incrementing the sequence value."""
+    """Utility class that supports atomically incrementing the sequence value.
+    The values are generated by itertools.count whose next() is atomic, i.e. no lock is needed."""
     def __init__(self, initial=0):
-        self.lock = Lock()
+        self.sequence = itertools.count(initial + 1)
         self.value = initial
 
     def increment_and_get(self):
         """Atomically increments by one the current value and returns the new value."""
+        value = next(self.sequence)
+        # value is only informational, it may lag behind when values are generated concurrently
+        self.value = value
+        return value
+
+
+def parse_percent(percent_data):
+    """Parses the progress percent in percent_data and rounds it to the nearest integer.
+    Integer percents, the common case, are parsed with int() and other percents with float(), both directly from
+    the bytes, i.e. without decoding them first.
+
+    Parameters
+    ----------
+    percent_data: bytes
+        The percent matched in the progress message.
+
+    Returns
+    -------
+    the percent as an int, or None if the percent is not in [0, 100].
+    Raises ValueError if percent_data is not a number.
+    """
+    if percent_data.isdigit():
+        percent = int(percent_data)
+        return percent if percent <= 100 else None
+    percent_float = float(percent_data)
+    if percent_float < 0 or percent_float > 100:
+        return None
+    return round(percent_float)
+
+
+def parse_json_progress(line):
+    """Parses a json progress line, e.g. {"percent": 50, "message": "halfway", "metrics": {"rows": 1000}}.
+
+    Parameters
+    ----------
+    line: bytes
+        The line to parse.
+
+    Returns
+    -------
+    the dictionary from the line, or None if the line is not a json object with a percent.
+    """
+    data = line.strip()
+    if not data.startswith(b'{'):
+        return None
+    try:
+        progress = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(progress, dict) or JSON_PROGRESS_PERCENT_KEY not in progress:
+        return None
+    return progress
+
+
+def parse_regex_progress_report(progress_report):
+    """Extracts the progress fields from the result of matching the progress regex.
+
+    Returns
+    -------
+    the tuple (percent, message, metrics), or None if the percent is not in [0, 100].
+    """
+    if isinstance(progress_report, tuple) and len(progress_report) == 2:
+        percent_data, message_data = progress_report
+    elif isinstance(progress_report, tuple) and len(progress_report) == 1:
+        percent_data, message_data = progress_report[0], b''
+    else:
+        percent_data, message_data = progress_report, b''
+    percent = parse_percent(percent_data)
+    return None if percent is None else (percent, message_data, None)
+
+
+def parse_json_progress_report(progress_report):
+    """Extracts the progress fields from a dictionary returned by parse_json_progress.
+
+    Returns
+    -------
+    the tuple (percent, message, metrics), or None if the percent is not in [0, 100].
+    Raises ValueError if the percent is not a number.
+    """
+    percent = progress_report[JSON_PROGRESS_PERCENT_KEY]
+    if isinstance(percent, bool) or not isinstance(percent, (int, float)):
+        raise ValueError('Progress percent {} is not a number'.format(percent))
+    if percent < 0 or percent > 100:
+        return None
+    message = progress_report.get('message', '')
+    metrics = progress_report.get('metrics')
+    return (round(percent), message if isinstance(message, str) else str(message),
+            metrics if isinstance(metrics, dict) and metrics else None)
+
+
+def extract_required_literal(regex_string):
+    """Extracts a literal string that must be present in any input matched by regex_string.
+    The literal is the longest prefix of the regex, ignoring a leading '^', that consists of plain or escaped
+    characters; e.g. 'progress: ' is extracted from 'progress: ([0-9]*\\.?[0-9]+), (.*)'.
+    The extraction is conservative and an empty string is returned whenever the literal cannot be determined,
+    e.g. when the regex contains top-level alternation.
+
+    Parameters
+    ----------
+    regex_string: string
+        The regex to analyze.
+
+    Returns
+    -------
+    the required literal as a string, possibly empty.
+    """
+    if re.search(r'\(\?[aiLmsux]+\)', regex_string):
+        # global inline flags, e.g. (?i), change the meaning of the literal characters
+        return ''
+    depth = 0
+    index = 0
+    while index < len(regex_string):
+        char = regex_string[index]
+        if char == '\\':
+            index += 1
+        elif char == '[':
+            # skip the character class, a ']' immediately after '[' or '[^' is part of the class
+            index += 2 if regex_string.startswith('[^', index) else 1
+            index += 1 if regex_string.startswith(']', index) else 0
+            while index < len(regex_string) and regex_string[index] != ']':
+                index += 2 if regex_string[index] == '\\' else 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return ''
+        index += 1
+
+    literal = []
+    index = 1 if regex_string.startswith('^') else 0
+    while index < len(regex_string):
+        char = regex_string[index]
+        if char == '\\':
+            if index + 1 >= len(regex_string) or regex_string[index + 1].isalnum():
+                # character classes (e.g. \s), anchors (e.g. \b) and backreferences are not literals
+                break
+            char = regex_string[index + 1]
+            next_index = index + 2
+        elif char in '.^$*+?{}[]()|':
+            break
+        else:
+            next_index = index + 1
+        next_char = regex_string[next_index] if next_index < len(regex_string) else ''
+        if next_char in ['*', '?', '{']:
+            # the character is optional
+            break
+        literal.append(char)
+        if next_char == '+':
+            break
+        index = next_index
+    return ''.join(literal)
+
+
+def split_fragments(data, max_bytes_per_fragment, defer_incomplete_fragment):
+    """Splits data into fragments which end at a newline, after max_bytes_per_fragment bytes, or at the end of data.
+
+    Parameters
+    ----------
+    data: bytes
+        The data to split.
+    max_bytes_per_fragment: int
+        The max length of any fragment.
+    defer_incomplete_fragment: boolean
+        Whether a last fragment which is shorter than max_bytes_per_fragment and does not end with a newline
+        should be returned separately, as more data is expected to complete it.
+
+    Returns
+    -------
+    A tuple of the list of fragments and the deferred incomplete fragment (empty if there is none).
+    """
+    if not data:
+        return [], b''
+    fragments = io.BytesIO(data).readlines()
+    if max(map(len, fragments)) > max_bytes_per_fragment:
+        fragments = [fragment[i:i + max_bytes_per_fragment]
+                     for fragment in fragments
+                     for i in range(0, len(fragment), max_bytes_per_fragment)]
+    last_fragment = fragments[-1]
+    if defer_incomplete_fragment and len(last_fragment) < max_bytes_per_fragment and not last_fragment.endswith(b'\n'):
+        return fragments[:-1], fragments[-1]
+    return fragments, b''
+
+
+class FragmentReader(object):
+    """Reads large chunks from a file and splits them into fragments in memory.
+    The fragments are identical to the ones generated by repeated calls to readline(max_bytes_per_fragment):
+    each fragment ends at a newline, after max_bytes_per_fragment bytes, or at the end of the available data.
+    """
+
+    def __init__(self, file_obj, max_bytes_per_fragment, chunk_size=TAIL_CHUNK_SIZE_BYTES):
+        """
+        Parameters
+        ----------
+        file_obj: file object
+            The (preferably unbuffered) binary file to read from.
+        max_bytes_per_fragment: int
+            The max length of any fragment.
+        chunk_size: int
+            The number of bytes to request from the file in each read.
+        """
+        self.file_obj = file_obj
+        self.max_bytes_per_fragment = max_bytes_per_fragment
+        self.chunk_size = max(chunk_size, max_bytes_per_fragment)
+        self.remainder = b''
+
+    def read_fragments(self):
+        """Reads the next chunk of data available in the file and splits it into fragments.
+
+        Returns
+        -------
+        the list of fragments, an empty list if no new data is available.
+        """
+        chunk = self.file_obj.read(self.chunk_size)
+        if not chunk:
+            # no more data available, a partial line is returned as is (similar to readline)
+            fragments = [self.remainder] if self.remainder else []
+            self.remainder = b''
+            return fragments
+
+        # when the chunk is full, more data is probably available to complete the last fragment, defer it to the
+        # next read; the chunk size is at least max_bytes_per_fragment, hence at least one fragment remains
+        fragments, self.remainder = split_fragments(self.remainder + chunk, self.max_bytes_per_fragment,
+                                                    len(chunk) == self.chunk_size)
+        return fragments
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket which limits the rate of progress updates sent by all the updaters sharing it."""
+
+    def __init__(self, rate_per_sec, capacity):
+        """
+        rate_per_sec: float
+            The rate at which tokens are added to the bucket.
+        capacity: float
+            The max number of tokens in the bucket, i.e. the size of a burst of updates.
+        """
+        self.rate_per_sec = rate_per_sec
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.last_refill_time = time.monotonic()
+        self.lock = Lock()
+
+    def try_acquire(self):
+        """Takes a token from the bucket, returns False without waiting if the bucket is empty."""
         with self.lock:
-            self.value += 1
-            return self.value
+            current_time = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (current_time - self.last_refill_time) * self.rate_per_sec)
+            self.last_refill_time = current_time
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def time_until_available_ms(self):
+        """Returns the time in ms until a token can be taken from the bucket, without taking it."""
+        with self.lock:
+            elapsed_secs = time.monotonic() - self.last_refill_time
+            tokens = min(self.capacity, self.tokens + elapsed_secs * self.rate_per_sec)
+            return max(1 - tokens, 0) * 1000 / self.rate_per_sec
+
+
+__update_token_bucket__ = None
+__update_token_bucket_lock__ = Lock()
+
+
+def get_update_token_bucket(max_updates_per_sec):
+    """Returns the token bucket shared by all progress updaters in the executor, e.g. the tasks of a multi-task
+    executor, it is created with a capacity of one second of updates on the first call."""
+    global __update_token_bucket__
+    with __update_token_bucket_lock__:
+        if __update_token_bucket__ is None:
+            __update_token_bucket__ = TokenBucket(max_updates_per_sec, max_updates_per_sec)
+        return __update_token_bucket__
 
 
 class ProgressUpdater(object):
@@ -24,7 +324,8 @@ class ProgressUpdater(object):
     It throttles the rate at which progress updates are sent.
     """
 
-    def __init__(self, task_id, max_message_length, poll_interval_ms, send_progress_message_fn):
+    def __init__(self, task_id, max_message_length, poll_interval_ms, send_progress_message_fn,
+                 min_percent_delta=0, max_poll_interval_ms=None, token_bucket=None):
         """
         task_id: string
             The task id.
@@ -34,14 +335,30 @@ class ProgressUpdater(object):
             The interval after which to send a subsequent progress update.
         send_progress_message_fn: function(message)
             The helper function used to send the progress message.
+        min_percent_delta: int, optional
+            When positive, updates whose percent changed by less than min_percent_delta since the last update sent
+            are only sent after a backoff interval; the interval doubles, up to max_poll_interval_ms, while the
+            percent remains unchanged and is reset to poll_interval_ms once it changes.
+        max_poll_interval_ms: int, optional
+            The max backoff interval, defaults to poll_interval_ms.
+        token_bucket: TokenBucket, optional
+            When provided, updates which are not forced are only sent if a token can be taken from the bucket.
         """
         self.task_id = task_id
         self.max_message_length = max_message_length
         self.poll_interval_ms = poll_interval_ms
+        self.min_percent_delta = min_percent_delta
+        self.max_poll_interval_ms = max(max_poll_interval_ms or poll_interval_ms, poll_interval_ms)
+        self.backoff_interval_ms = poll_interval_ms
+        self.token_bucket = token_bucket
         self.last_reported_time = None
+        self.last_percent_sent = None
         self.last_progress_data_sent = None
         self.send_progress_message = send_progress_message_fn
         self.lock = Lock()
+        # per progress update events are counted and rate-limited instead of being logged individually
+        self.counters = clog.EventCounters()
+        self.rate_limited_logger = clog.RateLimitedLogger()
 
     def has_enough_time_elapsed_since_last_update(self):
         """Returns true if enough time (based on poll_interval_ms) has elapsed since
@@ -54,12 +371,70 @@ class ProgressUpdater(object):
             time_diff_ms = (current_time - self.last_reported_time) * 1000
             return time_diff_ms >= self.poll_interval_ms
 
+    def time_until_update_due_ms(self, percent):
+        """Returns the time in ms until progress with percent is due: enough time has elapsed since the last update
+        and either the percent changed by at least min_percent_delta or the backoff interval has elapsed.
+        """
+        if self.last_reported_time is None:
+            return 0
+        time_diff_ms = (time.time() - self.last_reported_time) * 1000
+        interval_ms = self.poll_interval_ms
+        if self.min_percent_delta > 0 and self.last_percent_sent is not None and \
+                abs(percent - self.last_percent_sent) < self.min_percent_delta:
+            interval_ms = max(interval_ms, self.backoff_interval_ms)
+        return max(interval_ms - time_diff_ms, 0)
+
+    def is_update_due(self, progress_data):
+        """Returns true if progress_data should be sent, see time_until_update_due_ms."""
+        return self.time_until_update_due_ms(progress_data.percent) <= 0
+
+    def is_progress_update_due(self, percent):
+        """Returns true if progress with percent would be sent now, i.e. it is due and, when a token bucket is used,
+        a token is available; coalesced progress is retained until then instead of being throttled.
+        """
+        return self.time_until_next_update_ms(percent) <= 0
+
+    def adapt_backoff_interval(self, progress_data):
+        """Doubles the backoff interval if the percent of the progress_data being sent has not changed enough,
+        otherwise resets it to poll_interval_ms."""
+        if self.min_percent_delta > 0:
+            if self.last_percent_sent is not None and \
+                    abs(progress_data.percent - self.last_percent_sent) < self.min_percent_delta:
+                self.backoff_interval_ms = min(self.backoff_interval_ms * 2, self.max_poll_interval_ms)
+            else:
+                self.backoff_interval_ms = self.poll_interval_ms
+        self.last_percent_sent = progress_data.percent
+
+    def time_until_next_update_ms(self, percent):
+        """Returns the time in ms until progress with percent would be sent, i.e. until it is due (including the
+        backoff interval) and a token is available in the token bucket."""
+        time_until_due_ms = self.time_until_update_due_ms(percent)
+        if self.token_bucket is not None:
+            time_until_due_ms = max(time_until_due_ms, self.token_bucket.time_until_available_ms())
+        return time_until_due_ms
+
+    def handle_send_failure(self, message):
+        """Invoked when a progress message, which has been reported as sent, could not be delivered.
+        The progress is no longer treated as sent and can hence be sent again, e.g. by a forced update.
+
+        Parameters
+        ----------
+        message: dictionary
+            The progress message which could not be delivered.
+        """
+        with self.lock:
+            last_progress_data = self.last_progress_data_sent
+            if last_progress_data and last_progress_data.sequence == message['progress-sequence']:
+                self.counters.increment('undelivered')
+                self.rate_limited_logger.info('undelivered', 'Progress message %s was not delivered', message)
+                self.last_progress_data_sent = None
+
     def is_increasing_sequence(self, progress_data):
         """Checks if the sequence number in progress_data is larger than the previously published progress.
 
         Parameters
         ----------
-        progress_data: dictionary
+        progress_data: ProgressState
             The progress data to send.
 
         Returns
@@ -67,8 +442,8 @@ class ProgressUpdater(object):
         True if the sequence number in progress_data is larger than the previously published progress, False otherwise
         """
         last_progress_data = self.last_progress_data_sent
-        last_progress_sequence = last_progress_data['progress-sequence'] if last_progress_data else -1
-        return progress_data['progress-sequence'] > last_progress_sequence
+        last_progress_sequence = last_progress_data.sequence if last_progress_data else -1
+        return progress_data.sequence > last_progress_sequence
 
     def send_progress_update(self, progress_data, force_send=False):
         """Sends a progress update if enough time has elapsed since the last progress update.
@@ -77,7 +452,7 @@ class ProgressUpdater(object):
         
         Parameters
         ----------
-        progress_data: dictionary
+        progress_data: ProgressState
             The progress data to send.
         force_send: boolean, optional
             Defaults to false.
@@ -89,35 +464,55 @@ class ProgressUpdater(object):
         with self.lock:
             # ensure we do not send outdated progress data due to parallel repeated calls to this method
             if progress_data is None or not self.is_increasing_sequence(progress_data):
-                logging.info('Skipping invalid/outdated progress data {}'.format(progress_data))
-            elif not force_send and not self.has_enough_time_elapsed_since_last_update():
-                logging.debug('Not sending progress data as enough time has not elapsed since last update')
+                self.counters.increment('outdated')
+                logging.debug('Skipping invalid/outdated progress data %s', progress_data)
+            elif not force_send and not self.is_update_due(progress_data):
+                self.counters.increment('throttled')
+            elif not force_send and self.token_bucket is not None and not self.token_bucket.try_acquire():
+                self.counters.increment('rate-limited')
             else:
-                logging.info('Sending progress message {}'.format(progress_data))
-                message_dict = dict(progress_data)
-                message_dict['task-id'] = self.task_id
+                self.rate_limited_logger.info('sending', 'Sending progress message %s', progress_data)
+                progress_str = progress_data.message
+                if isinstance(progress_str, bytes):
+                    try:
+                        progress_str = progress_str.decode('utf-8')
+                    except UnicodeDecodeError:
+                        self.counters.increment('undecodable')
+                        self.rate_limited_logger.info('undecodable', 'Unable to decode progress message in utf-8, '
+                                                                     'replacing the invalid bytes')
+                        progress_str = progress_str.decode('utf-8', errors='replace')
+                progress_str = progress_str.strip()
 
-                raw_progress_message = progress_data['progress-message']
-                try:
-                    progress_str = raw_progress_message.decode('ascii').strip()
-                except UnicodeDecodeError:
-                    logging.info('Unable to decode progress message in ascii, using empty string instead')
-                    progress_str = ''
-
-                if len(progress_str) <= self.max_message_length:
-                    message_dict['progress-message'] = progress_str
-                else:
+                # the message length is limited in utf-8 encoded bytes, trimming never splits a character
+                progress_bytes = progress_str.encode()
+                if len(progress_bytes) > self.max_message_length:
                     allowed_progress_message_length = max(self.max_message_length - 3, 0)
-                    new_progress_str = progress_str[:allowed_progress_message_length].strip() + '...'
-                    logging.info('Progress message trimmed to {}'.format(new_progress_str))
-                    message_dict['progress-message'] = new_progress_str
+                    progress_str = progress_bytes[:allowed_progress_message_length].decode(
+                        'utf-8', errors='ignore').strip() + '...'
+                    self.counters.increment('trimmed')
+                    logging.debug('Progress message trimmed to %s', progress_str)
+
+                # the message is only converted into its wire format, i.e. json, when it is sent
+                message_dict = {'progress-message': progress_str,
+                                'progress-percent': progress_data.percent,
+                                'progress-sequence': progress_data.sequence,
+                                'task-id': self.task_id}
+                if progress_data.metrics:
+                    message_dict['progress-metrics'] = progress_data.metrics
 
                 send_success = self.send_progress_message(message_dict)
                 if send_success:
+                    self.counters.increment('sent')
+                    self.adapt_backoff_interval(progress_data)
                     self.last_progress_data_sent = progress_data
                     self.last_reported_time = time.time()
                 else:
-                    logging.info('Unable to send progress message {}'.format(message_dict))
+                    self.counters.increment('unsent')
+                    self.rate_limited_logger.info('unsent', 'Unable to send progress message %s', message_dict)
+
+    def log_statistics(self):
+        """Logs the counts of progress updates sent, throttled, skipped, etc."""
+        logging.info('Progress updates: %s', self.counters)
 
 
 class ProgressWatcher(object):
@@ -126,7 +521,8 @@ class ProgressWatcher(object):
     """
 
     def __init__(self, output_name, location_tag, sequence_counter, max_bytes_read_per_line, progress_regex_string,
-                 stop_signal, task_completed_signal, progress_termination_signal):
+                 stop_signal, task_completed_signal, progress_termination_signal, tail_mode=ci.TAIL_MODE_POLL,
+                 is_progress_update_due=None, progress_format=PROGRESS_FORMAT_REGEX):
         """The ProgressWatcher constructor.
 
         Parameters
@@ -135,6 +531,14 @@ class ProgressWatcher(object):
             The progress regex to match against, it must return one or two capture groups.
             The first capture group represents the progress percentage.
             The second capture group, if present, represents the progress message.
+        tail_mode: string
+            Either ci.TAIL_MODE_INOTIFY or ci.TAIL_MODE_POLL, determines how tail waits for new content.
+        is_progress_update_due: function(percent), optional
+            When provided, progress is coalesced: matches only record the latest valid progress which is converted
+            into a progress state once is_progress_update_due(percent) returns true or when tailing completes.
+        progress_format: string
+            Either PROGRESS_FORMAT_REGEX or PROGRESS_FORMAT_JSON, the latter matches json progress lines
+            (see parse_json_progress) instead of using progress_regex_string.
         """
         self.target_file = output_name
         self.location_tag = location_tag
@@ -142,41 +546,117 @@ class ProgressWatcher(object):
         self.max_bytes_read_per_line = max_bytes_read_per_line
         self.progress_regex_string = progress_regex_string
         self.progress_regex_pattern = re.compile(progress_regex_string.encode())
+        self.progress_format = progress_format
+        if progress_format == PROGRESS_FORMAT_JSON:
+            self.progress_regex_literal = json.dumps(JSON_PROGRESS_PERCENT_KEY).encode()
+            self.parse_progress_report = parse_json_progress_report
+        else:
+            self.progress_regex_literal = extract_required_literal(progress_regex_string).encode()
+            self.parse_progress_report = parse_regex_progress_report
         self.progress = None
         self.stop_signal = stop_signal
         self.task_completed_signal = task_completed_signal
         self.progress_termination_signal = progress_termination_signal
+        self.tail_mode = tail_mode
+        self.is_progress_update_due = is_progress_update_due
+        self.pending_progress = None
+        self.notifier = None
+        self.fragment_count = 0
+        self.line_count = 0
+        self.match_count = 0
+        self.wakeup_count = 0
+        self.rate_limited_logger = clog.RateLimitedLogger()
+        self.truncation_count = 0
+        self.rotation_count = 0
+        # json progress and regexes anchored at the start of a line cannot match the later fragments of a line
+        self.skips_line_continuations = progress_format == PROGRESS_FORMAT_JSON or progress_regex_string.startswith('^')
+        self.skipped_fragment_count = 0
+        # the state of the line whose fragments are being matched, see __progress_window and __carry_over
+        self.linesep_bytes = os.linesep.encode()
+        self.line_continues = False
+        self.line_carry = b''
 
     def current_progress(self):
-        """Returns the current progress dictionary."""
+        """Returns the current ProgressState."""
         return self.progress
 
-    def tail(self, sleep_time_ms):
+    def reset_line_state(self):
+        """Forgets the line whose fragments are being matched, e.g. when the target file is read from the start."""
+        self.line_continues = False
+        self.line_carry = b''
+
+    def wake_up(self):
+        """Interrupts tail if it is waiting for new content, e.g. after one of the signals has been set."""
+        notifier = self.notifier
+        if notifier is not None:
+            notifier.wake()
+
+    def __file_state(self, target_file_obj):
+        """Compares the open file being tailed with the file currently present at the target path.
+
+        Returns
+        -------
+        FILE_STATE_MISSING if no file is present at the target path,
+        FILE_STATE_ROTATED if the target path refers to a different file than the one being read,
+        FILE_STATE_TRUNCATED if the file being read is smaller than the current read position,
+        else FILE_STATE_UNCHANGED.
+        """
+        try:
+            path_stat = os.stat(self.target_file)
+        except FileNotFoundError:
+            return FILE_STATE_MISSING
+        file_stat = os.fstat(target_file_obj.fileno())
+        if (path_stat.st_dev, path_stat.st_ino) != (file_stat.st_dev, file_stat.st_ino):
+            return FILE_STATE_ROTATED
+        if file_stat.st_size < target_file_obj.tell():
+            return FILE_STATE_TRUNCATED
+        return FILE_STATE_UNCHANGED
+
+    def tail(self, sleep_time_ms, shared_notifier=None):
         """This method incrementally generates lines from a file by waiting for new content from a file.
         It behaves like the 'tail -f' shell command.
+        In inotify tail mode, it sleeps until the file is created or modified instead of polling.
+        Similar to 'tail -F', the file is read from the start again if it is truncated and the new
+        file is opened if the target path is rotated (i.e. refers to a different file).
         
         Parameters
         ----------
         sleep_time_ms: int
             The unit of time in ms to repetitively sleep when the file has not been created or no new
-            content is available in the file being tailed.
+            content is available in the file being tailed and inotify is not being used.
+        shared_notifier: PollingNotifier or InotifyNotifier, optional
+            When provided, the target file is registered with the notifier and the caller is responsible
+            for waiting on it: None is generated whenever no new content is currently available.
         
         Returns
         -------
         an incrementally generated list of lines in the file being tailed.
         """
-        try:
-            sleep_param = sleep_time_ms / 1000
+        notifier = shared_notifier
+
+        def await_change():
+            notifier.await_change()
+            self.wakeup_count = notifier.wakeup_count
 
+        try:
             if os.path.exists(self.target_file) and not os.path.isfile(self.target_file):
                 logging.info('Skipping progress monitoring on %s as it is not a file', self.target_file)
                 return
 
+            if notifier is None:
+                notifier = ci.create_notifier(self.tail_mode, sleep_time_ms)
+                self.notifier = notifier
+            if not notifier.watch(self.target_file):
+                logging.info('Unable to watch %s, polling for changes [tag=%s]', self.target_file, self.location_tag)
+
             if not os.path.isfile(self.target_file):
                 logging.debug('Awaiting creation of file %s [tag=%s]', self.target_file, self.location_tag)
 
             while not os.path.isfile(self.target_file) and not self.task_completed_signal.isSet():
-                time.sleep(sleep_param)
+                if shared_notifier is None:
+                    await_change()
+                else:
+                    yield None
 
             if not os.path.isfile(self.target_file):
                 logging.info('Progress output file has not been created [tag=%s]', self.location_tag)
@@ -188,38 +668,89 @@ class ProgressWatcher(object):
 
             logging.info('File has been created, reading contents [tag=%s]', self.location_tag)
             linesep_bytes = os.linesep.encode()
-            fragment_index = 0
-            line_index = 0
 
             def log_tail_summary():
-                log_message = '%s fragments and %s lines read while processing progress messages [tag=%s]'
-                logging.info(log_message, fragment_index, line_index, self.location_tag)
+                log_message = '%s fragments and %s lines read with %s wakeups, %s truncations and %s rotations ' \
+                              'while processing progress messages [tag=%s]'
+                logging.info(log_message, self.fragment_count, self.line_count, self.wakeup_count,
+                             self.truncation_count, self.rotation_count, self.location_tag)
 
-            with open(self.target_file, 'rb') as target_file_obj:
+            # bound is_set methods are used as the termination signal is checked for every fragment
+            is_terminated = self.progress_termination_signal.is_set
+            target_file_obj = open(self.target_file, 'rb', buffering=0)
+            try:
+                fragment_reader = FragmentReader(target_file_obj, self.max_bytes_read_per_line)
+                awaiting_recreation = False
                 while not self.stop_signal.isSet():
-                    if self.progress_termination_signal.isSet():
+                    if is_terminated():
                         logging.info('tail short-circuiting due to progress termination [tag=%s]', self.location_tag)
                         log_tail_summary()
                         break
-                    line = target_file_obj.readline(self.max_bytes_read_per_line)
-                    if not line:
+                    fragments = fragment_reader.read_fragments()
+                    if not fragments:
+                        # all content has been read, check whether the file has been truncated or rotated
+                        file_state = self.__file_state(target_file_obj)
+                        if file_state == FILE_STATE_TRUNCATED:
+                            logging.info('File has been truncated, reading from the start [tag=%s]', self.location_tag)
+                            self.truncation_count += 1
+                            target_file_obj.seek(0)
+                            fragment_reader = FragmentReader(target_file_obj, self.max_bytes_read_per_line)
+                            self.reset_line_state()
+                            continue
+                        if file_state == FILE_STATE_ROTATED:
+                            # watch before opening to avoid missing modifications of the new file
+                            notifier.watch(self.target_file)
+                            try:
+                                rotated_file_obj = open(self.target_file, 'rb', buffering=0)
+                            except FileNotFoundError:
+                                # the new file has already been removed, treat it as missing
+                                file_state = FILE_STATE_MISSING
+                            else:
+                                logging.info('File has been rotated, reading the new file [tag=%s]', self.location_tag)
+                                self.rotation_count += 1
+                                awaiting_recreation = False
+                                target_file_obj.close()
+                                target_file_obj = rotated_file_obj
+                                fragment_reader = FragmentReader(target_file_obj, self.max_bytes_read_per_line)
+                                self.reset_line_state()
+                                continue
+                        if file_state == FILE_STATE_MISSING and not awaiting_recreation:
+                            # the file has been moved or deleted, watch for it being created again
+                            logging.info('File has been removed, awaiting its re-creation [tag=%s]', self.location_tag)
+                            awaiting_recreation = True
+                            notifier.watch(self.target_file)
                         # exit if program has completed and there are no more lines to read
                         if self.task_completed_signal.isSet():
                             log_tail_summary()
                             break
-                        # no new line available, sleep before trying again
-                        time.sleep(sleep_param)
+                        # no new line available, wait for changes before trying again
+                        if shared_notifier is None:
+                            await_change()
+                        else:
+                            yield None
                         continue
 
-                    fragment_index += 1
-                    if line.endswith(linesep_bytes):
-                        line_index += 1
-                    yield line
-                if self.stop_signal.isSet() and not self.task_completed_signal.isSet():
-                    logging.info('Task requested to be killed, may not have processed all progress messages')
+                    for fragment in fragments:
+                        if is_terminated():
+                            break
+                        self.fragment_count += 1
+                        if fragment.endswith(linesep_bytes):
+                            self.line_count += 1
+                        yield fragment
+                    if shared_notifier is not None:
+                        # allow the caller to process the other locations sharing the notifier
+                        yield None
+            finally:
+                target_file_obj.close()
+            if self.stop_signal.isSet() and not self.task_completed_signal.isSet():
+                logging.info('Task requested to be killed, may not have processed all progress messages')
         except Exception as exception:
             logging.exception('Error while tailing %s [tag=%s]', self.target_file, self.location_tag)
             raise exception
+        finally:
+            if shared_notifier is None and notifier is not None:
+                self.notifier = None
+                notifier.close()
 
     def match_progress_update(self, input_data):
         """Returns the progress tuple when the input string matches the provided regex.
@@ -234,129 +765,304 @@ class ProgressWatcher(object):
         the tuple (percent, message) if the string matches the provided regex,
                  else return None.
         """
-        matches = self.progress_regex_pattern.findall(input_data)
-        return matches[0] if len(matches) >= 1 else None
-
-    def __update_progress(self, progress_report):
-        """Updates the progress field with the data from progress_report if it is valid."""
-        if isinstance(progress_report, tuple) and len(progress_report) == 2:
-            percent_data, message_data = progress_report
-        elif isinstance(progress_report, tuple) and len(progress_report) == 1:
-            percent_data, message_data = progress_report[0], b''
+        # cheap check to skip the regex for the vast majority of lines which are not progress messages
+        if input_data.find(self.progress_regex_literal) < 0:
+            return None
+        if self.progress_format == PROGRESS_FORMAT_JSON:
+            return parse_json_progress(input_data)
+        match = self.progress_regex_pattern.search(input_data)
+        if match is None:
+            return None
+        # return the same values as the first result of findall()
+        groups = match.groups(default=b'')
+        if len(groups) == 0:
+            return match.group(0)
+        elif len(groups) == 1:
+            return groups[0]
+        else:
+            return groups
+
+    def __progress_window(self, fragment):
+        """Returns the data in which progress messages are matched for the fragment, None if it can be skipped.
+        The later fragments of a line longer than max_bytes_read_per_line are prefixed with the data carried over
+        from the previous fragment of the line, hence a progress message split across fragments is not missed.
+        """
+        if not self.line_continues:
+            return fragment
+        if self.skips_line_continuations:
+            self.skipped_fragment_count += 1
+            return None
+        return self.line_carry + fragment if self.line_carry else fragment
+
+    def __carry_over(self, window, fragment, progress_report):
+        """Records the data of window to carry over to the next fragment of the line.
+        The carried over data is at most max_bytes_read_per_line bytes long and never contains a matched progress
+        message, hence memory stays bounded on arbitrarily long lines and no progress message is matched twice.
+        """
+        self.line_continues = not fragment.endswith(self.linesep_bytes)
+        literal = self.progress_regex_literal
+        if not self.line_continues or window is None or self.skips_line_continuations or not literal:
+            self.line_carry = b''
+            return
+        literal_index = window.rfind(literal) if progress_report is None else -1
+        if 0 <= literal_index and len(window) - literal_index <= self.max_bytes_read_per_line:
+            # the progress message may be incomplete, e.g. its percent is split across fragments
+            self.line_carry = window[literal_index:]
         else:
-            percent_data, message_data = progress_report, b''
+            # the literal of a progress message may start within the last bytes of the window
+            self.line_carry = window[max(0, len(window) - len(literal) + 1):]
 
-        percent_float = float(percent_data.decode())
-        if percent_float < 0 or percent_float > 100:
-            logging.info('Skipping "%s" as the percent is not in [0, 100]', progress_report)
-            return False
+    def __parse_progress_report(self, progress_report):
+        """Returns the (percent, message, metrics) tuple from progress_report, None if the percent is not valid."""
+        progress_fields = self.parse_progress_report(progress_report)
+        if progress_fields is None:
+            self.rate_limited_logger.info('percent-range', 'Skipping "%s" as the percent is not in [0, 100]',
+                                          progress_report)
+        return progress_fields
 
-        percent_int = int(round(percent_float))
+    def __update_progress(self, progress_fields):
+        """Updates the progress field with the (percent, message, metrics) tuple and returns it."""
+        percent_int, message_data, metrics = progress_fields
         logging.debug('Updating progress to %s percent [tag=%s]', percent_int, self.location_tag)
 
-        self.progress = {'progress-message': message_data,
-                         'progress-percent': percent_int,
-                         'progress-sequence': self.sequence_counter.increment_and_get()}
-        return True
+        self.progress = ProgressState(message_data, percent_int, self.sequence_counter.increment_and_get(), metrics)
+        return self.progress
 
-    def retrieve_progress_states(self):
+    def retrieve_progress_states(self, shared_notifier=None, fragments=None):
         """Generates the progress states by tailing the target_file.
         It tails a target file (using the tail() method) and uses the provided 
         regex to find a match for a progress message. The regex is expected to 
         generate two components in the match: the progress percent as an int and 
         a progress message string. When such a message is found, this method 
-        yields the current progress as a dictionary.
+        yields the current progress as a ProgressState.
+        Lines longer than max_bytes_read_per_line are matched fragment by fragment with a bounded overlap
+        between the fragments, the later fragments of such lines are skipped when no match is possible.
 
         Note: This function must rethrow any OSError exceptions that it encounters.
 
+        Parameters
+        ----------
+        shared_notifier: PollingNotifier or InotifyNotifier, optional
+            Passed on to tail(), None is generated whenever no new content is currently available.
+        fragments: iterable of bytes, optional
+            When provided, progress messages are matched in these fragments instead of tailing the target file.
+            A None entry signals that no new content is currently available and is generated as is.
+
         Returns
         -------
         An incrementally generated list of progress states.
         """
-        last_unprocessed_report = None
-        if self.progress_regex_string:
-            sleep_time_ms = 50
-            for line in self.tail(sleep_time_ms):
+        last_unprocessed_fields = None
+        if self.progress_regex_string or self.progress_format == PROGRESS_FORMAT_JSON:
+            if fragments is not None:
+                lines = fragments
+            elif shared_notifier is None:
+                lines = self.tail(TAIL_SLEEP_TIME_MS)
+            else:
+                lines = self.tail(TAIL_SLEEP_TIME_MS, shared_notifier=shared_notifier)
+            for line in lines:
+                if line is None:
+                    if self.is_pending_progress_due():
+                        yield self.__materialize_pending_progress()
+                    yield None
+                    continue
                 try:
-                    progress_report = self.match_progress_update(line)
+                    window = self.__progress_window(line)
+                    progress_report = None if window is None else self.match_progress_update(window)
+                    self.__carry_over(window, line, progress_report)
                     if progress_report is not None:
+                        self.match_count += 1
+                        progress_fields = self.__parse_progress_report(progress_report)
+                        if progress_fields is None:
+                            continue
                         if self.task_completed_signal.isSet():
-                            last_unprocessed_report = progress_report
-                        elif self.__update_progress(progress_report):
-                            yield self.progress
+                            last_unprocessed_fields = progress_fields
+                        elif self.is_progress_update_due is not None:
+                            # coalescing: only the latest valid progress is retained until an update is due
+                            self.pending_progress = progress_fields
+                            if self.is_pending_progress_due():
+                                yield self.__materialize_pending_progress()
+                        else:
+                            yield self.__update_progress(progress_fields)
                 except Exception as exception:
                     if cu.is_out_of_memory_error(exception):
                         raise exception
                     else:
                         logging.exception('Skipping "%s" as a progress entry', line)
-        if last_unprocessed_report is not None:
-            if self.__update_progress(last_unprocessed_report):
-                yield self.progress
+        if last_unprocessed_fields is not None:
+            self.pending_progress = None
+            yield self.__update_progress(last_unprocessed_fields)
+        elif self.pending_progress is not None:
+            yield self.__materialize_pending_progress()
+
+    def pending_percent(self):
+        """Returns the percent of the pending progress recorded while coalescing, None if there is none."""
+        progress_fields = self.pending_progress
+        return None if progress_fields is None else progress_fields[0]
 
+    def is_pending_progress_due(self):
+        """Returns true if there is pending progress and an update with its percent is due."""
+        percent = self.pending_percent()
+        return percent is not None and self.is_progress_update_due(percent)
 
-class ProgressTracker(object):
-    """Helper class to track progress messages from the specified location."""
+    def __materialize_pending_progress(self):
+        """Returns the progress state created from the pending progress recorded while coalescing."""
+        progress_fields = self.pending_progress
+        self.pending_progress = None
+        return self.__update_progress(progress_fields)
+
+
+class MultiplexedProgressTracker(object):
+    """Helper class to track progress messages from multiple locations using a single thread.
+    The locations are tailed in a round-robin manner and the thread waits on a notifier shared
+    across all locations whenever none of them have new content available.
+    """
 
     def __init__(self, config, stop_signal, task_completed_signal, counter, progress_updater,
-                 progress_termination_signal, location, location_tag, os_error_handler):
-        """Launches the threads that track progress and send progress updates to the driver.
+                 progress_termination_signal, locations, os_error_handler):
+        """Creates the watchers for all locations, the tracking thread is launched by start().
 
         Parameters
         ----------
         config: cook.config.ExecutorConfig
             The current executor config.
-        stop_signal: threading.Event
+        stop_signal: cook.util.NotifyingEvent
             Event that determines if an interrupt was sent
         task_completed_signal: threading.Event
             Event that tracks task execution completion
-        progress_updater: ProgressUpdater
-            The progress updater used to send the progress messages
         counter: ProgressSequenceCounter
             The sequence counter
-        location: string
-            The target location to read for progress messages
-        location_tag: string
-            A tag to identify the target location.
+        progress_updater: ProgressUpdater
+            The progress updater used to send the progress messages
+        progress_termination_signal: threading.Event
+            Event that determines if progress tracking should be terminated
+        locations: list of (string, string) tuples
+            The target locations to read for progress messages along with the tags that identify them.
         os_error_handler: fn(os_error)
             OSError exception handler for out of memory situations."""
-        self.location_tag = location_tag
+        self.notifier = None
         self.os_error_handler = os_error_handler
         self.progress_complete_event = Event()
-        self.watcher = ProgressWatcher(location, location_tag, counter, config.max_bytes_read_per_line,
-                                       config.progress_regex_string, stop_signal, task_completed_signal,
-                                       progress_termination_signal)
+        self.tail_mode = config.progress_tail_mode
         self.updater = progress_updater
+        is_progress_update_due = progress_updater.is_progress_update_due \
+            if config.progress_coalesce else None
+        self.watchers = [ProgressWatcher(location, location_tag, counter, config.max_bytes_read_per_line,
+                                         config.progress_regex_string, stop_signal, task_completed_signal,
+                                         progress_termination_signal, tail_mode=config.progress_tail_mode,
+                                         is_progress_update_due=is_progress_update_due,
+                                         progress_format=config.progress_format)
+                         for location, location_tag in locations]
+
+    def location_tags(self):
+        """Returns the tags of all tracked locations."""
+        return [watcher.location_tag for watcher in self.watchers]
 
     def start(self):
-        """Launches a thread that starts monitoring the progress location for progress messages."""
-        logging.info('Starting progress monitoring from [tag=%s]', self.location_tag)
+        """Launches a thread that starts monitoring all the progress locations for progress messages."""
+        logging.info('Starting progress monitoring from %s', self.location_tags())
         tracker_thread = Thread(target=self.track_progress, args=())
         tracker_thread.daemon = True
         tracker_thread.start()
 
+    def wake_up(self):
+        """Wakes up the tracker thread so that it can observe changes to the stop, completion or termination signals."""
+        notifier = self.notifier
+        if notifier is not None:
+            notifier.wake()
+
     def wait(self, timeout=None):
         """Waits for the progress tracker thread to run to completion."""
-        self.progress_complete_event.wait(timeout=timeout)
+        with ctr.start_span('progress-tracker-wait', locations=self.location_tags()):
+            self.progress_complete_event.wait(timeout=timeout)
         if self.progress_complete_event.isSet():
-            logging.info('Progress monitoring complete [tag=%s]', self.location_tag)
+            logging.info('Progress monitoring complete %s', self.location_tags())
         else:
-            logging.info('Progress monitoring did not complete [tag=%s]', self.location_tag)
+            logging.info('Progress monitoring did not complete %s', self.location_tags())
+
+    def __track_watcher_progress(self, watcher, progress_states):
+        """Sends the progress updates available from watcher without waiting for new content.
+
+        Returns
+        -------
+        False when the watcher has completed and no longer needs to be tracked, else True.
+        """
+        try:
+            for current_progress in progress_states:
+                if current_progress is None:
+                    return True
+                self.updater.send_progress_update(current_progress)
+        except Exception as exception:
+            if cu.is_out_of_memory_error(exception):
+                self.os_error_handler(exception)
+            else:
+                logging.exception('Exception while tracking progress [tag=%s]', watcher.location_tag)
+        logging.info('Progress monitoring complete [tag=%s]', watcher.location_tag)
+        return False
+
+    def create_progress_states(self, notifier):
+        """Creates the progress state generators of all locations, the locations are registered with notifier.
+
+        Returns
+        -------
+        A list of (watcher, progress_states) tuples, one for each location.
+        """
+        return [(watcher, watcher.retrieve_progress_states(shared_notifier=notifier)) for watcher in self.watchers]
+
+    def track_available_progress(self, active_watchers):
+        """Sends the progress updates currently available from all active watchers without waiting for new content.
+
+        Parameters
+        ----------
+        active_watchers: list of (ProgressWatcher, generator) tuples
+            The watchers that have not completed along with their progress state generators.
+
+        Returns
+        -------
+        A tuple of the watchers that have not completed and whether the caller should wait for new content.
+        """
+        fragment_count = sum(watcher.fragment_count for watcher, _ in active_watchers)
+        remaining_watchers = [(watcher, progress_states) for watcher, progress_states in active_watchers
+                              if self.__track_watcher_progress(watcher, progress_states)]
+        no_new_content = fragment_count == sum(watcher.fragment_count for watcher, _ in remaining_watchers)
+        should_wait = remaining_watchers and no_new_content and len(active_watchers) == len(remaining_watchers)
+        return remaining_watchers, bool(should_wait)
+
+    def change_timeout_ms(self, active_watchers):
+        """Returns the max time in ms to wait for new content, None if there is no coalesced progress to send."""
+        pending_percents = [watcher.pending_percent() for watcher, _ in active_watchers
+                            if watcher.pending_progress is not None]
+        if pending_percents:
+            # wake up in time to send the coalesced progress, including any backoff or wait for a token
+            return min(self.updater.time_until_next_update_ms(percent) for percent in pending_percents)
+        return None
 
     def track_progress(self):
-        """Retrieves and sends progress updates using send_progress_update_fn.
+        """Retrieves and sends progress updates from all locations until each of them completes.
         It sets the progress_complete_event before returning."""
+        notifier = None
         try:
-            for current_progress in self.watcher.retrieve_progress_states():
-                self.updater.send_progress_update(current_progress)
+            notifier = ci.create_notifier(self.tail_mode, TAIL_SLEEP_TIME_MS)
+            self.notifier = notifier
+            active_watchers = self.create_progress_states(notifier)
+            while active_watchers:
+                active_watchers, should_wait = self.track_available_progress(active_watchers)
+                if should_wait:
+                    notifier.await_change(timeout_ms=self.change_timeout_ms(active_watchers))
+                    for watcher, _ in active_watchers:
+                        watcher.wakeup_count = notifier.wakeup_count
         except Exception as exception:
             if cu.is_out_of_memory_error(exception):
                 self.os_error_handler(exception)
             else:
-                logging.exception('Exception while tracking progress [tag=%s]', self.location_tag)
+                logging.exception('Exception while tracking progress %s', self.location_tags())
         finally:
+            self.notifier = None
+            if notifier is not None:
+                notifier.close()
             self.progress_complete_event.set()
 
     def force_send_progress_update(self):
-        """Retrieves the latest progress message and attempts to force send it to the scheduler."""
-        latest_progress = self.watcher.current_progress()
-        self.updater.send_progress_update(latest_progress, force_send=True)
+        """Retrieves the latest progress message from each location and attempts to force send it to the scheduler."""
+        for watcher in self.watchers:
+            self.updater.send_progress_update(watcher.current_progress(), force_send=True)
@@ -0,0 +1,231 @@
+"""This module samples the resource usage of the task while it runs.
+Samples are read either from the task's process tree (via psutil) or from the task's cgroup v2 counters,
+the most recent samples are kept in a ring buffer and summaries are reported to the scheduler.
+"""
+
+import collections
+import logging
+import os
+import time
+from threading import Lock
+
+import cook.subprocess as cs
+
+SAMPLE_SOURCE_CGROUP = 'cgroup'
+SAMPLE_SOURCE_PROCESS_TREE = 'process-tree'
+
+BYTES_PER_MB = 1024 * 1024
+
+ResourceSample = collections.namedtuple('ResourceSample', ['timestamp', 'cpu_secs', 'rss_bytes', 'read_bytes',
+                                                           'write_bytes', 'num_processes'])
+
+
+def read_process_tree_sample(root_process_id):
+    """Sums the cpu time, resident memory and I/O counters of the processes in the tree rooted at root_process_id.
+    Counters of processes that have exited are not included, i.e. the cumulative counters may decrease.
+
+    Returns
+    -------
+    A ResourceSample, or None if the root process is not running.
+    """
+    # imported lazily, psutil is not needed when the cgroup counters are sampled
+    import psutil
+    cpu_secs = 0.0
+    rss_bytes = read_bytes = write_bytes = num_processes = 0
+    for process_id in cs.find_process_tree_ids(root_process_id):
+        try:
+            process = psutil.Process(process_id)
+            with process.oneshot():
+                cpu_times = process.cpu_times()
+                cpu_secs += cpu_times.user + cpu_times.system
+                rss_bytes += process.memory_info().rss
+                if hasattr(process, 'io_counters'):
+                    io_counters = process.io_counters()
+                    read_bytes += io_counters.read_bytes
+                    write_bytes += io_counters.write_bytes
+            num_processes += 1
+        except (psutil.AccessDenied, psutil.NoSuchProcess, psutil.ZombieProcess):
+            continue
+    if num_processes == 0:
+        return None
+    return ResourceSample(time.time(), cpu_secs, rss_bytes, read_bytes, write_bytes, num_processes)
+
+
+def find_cgroup_directory(process_id):
+    """Returns the cgroup v2 directory of the process if its cpu and memory counters can be read, else None."""
+    cgroup_path = cs.read_cgroup_path(process_id)
+    if cgroup_path is None:
+        return None
+    cgroup_directory = os.path.join(cs.CGROUP_V2_DIRECTORY, cgroup_path.lstrip('/'))
+    if all(os.access(os.path.join(cgroup_directory, name), os.R_OK) for name in ['cpu.stat', 'memory.current']):
+        return cgroup_directory
+    return None
+
+
+def read_cgroup_sample(cgroup_directory):
+    """Reads the cpu, memory and I/O counters of the cgroup v2 in cgroup_directory.
+
+    Returns
+    -------
+    A ResourceSample, or None if the counters could not be read.
+    """
+    try:
+        cpu_usecs = 0
+        with open(os.path.join(cgroup_directory, 'cpu.stat')) as cpu_stat_file:
+            for line in cpu_stat_file:
+                if line.startswith('usage_usec '):
+                    cpu_usecs = int(line.split()[1])
+        with open(os.path.join(cgroup_directory, 'memory.current')) as memory_file:
+            rss_bytes = int(memory_file.read())
+        read_bytes = write_bytes = 0
+        io_stat_file_name = os.path.join(cgroup_directory, 'io.stat')
+        if os.path.exists(io_stat_file_name):
+            with open(io_stat_file_name) as io_stat_file:
+                for line in io_stat_file:
+                    for field in line.split()[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'rbytes':
+                            read_bytes += int(value)
+                        elif key == 'wbytes':
+                            write_bytes += int(value)
+        with open(os.path.join(cgroup_directory, 'cgroup.procs')) as procs_file:
+            num_processes = sum(1 for _ in procs_file)
+        return ResourceSample(time.time(), cpu_usecs / 1000000.0, rss_bytes, read_bytes, write_bytes, num_processes)
+    except Exception:
+        logging.exception('Error in reading resource usage of cgroup {}'.format(cgroup_directory))
+        return None
+
+
+class ResourceSampler(object):
+    """Periodically samples the resource usage of the task and reports summaries using send_message_fn.
+    The most recent samples are kept in a ring buffer, aggregates over the whole run (e.g. the max memory)
+    are maintained separately so that they are not lost when old samples are evicted.
+    """
+
+    def __init__(self, task_id, process_id, config, send_message_fn):
+        """
+        Parameters
+        ----------
+        task_id: string
+            The task id.
+        process_id: int
+            The id of the root process of the task.
+        config: cook.config.ExecutorConfig
+            The current executor config.
+        send_message_fn: function(message)
+            The helper function used to send the resource usage summaries.
+        """
+        self.task_id = task_id
+        self.process_id = process_id
+        self.sample_interval_secs = config.resource_sample_interval_secs
+        self.report_interval_secs = config.resource_report_interval_secs
+        self.send_message = send_message_fn
+        self.samples = collections.deque(maxlen=max(config.resource_sample_buffer_size, 2))
+        self.lock = Lock()
+        self.stopped = False
+        self.last_report_time = None
+        self.sampling_task = None
+
+        self.cgroup_directory = None
+        if config.resource_sample_source == SAMPLE_SOURCE_CGROUP:
+            self.cgroup_directory = find_cgroup_directory(process_id)
+            if self.cgroup_directory is None:
+                logging.info('Unable to read cgroup counters, sampling the process tree instead')
+        self.source = SAMPLE_SOURCE_CGROUP if self.cgroup_directory else SAMPLE_SOURCE_PROCESS_TREE
+
+        self.first_sample = None
+        self.num_samples = 0
+        self.max_cpus = 0.0
+        self.max_rss_bytes = 0
+        self.max_processes = 0
+
+    def read_sample(self):
+        """Reads the current resource usage from the configured source."""
+        if self.cgroup_directory:
+            return read_cgroup_sample(self.cgroup_directory)
+        else:
+            return read_process_tree_sample(self.process_id)
+
+    def sample(self):
+        """Records the current resource usage, returns the sample or None if it could not be read."""
+        resource_sample = self.read_sample()
+        if resource_sample is not None:
+            with self.lock:
+                if self.samples:
+                    last_sample = self.samples[-1]
+                    elapsed_secs = resource_sample.timestamp - last_sample.timestamp
+                    if elapsed_secs > 0:
+                        cpus = max(resource_sample.cpu_secs - last_sample.cpu_secs, 0) / elapsed_secs
+                        self.max_cpus = max(self.max_cpus, cpus)
+                else:
+                    self.first_sample = resource_sample
+                self.samples.append(resource_sample)
+                self.num_samples += 1
+                self.max_rss_bytes = max(self.max_rss_bytes, resource_sample.rss_bytes)
+                self.max_processes = max(self.max_processes, resource_sample.num_processes)
+        return resource_sample
+
+    def summarize(self):
+        """Summarizes the samples recorded so far.
+
+        Returns
+        -------
+        A dictionary with the resource usage summary, or None if no samples have been recorded.
+        """
+        with self.lock:
+            if not self.samples:
+                return None
+            first_sample = self.first_sample
+            last_sample = self.samples[-1]
+            duration_secs = last_sample.timestamp - first_sample.timestamp
+            recent_sample = self.samples[0]
+            recent_duration_secs = last_sample.timestamp - recent_sample.timestamp
+            recent_cpus = max(last_sample.cpu_secs - recent_sample.cpu_secs, 0) / recent_duration_secs \
+                if recent_duration_secs > 0 else 0.0
+            # cgroup counters include usage prior to the task launch, hence usage is computed since the first sample
+            cpu_secs = max(last_sample.cpu_secs - first_sample.cpu_secs, 0)
+            read_bytes = max(last_sample.read_bytes - first_sample.read_bytes, 0)
+            write_bytes = max(last_sample.write_bytes - first_sample.write_bytes, 0)
+            return {'cpu-secs': round(cpu_secs, 3),
+                    'cpus-avg': round(cpu_secs / duration_secs, 3) if duration_secs > 0 else 0.0,
+                    'cpus-max': round(self.max_cpus, 3),
+                    'cpus-recent': round(recent_cpus, 3),
+                    'duration-secs': round(duration_secs, 3),
+                    'io-read-mb': round(read_bytes / BYTES_PER_MB, 3),
+                    'io-write-mb': round(write_bytes / BYTES_PER_MB, 3),
+                    'mem-mb': round(last_sample.rss_bytes / BYTES_PER_MB, 3),
+                    'mem-mb-max': round(self.max_rss_bytes / BYTES_PER_MB, 3),
+                    'processes-max': self.max_processes,
+                    'samples': self.num_samples,
+                    'source': self.source}
+
+    def send_summary(self):
+        """Sends the current resource usage summary, if any, to the scheduler."""
+        summary = self.summarize()
+        if summary is not None:
+            logging.info('Resource usage of task {}: {}'.format(self.task_id, summary))
+            self.send_message({'resource-usage': summary, 'task-id': self.task_id, 'type': 'resource-usage'})
+
+    def __sample_and_report(self):
+        """Samples the resource usage and sends a summary every report_interval_secs."""
+        self.sample()
+        if self.report_interval_secs > 0 and time.time() - self.last_report_time >= self.report_interval_secs:
+            self.last_report_time = time.time()
+            self.send_summary()
+
+    def start(self, timer_service):
+        """Records an initial sample and schedules sampling every sample_interval_secs on timer_service."""
+        self.sample()
+        self.last_report_time = time.time()
+        self.sampling_task = timer_service.schedule_periodic(self.sample_interval_secs, self.__sample_and_report,
+                                                             'resource-sampling')
+
+    def stop(self):
+        """Stops sampling and sends the final resource usage summary, subsequent calls have no effect."""
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        if self.sampling_task is not None:
+            self.sampling_task.cancel()
+        self.send_summary()
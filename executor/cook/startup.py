@@ -0,0 +1,109 @@
+"""This module profiles the startup of the executor, it is enabled with the --profile-startup argument.
+The profile reports the time spent importing modules and the time at which each startup phase, up to the task
+being reported as running, was reached. The module only depends on the standard library so that it can be
+enabled before the rest of the executor is imported.
+"""
+
+import builtins
+import logging
+import sys
+import time
+from threading import Lock
+
+PROFILE_STARTUP_ARGUMENT = '--profile-startup'
+
+# The number of slowest imports included in the report
+REPORTED_IMPORTS = 15
+
+__profiler__ = None
+__report_lock__ = Lock()
+
+
+class StartupProfiler(object):
+    """Records the cumulative time of first imports and the times at which startup phases are reached."""
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.import_times = {}
+        self.phases = []
+        self.original_import = None
+        self.reported = False
+
+    def install_import_timer(self):
+        """Replaces the import function to time the first import of every module."""
+        original_import = builtins.__import__
+        import_times = self.import_times
+
+        def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if level != 0 or name in sys.modules:
+                return original_import(name, globals, locals, fromlist, level)
+            start_time = time.perf_counter()
+            try:
+                return original_import(name, globals, locals, fromlist, level)
+            finally:
+                import_times.setdefault(name, time.perf_counter() - start_time)
+
+        self.original_import = original_import
+        builtins.__import__ = timed_import
+
+    def uninstall_import_timer(self):
+        """Restores the import function replaced by install_import_timer."""
+        if self.original_import is not None:
+            builtins.__import__ = self.original_import
+            self.original_import = None
+
+    def mark(self, phase):
+        """Records that the startup phase has been reached."""
+        self.phases.append((phase, time.perf_counter()))
+
+    def report_lines(self):
+        """Returns the lines of the startup profile.
+        Import times are cumulative, i.e. they include the time spent importing the dependencies of a module.
+        """
+        lines = []
+        previous_time = self.start_time
+        for phase, phase_time in self.phases:
+            lines.append('Startup phase {} reached at {:.1f} ms (+{:.1f} ms)'.format(
+                phase, (phase_time - self.start_time) * 1000, (phase_time - previous_time) * 1000))
+            previous_time = phase_time
+        slowest_imports = sorted(self.import_times.items(), key=lambda item: item[1], reverse=True)
+        for name, import_secs in slowest_imports[:REPORTED_IMPORTS]:
+            lines.append('Startup import of {} took {:.1f} ms'.format(name, import_secs * 1000))
+        return lines
+
+
+def is_profiling_requested(args):
+    """Returns true if args request the startup to be profiled."""
+    return PROFILE_STARTUP_ARGUMENT in args
+
+
+def enable_profiling():
+    """Starts profiling the startup, imports after this call are timed."""
+    global __profiler__
+    if __profiler__ is None:
+        __profiler__ = StartupProfiler()
+        __profiler__.install_import_timer()
+    return __profiler__
+
+
+def mark(phase):
+    """Records that the startup phase has been reached, does nothing when profiling is not enabled."""
+    if __profiler__ is not None:
+        __profiler__.mark(phase)
+
+
+def report(output_fn):
+    """Stops profiling and reports the startup profile once using output_fn and logging.
+    Does nothing when profiling is not enabled or the profile has already been reported.
+    """
+    profiler = __profiler__
+    if profiler is None:
+        return
+    with __report_lock__:
+        if profiler.reported:
+            return
+        profiler.reported = True
+    profiler.uninstall_import_timer()
+    for line in profiler.report_lines():
+        logging.info(line)
+        output_fn(line)
@@ -1,18 +1,32 @@
 """This module provides helper functions for subprocess management."""
 
+import collections
 import logging
+import math
+import select
 import signal
 import subprocess
 import sys
+import time
+from threading import Lock, Thread
 
 import os
-import psutil
 
 import cook
 import cook.io_helper as cio
+import cook.metrics as cmet
+import cook.tracing as ctr
+import cook.util as cu
 
+PROC_DIRECTORY = '/proc'
+CGROUP_V2_DIRECTORY = '/sys/fs/cgroup'
+# The max time to wait for a cgroup to report that it has been frozen or thawed
+CGROUP_FREEZE_TIMEOUT_SECS = 0.1
+# Bounds the number of /proc snapshots taken while freezing a process tree that keeps forking
+MAX_PROCESS_TREE_SNAPSHOTS = 10
 
-def launch_process(command, environment):
+
+def launch_process(command, environment, capture_output=False):
     """Launches the process using the command and specified environment.
 
     Parameters
@@ -21,6 +35,9 @@ def launch_process(command, environment):
         The command to execute.
     environment: dictionary
         The environment.
+    capture_output: boolean
+        Whether the stdout and stderr of the process are pipes read by the executor, by default the process
+        writes directly to the executor's stdout and stderr.
 
     Returns
     -------
@@ -29,15 +46,17 @@ def launch_process(command, environment):
     if not command:
         logging.warning('No command provided!')
         return None
-    # The preexec_fn is run after the fork() but before exec() to run the shell.
-    # setsid will run the program in a new session, thus assigning a new process group to it and its children.
+    # start_new_session calls setsid after the fork() but before exec() to run the shell, thus assigning
+    # a new process group to the program and its children.
+    # Unlike a preexec_fn it allows the child to be created with vfork(), which does not copy the executor's
+    # page tables and hence keeps the launch time independent of the executor's memory footprint.
     return subprocess.Popen(command,
                             bufsize=0,
                             env=environment,
-                            preexec_fn=os.setsid,
                             shell=True,
-                            stderr=sys.stderr,
-                            stdout=sys.stdout)
+                            start_new_session=True,
+                            stderr=subprocess.PIPE if capture_output else sys.stderr,
+                            stdout=subprocess.PIPE if capture_output else sys.stdout)
 
 
 def is_process_running(process):
@@ -55,6 +74,60 @@ def is_process_running(process):
     return process.poll() is None
 
 
+def open_pidfd(process_id):
+    """Opens a pidfd referring to the process, the pidfd becomes readable when the process exits.
+
+    Returns
+    -------
+    The pidfd, or None if pidfds are not supported (they require Linux 5.3+) or the process no longer exists.
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(process_id)
+    except OSError as error:
+        logging.info('Unable to open pidfd for process {}: {}'.format(process_id, error))
+        return None
+
+
+def has_process_exited(process):
+    """Checks whether the process has exited without reaping it, i.e. the exit status remains available to wait.
+
+    Parameters
+    ----------
+    process: subprocess.Popen
+        The process to query
+
+    Returns
+    -------
+    whether the process has exited.
+    """
+    if process.returncode is not None:
+        return True
+    try:
+        return os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+    except ChildProcessError:
+        # the process has already been reaped
+        return True
+
+
+def await_process_exit(process):
+    """Blocks in waitid until the process exits, without reaping it, i.e. the exit status remains available to wait.
+
+    Parameters
+    ----------
+    process: subprocess.Popen
+        The process to wait for
+    """
+    if process.returncode is not None:
+        return
+    try:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    except ChildProcessError:
+        # the process has already been reaped
+        pass
+
+
 def find_process_group(process_id):
     """Return the process group id of the process with process id process_id.
     Parameters
@@ -99,60 +172,216 @@ def _send_signal_to_process(process_id, signal_to_send):
     return False
 
 
-def _send_signal_to_process_tree(root_process_id, signal_to_send):
-    """Send the signal_to_send signal to the process tree rooted at process_id.
-    Parameters
-    ----------
-    process_id: int
-        The id of the root process.
-    signal_to_send: signal.Signals enum
-        The signal to send to the process group.
+def _read_process_children_map():
+    """Snapshots the parent of every running process in a single scan of /proc.
+    Falls back to psutil on platforms without /proc.
+
     Returns
     -------
-    True if the signal was sent successfully.
+    A dictionary from process id to the list of ids of its child processes.
     """
-    signal_name = signal_to_send.name
-    logging.info('Sending {} to process tree rooted at (id: {})'.format(signal_name, root_process_id))
+    children_map = collections.defaultdict(list)
+    try:
+        process_ids = [int(name) for name in os.listdir(PROC_DIRECTORY) if name.isdigit()]
+    except FileNotFoundError:
+        # imported lazily, psutil is only needed on platforms without /proc
+        import psutil
+        for process in psutil.process_iter(attrs=['pid', 'ppid']):
+            children_map[process.info['ppid']].append(process.info['pid'])
+        return children_map
+    for process_id in process_ids:
+        try:
+            with open(os.path.join(PROC_DIRECTORY, str(process_id), 'stat'), 'rb') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            # the process has already exited
+            continue
+        # the command name may contain spaces or parentheses, the state and the parent id follow its closing parenthesis
+        parent_process_id = int(stat[stat.rindex(b')') + 2:].split(b' ', 2)[1])
+        children_map[parent_process_id].append(process_id)
+    return children_map
 
-    process_queue = [root_process_id]
-    visited_process_ids = set()
 
-    num_processes_found = 0
-    num_processes_killed = 0
-    signal_sent_to_all_processes_successfully = True
+def _find_process_tree(root_process_id, children_map):
+    """Returns the ids, in breadth-first order, of the processes in the tree rooted at root_process_id.
 
+    Parameters
+    ----------
+    root_process_id: int
+        The id of the root process.
+    children_map: dictionary
+        The child process ids of every process, see _read_process_children_map.
+    """
+    tree_process_ids = [root_process_id]
+    visited_process_ids = {root_process_id}
+    process_queue = collections.deque(tree_process_ids)
     while process_queue:
-        loop_process_id = process_queue.pop(0)
-        num_processes_found += 1
-        try:
-            visited_process_ids.add(loop_process_id)
+        for child_process_id in children_map.get(process_queue.popleft(), ()):
+            if child_process_id not in visited_process_ids:
+                visited_process_ids.add(child_process_id)
+                tree_process_ids.append(child_process_id)
+                process_queue.append(child_process_id)
+    return tree_process_ids
+
 
-            # Stop the process to keep it from forking since a forked child might get re-parented
-            _send_signal_to_process(loop_process_id, signal.SIGSTOP)
+def find_process_tree_ids(root_process_id):
+    """Returns the ids of the processes in the tree rooted at root_process_id using a single /proc snapshot."""
+    return _find_process_tree(root_process_id, _read_process_children_map())
 
-            # Now safe to retrieve the children
-            process = psutil.Process(loop_process_id)
-            children = process.children()
-            [process_queue.append(child.pid) for child in children if child.pid not in visited_process_ids]
 
-            if _send_signal_to_process(loop_process_id, signal_to_send):
-                num_processes_killed += 1
-            else:
-                signal_sent_to_all_processes_successfully = False
+def _signal_processes(process_ids, signal_to_send):
+    """Sends signal_to_send to every process in process_ids without logging each signal.
+
+    Returns
+    -------
+    A tuple of the number of processes that were signalled successfully and the number of processes that could
+    not be found, e.g. as they exited after the process ids were read.
+    """
+    num_processes_signalled = 0
+    num_processes_not_found = 0
+    for process_id in process_ids:
+        try:
+            os.kill(process_id, signal_to_send)
+            num_processes_signalled += 1
         except ProcessLookupError:
-            logging.info('Unable to send {} as could not find process (id: {})'.format(signal_name, loop_process_id))
+            logging.debug('Unable to send %s as could not find process (id: %s)', signal_to_send.name, process_id)
+            num_processes_not_found += 1
         except Exception:
-            logging.exception('Error in sending {} to process (id: {})'.format(signal_name, loop_process_id))
-            signal_sent_to_all_processes_successfully = False
+            logging.exception('Error in sending {} to process (id: {})'.format(signal_to_send.name, process_id))
+    return num_processes_signalled, num_processes_not_found
+
+
+def read_cgroup_path(process_id):
+    """Returns the cgroup v2 path of the process, or None if it is not available."""
+    try:
+        with open(os.path.join(PROC_DIRECTORY, str(process_id), 'cgroup')) as cgroup_file:
+            for line in cgroup_file:
+                if line.startswith('0::'):
+                    return line[3:].strip()
+    except OSError:
+        pass
+    return None
+
 
-    log_message = 'Found {} process(es) in tree rooted at (id: {}), successfully sent {} to {} process(es)'
-    logging.info(log_message.format(num_processes_found, root_process_id, signal_name, num_processes_killed))
+def _find_freezable_cgroup(root_process_id):
+    """Returns the cgroup v2 directory of the process tree if it can be frozen without freezing the executor.
+
+    Returns
+    -------
+    The directory of the cgroup of root_process_id when it has a writable cgroup.freeze file and does not contain
+    the executor process, else None.
+    """
+    task_cgroup_path = read_cgroup_path(root_process_id)
+    executor_cgroup_path = read_cgroup_path(os.getpid())
+    if not task_cgroup_path or not executor_cgroup_path or task_cgroup_path == '/':
+        return None
+    if (executor_cgroup_path + '/').startswith(task_cgroup_path.rstrip('/') + '/'):
+        return None
+    cgroup_directory = os.path.join(CGROUP_V2_DIRECTORY, task_cgroup_path.lstrip('/'))
+    if os.access(os.path.join(cgroup_directory, 'cgroup.freeze'), os.W_OK):
+        return cgroup_directory
+    return None
+
+
+def _set_cgroup_frozen(cgroup_directory, frozen):
+    """Freezes or thaws the cgroup, returns True if the cgroup reached the requested state in time."""
+    try:
+        with open(os.path.join(cgroup_directory, 'cgroup.freeze'), 'w') as freeze_file:
+            freeze_file.write('1' if frozen else '0')
+        expected_event = 'frozen {}'.format(1 if frozen else 0)
+        deadline = time.monotonic() + CGROUP_FREEZE_TIMEOUT_SECS
+        while True:
+            with open(os.path.join(cgroup_directory, 'cgroup.events')) as events_file:
+                if expected_event in events_file.read().splitlines():
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.001)
+    except Exception:
+        logging.exception('Error in setting cgroup {} frozen={}'.format(cgroup_directory, frozen))
+        return False
 
-    for loop_process_id in visited_process_ids:
-        # Try and continue the processes in case the signal is non-terminating but doesn't continue the process.
-        _send_signal_to_process(loop_process_id, signal.SIGCONT)
 
-    return signal_sent_to_all_processes_successfully
+def _freeze_process_tree(root_process_id):
+    """Stops every process in the tree rooted at root_process_id using SIGSTOP.
+    The tree is computed from /proc snapshots until a snapshot reveals no new processes,
+    i.e. processes forked before their parent was stopped are also stopped.
+
+    Returns
+    -------
+    The tuple (ids of the processes in the tree, ids of the stopped processes, number of snapshots).
+    """
+    tree_process_ids = []
+    known_process_ids = set()
+    stopped_process_ids = []
+    num_snapshots = 0
+    while num_snapshots < MAX_PROCESS_TREE_SNAPSHOTS:
+        num_snapshots += 1
+        children_map = _read_process_children_map()
+        new_process_ids = [process_id for process_id in _find_process_tree(root_process_id, children_map)
+                           if process_id not in known_process_ids]
+        if not new_process_ids:
+            break
+        known_process_ids.update(new_process_ids)
+        tree_process_ids.extend(new_process_ids)
+        for process_id in new_process_ids:
+            num_processes_stopped, _ = _signal_processes([process_id], signal.SIGSTOP)
+            if num_processes_stopped:
+                stopped_process_ids.append(process_id)
+    return tree_process_ids, stopped_process_ids, num_snapshots
+
+
+def _send_signal_to_process_tree(root_process_id, signal_to_send):
+    """Send the signal_to_send signal to the process tree rooted at process_id.
+    The tree is frozen before it is signalled to keep processes from forking children that would escape the signal.
+    When the tree runs in its own cgroup v2 (i.e. one not containing the executor), the cgroup freezer is used.
+    Else every process is stopped with SIGSTOP and continued with SIGCONT after being signalled.
+    Parameters
+    ----------
+    process_id: int
+        The id of the root process.
+    signal_to_send: signal.Signals enum
+        The signal to send to the process group.
+    Returns
+    -------
+    True if the signal was sent successfully.
+    """
+    signal_name = signal_to_send.name
+    logging.info('Sending {} to process tree rooted at (id: {})'.format(signal_name, root_process_id))
+    start_time = time.perf_counter()
+
+    cgroup_directory = _find_freezable_cgroup(root_process_id)
+    if cgroup_directory and _set_cgroup_frozen(cgroup_directory, True):
+        freeze_method = 'cgroup freezer'
+        tree_process_ids = _find_process_tree(root_process_id, _read_process_children_map())
+        stopped_process_ids = []
+        num_snapshots = 1
+    else:
+        if cgroup_directory:
+            logging.info('Unable to freeze cgroup {}, stopping processes instead'.format(cgroup_directory))
+            _set_cgroup_frozen(cgroup_directory, False)
+            cgroup_directory = None
+        freeze_method = 'SIGSTOP'
+        tree_process_ids, stopped_process_ids, num_snapshots = _freeze_process_tree(root_process_id)
+    freeze_time_ms = (time.perf_counter() - start_time) * 1000
+
+    num_processes_killed, num_processes_not_found = _signal_processes(tree_process_ids, signal_to_send)
+
+    # Try and continue the processes in case the signal is non-terminating but doesn't continue the process.
+    if cgroup_directory:
+        _set_cgroup_frozen(cgroup_directory, False)
+    else:
+        _signal_processes(stopped_process_ids, signal.SIGCONT)
+    total_time_ms = (time.perf_counter() - start_time) * 1000
+
+    log_message = 'Found {} process(es) in tree rooted at (id: {}), successfully sent {} to {} process(es) ' \
+                  'and {} had exited in {:.1f} ms (frozen with {} in {:.1f} ms using {} snapshot(s))'
+    logging.info(log_message.format(len(tree_process_ids), root_process_id, signal_name, num_processes_killed,
+                                    num_processes_not_found, total_time_ms, freeze_method, freeze_time_ms,
+                                    num_snapshots))
+
+    # processes which exited after the tree was read do not need the signal, as in the other kill mechanisms
+    return num_processes_killed + num_processes_not_found == len(tree_process_ids)
 
 
 def _send_signal_to_process_group(process_id, signal_to_send):
@@ -200,6 +429,168 @@ def send_signal(process_id, signal_to_send):
             logging.info('Failed to send {} to process (id: {})'.format(signal_name, process_id))
 
 
+class ProcessExitWaiter(object):
+    """Waits for a process to exit and drives its termination once the stop signal is set.
+    The waiting thread sleeps in poll until the pidfd (Linux 5.3+) of the process becomes readable or a wakeup pipe
+    is written to; the stop signal writes to the pipe when it is set and, when pidfds are not available, so does a
+    helper thread blocked in waitid once the process exits.
+    When the stop signal is set, the process is sent a SIGTERM and, if it has not exited after
+    (shutdown_grace_period_ms - 100) ms, a SIGKILL; the same thread waits for the exit and escalates the kill.
+    """
+
+    def __init__(self, process, stop_signal, shutdown_grace_period_ms):
+        """
+        Parameters
+        ----------
+        process: subprocess.Popen
+            The process to wait for.
+        stop_signal: cook.util.NotifyingEvent
+            Event that determines if the process was requested to terminate.
+        shutdown_grace_period_ms: int
+            Grace period before forceful kill.
+        """
+        self.process = process
+        self.stop_signal = stop_signal
+        self.shutdown_grace_period_secs = max(shutdown_grace_period_ms - (1000 * cook.TERMINATE_GRACE_SECS), 0) / 1000.0
+        self.exit_time = None
+        self.kill_span = None
+        self.sigterm_time = None
+        self.sigkill_time = None
+        self.wakeup_lock = Lock()
+        self.wakeup_fds = None
+
+    def terminated(self):
+        """Returns true if the process was sent a signal to terminate it."""
+        return self.sigterm_time is not None
+
+    def __wake_up(self):
+        """Wakes up the thread waiting in poll, a no-op once the wait has completed."""
+        with self.wakeup_lock:
+            if self.wakeup_fds is not None:
+                try:
+                    os.write(self.wakeup_fds[1], b'\0')
+                except BlockingIOError:
+                    # the pipe is full, i.e. a wakeup is already pending
+                    pass
+
+    def __await_exit_and_wake_up(self):
+        """Blocks in waitid, without reaping the process, until it exits and then wakes up the waiting thread.
+        It stands in for the pidfd; a SIGCHLD handler is not an option as handlers can only be installed on
+        the main thread.
+        """
+        try:
+            await_process_exit(self.process)
+        except Exception:
+            logging.exception('Error in waiting for process (id: {}) to exit'.format(self.process.pid))
+        self.__wake_up()
+
+    def __terminate(self):
+        """Sends a SIGTERM to the process if it is still running."""
+        self.sigterm_time = time.time()
+        self.kill_span = ctr.start_span('terminate-process', pid=self.process.pid)
+        if not has_process_exited(self.process):
+            logging.info('Executor has been instructed to terminate running task')
+            logging.info('Waiting up to {} ms for process to terminate'.format(self.shutdown_grace_period_secs * 1000))
+            send_signal(self.process.pid, signal.SIGTERM)
+
+    def __kill(self):
+        """Sends a SIGKILL to the process if it is still running."""
+        self.sigkill_time = time.time()
+        if not has_process_exited(self.process):
+            logging.info('Process did not terminate via SIGTERM after {} seconds'.format(
+                self.shutdown_grace_period_secs))
+            send_signal(self.process.pid, signal.SIGKILL)
+
+    def wait(self):
+        """Blocks until the process exits, terminating it if the stop signal is set, and reaps it.
+
+        Returns
+        -------
+        The time at which the exit of the process was detected.
+        """
+        # a reaped process id may have been reused, hence a pidfd is only opened for a process that has not been reaped
+        pidfd = open_pidfd(self.process.pid) if self.process.returncode is None else None
+        wakeup_read_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(wakeup_read_fd, False)
+        os.set_blocking(wakeup_write_fd, False)
+        self.wakeup_fds = (wakeup_read_fd, wakeup_write_fd)
+        poller = select.poll()
+        poller.register(wakeup_read_fd, select.POLLIN)
+        if pidfd is not None:
+            poller.register(pidfd, select.POLLIN)
+        elif self.process.returncode is None:
+            Thread(target=self.__await_exit_and_wake_up, args=(), name='process-exit-waiter', daemon=True).start()
+        self.stop_signal.add_callback(self.__wake_up)
+        try:
+            while True:
+                if self.sigterm_time is None and self.stop_signal.is_set():
+                    self.__terminate()
+                timeout_ms = None
+                if self.sigterm_time is not None and self.sigkill_time is None:
+                    remaining_secs = self.sigterm_time + self.shutdown_grace_period_secs - time.time()
+                    if remaining_secs <= 0:
+                        self.__kill()
+                        continue
+                    timeout_ms = math.ceil(remaining_secs * 1000)
+                if has_process_exited(self.process):
+                    self.exit_time = time.time()
+                    break
+                poller.poll(timeout_ms)
+                try:
+                    os.read(wakeup_read_fd, 4096)
+                except BlockingIOError:
+                    pass
+        finally:
+            self.stop_signal.remove_callback(self.__wake_up)
+            with self.wakeup_lock:
+                self.wakeup_fds = None
+                os.close(wakeup_read_fd)
+                os.close(wakeup_write_fd)
+            if pidfd is not None:
+                os.close(pidfd)
+        if self.sigterm_time is not None:
+            cmet.observe('kill_duration_ms', (self.exit_time - self.sigterm_time) * 1000)
+            self.kill_span.finish(sigkill=self.sigkill_time is not None)
+        # the process has exited, wait only reaps it
+        self.process.wait()
+        logging.info('Process (id: {}) exited with status {} (pid fd: {})'.format(
+            self.process.pid, self.process.returncode, pidfd is not None))
+        return self.exit_time
+
+
+def terminate_process(process, shutdown_grace_period_ms, timer_service):
+    """Attempts to kill a process without blocking the caller.
+     The process is sent a SIGTERM and an escalation is scheduled on timer_service to send it a SIGKILL if it
+     has not terminated after (shutdown_grace_period_ms - 100) ms, similar to kill_process.
+
+    Parameters
+    ----------
+    process: subprocess.Popen
+        The process to kill
+    shutdown_grace_period_ms: int
+        Grace period before forceful kill
+    timer_service: cook.timers.TimerService
+        The service used to schedule the escalation to SIGKILL.
+
+    Returns
+    -------
+    The ScheduledTask of the escalation to SIGKILL, or None if the process is not running.
+    """
+    shutdown_grace_period_ms = max(shutdown_grace_period_ms - (1000 * cook.TERMINATE_GRACE_SECS), 0)
+    if not is_process_running(process):
+        return None
+    logging.info('Waiting up to {} ms for process to terminate'.format(shutdown_grace_period_ms))
+    send_signal(process.pid, signal.SIGTERM)
+    shutdown_grace_period_secs = shutdown_grace_period_ms / 1000.0
+
+    def escalate_to_sigkill():
+        if is_process_running(process):
+            logging.info('Process did not terminate via SIGTERM after {} seconds'.format(shutdown_grace_period_secs))
+            send_signal(process.pid, signal.SIGKILL)
+
+    return timer_service.schedule(shutdown_grace_period_secs, escalate_to_sigkill, 'kill-escalation')
+
+
 def kill_process(process, shutdown_grace_period_ms):
     """Attempts to kill a process.
      First attempt is made by sending the process a SIGTERM.
@@ -217,26 +608,17 @@ def kill_process(process, shutdown_grace_period_ms):
     -------
     True if the process completed execution or was killed.
     """
-    shutdown_grace_period_ms = max(shutdown_grace_period_ms - (1000 * cook.TERMINATE_GRACE_SECS), 0)
     if is_process_running(process):
-        logging.info('Waiting up to {} ms for process to terminate'.format(shutdown_grace_period_ms))
-
-        send_signal(process.pid, signal.SIGTERM)
-        shutdown_grace_period_secs = shutdown_grace_period_ms / 1000.0
+        stop_signal = cu.NotifyingEvent()
+        stop_signal.set()
         try:
-            process.wait(shutdown_grace_period_secs)
-            cio.print_and_log('Command terminated with signal Terminated (pid: {})'.format(process.pid))
-        except subprocess.TimeoutExpired:
-            logging.info('Process did not terminate via SIGTERM after {} seconds'.format(shutdown_grace_period_secs))
+            with ctr.start_span('kill-process', pid=process.pid):
+                ProcessExitWaiter(process, stop_signal, shutdown_grace_period_ms).wait()
+            if process.returncode < 0:
+                signal_description = signal.strsignal(-process.returncode)
+                cio.print_and_log('Command terminated with signal {} (pid: {})'.format(signal_description, process.pid),
+                                  flush=True)
         except Exception:
-            logging.exception('Error while sending SIGTERM to (pid: {})'.format(process.pid))
-
-        if is_process_running(process):
-            send_signal(process.pid, signal.SIGKILL)
-            try:
-                process.wait() # wait indefinitely for process to die/complete, it cannot ignore SIGKILL
-                cio.print_and_log('Command terminated with signal Killed (pid: {})'.format(process.pid))
-            except Exception:
-                logging.exception('Error while sending SIGKILL to (pid: {})'.format(process.pid))
+            logging.exception('Error while killing (pid: {})'.format(process.pid))
 
     return not is_process_running(process)
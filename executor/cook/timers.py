@@ -0,0 +1,180 @@
+"""This module provides a single-threaded service that runs the executor's deadline and periodic work.
+Scheduling work on the service, instead of creating a Timer or Thread for each piece of work, avoids thread
+creation churn and makes the timing of all the work observable in one place.
+"""
+
+import heapq
+import itertools
+import logging
+import time
+from threading import Condition, Thread, current_thread
+
+
+class ScheduledTask(object):
+    """A callback scheduled on a TimerService, periodic tasks have a positive interval_secs."""
+
+    def __init__(self, name, fn, deadline, interval_secs=None):
+        self.name = name
+        self.fn = fn
+        self.deadline = deadline
+        self.interval_secs = interval_secs
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancels future runs of the task, a run that is in progress is not interrupted."""
+        self.cancelled = True
+
+
+class TimerStatistics(object):
+    """Timing statistics of the runs of tasks sharing a name."""
+
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.total_run_secs = 0.0
+        self.max_run_secs = 0.0
+        self.max_delay_secs = 0.0
+
+    def record(self, delay_secs, run_secs, failed):
+        self.runs += 1
+        self.failures += 1 if failed else 0
+        self.total_run_secs += run_secs
+        self.max_run_secs = max(self.max_run_secs, run_secs)
+        self.max_delay_secs = max(self.max_delay_secs, delay_secs)
+
+    def __str__(self):
+        return '{} runs ({} failed), run time total {:.1f} ms and max {:.1f} ms, max delay {:.1f} ms'.format(
+            self.runs, self.failures, self.total_run_secs * 1000, self.max_run_secs * 1000,
+            self.max_delay_secs * 1000)
+
+
+class TimerService(object):
+    """Runs scheduled and periodic callbacks, in deadline order, on a single thread.
+    Callbacks are expected to be short, a long running callback delays every other callback.
+    """
+
+    def __init__(self, name='timer-service'):
+        """
+        Parameters
+        ----------
+        name: string
+            The name of the thread running the callbacks.
+        """
+        self.name = name
+        self.condition = Condition()
+        self.queue = []
+        self.sequence = itertools.count()
+        self.stopped = False
+        self.thread = None
+        self.statistics = {}
+
+    def start(self):
+        """Starts the thread running the callbacks."""
+        self.thread = Thread(target=self.__run, args=(), name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enqueue(self, task):
+        """Adds the task to the callbacks to run once its deadline expires."""
+        with self.condition:
+            heapq.heappush(self.queue, (task.deadline, next(self.sequence), task))
+            self.condition.notify()
+        return task
+
+    def schedule(self, delay_secs, fn, name):
+        """Schedules fn to run once after delay_secs.
+
+        Returns
+        -------
+        The ScheduledTask which can be used to cancel the run.
+        """
+        return self.enqueue(ScheduledTask(name, fn, time.monotonic() + delay_secs))
+
+    def schedule_periodic(self, interval_secs, fn, name, initial_delay_secs=None):
+        """Schedules fn to run every interval_secs, measured from the end of the previous run.
+
+        Returns
+        -------
+        The ScheduledTask which can be used to cancel future runs.
+        """
+        initial_delay_secs = interval_secs if initial_delay_secs is None else initial_delay_secs
+        return self.enqueue(ScheduledTask(name, fn, time.monotonic() + initial_delay_secs, interval_secs))
+
+    def watch_event(self, event, fn, name):
+        """Runs fn once after event has been set, the event wakes up the service when it is set.
+
+        Parameters
+        ----------
+        event: cook.util.NotifyingEvent
+            The event to watch.
+
+        Returns
+        -------
+        The ScheduledTask which can be used to stop watching the event.
+        """
+        watch_task = ScheduledTask(name, fn, None)
+
+        def on_event_set():
+            if not watch_task.cancelled:
+                watch_task.deadline = time.monotonic()
+                self.enqueue(watch_task)
+
+        event.add_callback(on_event_set)
+        return watch_task
+
+    def __run(self):
+        """Runs the callbacks as their deadlines expire until the service is stopped."""
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    deadline, _, task = self.queue[0]
+                    if task.cancelled:
+                        heapq.heappop(self.queue)
+                        continue
+                    wait_secs = deadline - time.monotonic()
+                    if wait_secs <= 0:
+                        heapq.heappop(self.queue)
+                        break
+                    self.condition.wait(wait_secs)
+                if self.stopped:
+                    return
+
+            self.run_task(task)
+
+    def run_task(self, task):
+        """Runs the callback of the task and records its timing statistics, periodic tasks are enqueued again."""
+        start_time = time.monotonic()
+        failed = False
+        try:
+            task.fn()
+        except Exception:
+            failed = True
+            logging.exception('Error in running {}'.format(task.name))
+        end_time = time.monotonic()
+
+        with self.condition:
+            self.statistics.setdefault(task.name, TimerStatistics()).record(
+                start_time - task.deadline, end_time - start_time, failed)
+        if task.interval_secs and not task.cancelled:
+            task.deadline = end_time + task.interval_secs
+            self.enqueue(task)
+
+    def stop(self):
+        """Stops the service, callbacks that have not run yet are dropped."""
+        with self.condition:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None and self.thread is not current_thread():
+            self.thread.join()
+        self.log_statistics()
+
+    def log_statistics(self):
+        """Logs the timing statistics of the callbacks that have run."""
+        with self.condition:
+            for name, statistics in sorted(self.statistics.items()):
+                logging.info('{} {}: {}'.format(self.name, name, statistics))
@@ -0,0 +1,137 @@
+"""This module traces the phases of the executor's task lifecycle, it is enabled by configuring a trace file.
+A span is started and finished around a phase, e.g. launching the task or sending a message, and is written
+to the trace file as a json line with its name, wall clock start time, monotonic duration and attributes.
+When tracing is not enabled, starting a span returns a shared no-op span.
+"""
+
+import json
+import logging
+import threading
+import time
+from threading import Lock
+
+__tracer__ = None
+
+
+class Span(object):
+    """A traced phase, it is recorded when finished and can be used as a context manager."""
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.thread_name = threading.current_thread().name
+        self.start_time = time.time()
+        self.start_monotonic = time.monotonic()
+        self.finished = False
+
+    def finish(self, **attributes):
+        """Records the span along with attributes, spans are only recorded the first time they are finished."""
+        if self.finished:
+            return
+        self.finished = True
+        duration_ms = (time.monotonic() - self.start_monotonic) * 1000
+        self.attributes.update(attributes)
+        self.tracer.record(self, duration_ms)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.finish()
+        else:
+            self.finish(error=exception_type.__name__)
+        return False
+
+
+class NoopSpan(object):
+    """The span returned when tracing is not enabled."""
+
+    def finish(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer(object):
+    """Writes finished spans as json lines to the trace file, the lines are buffered until flushed."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = Lock()
+        self.trace_file = open(file_path, 'a')
+        self.span_count = 0
+
+    def start_span(self, name, attributes):
+        return Span(self, name, attributes)
+
+    def record(self, span, duration_ms):
+        """Writes the finished span to the trace file."""
+        entry = {'name': span.name,
+                 'start': round(span.start_time, 6),
+                 'duration-ms': round(duration_ms, 3),
+                 'thread': span.thread_name}
+        entry.update(span.attributes)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.write(line)
+                self.span_count += 1
+
+    def flush(self):
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.close()
+                self.trace_file = None
+                logging.info('{} spans written to {}'.format(self.span_count, self.file_path))
+
+
+def enable(file_path):
+    """Enables tracing to file_path, the tracer is created on the first call and returned.
+    Failing to open the trace file is logged and leaves tracing disabled as it is not needed to run the task.
+    """
+    global __tracer__
+    if __tracer__ is None:
+        try:
+            __tracer__ = Tracer(file_path)
+            logging.info('Tracing to {}'.format(file_path))
+        except OSError:
+            logging.exception('Unable to open the trace file {}'.format(file_path))
+    return __tracer__
+
+
+def start_span(name, **attributes):
+    """Starts a span named name, the span is recorded once its finish() method is invoked or its context is exited.
+    A no-op span is returned when tracing is not enabled.
+    """
+    tracer = __tracer__
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.start_span(name, attributes)
+
+
+def flush():
+    """Flushes the spans recorded so far to the trace file, does nothing when tracing is not enabled."""
+    tracer = __tracer__
+    if tracer is not None:
+        tracer.flush()
+
+
+def close():
+    """Flushes and closes the trace file, spans finished afterwards are dropped."""
+    tracer = __tracer__
+    if tracer is not None:
+        tracer.close()
@@ -2,6 +2,7 @@ import errno
 import logging
 import resource
 import sys
+from threading import Event, Lock
 
 __rusage_denom_mb = 1024.0
 if sys.platform == 'darwin':
@@ -21,3 +22,43 @@ def print_memory_usage():
 def is_out_of_memory_error(exception):
     """Returns true iff exception is an instance of OSError and error code represents an out of memory error."""
     return isinstance(exception, OSError) and exception.errno == errno.ENOMEM
+
+
+class NotifyingEvent(Event):
+    """An Event which invokes callbacks once it is set.
+    It lets components that wait on something else, e.g. file descriptors or a timer queue, observe the event
+    without polling it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks_lock = Lock()
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        """Registers callback to be invoked, on the thread setting the event, once the event is set.
+        The callback is invoked immediately if the event has already been set.
+        """
+        with self.callbacks_lock:
+            if not self.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        """Unregisters callback if it has not been invoked yet."""
+        with self.callbacks_lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def set(self):
+        """Sets the event and invokes the callbacks registered so far, each callback is invoked at most once."""
+        with self.callbacks_lock:
+            super().set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logging.exception('Error in invoking the callback of the event')
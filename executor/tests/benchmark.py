@@ -0,0 +1,378 @@
+"""Benchmarks for the cook executor.
+The benchmarks are not part of the test suite, they can be run from the executor folder using:
+
+    $ python -m tests.benchmark <benchmark-name> [options]
+
+Run with --help to list the available benchmarks and their options.
+"""
+
+import argparse
+import logging
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from threading import Event, Thread
+
+import cook.inotify as ci
+import cook.progress as cp
+import cook.subprocess as cs
+import tests.utils as tu
+
+DEFAULT_PROGRESS_REGEX = 'progress: ([0-9]*\.?[0-9]+), (.*)'
+
+
+def generate_output_file(file_name, size_mb, line_length, progress_every):
+    """Writes a synthetic stdout file of size_mb MB with a progress message every progress_every lines.
+
+    Returns
+    -------
+    the number of lines written.
+    """
+    filler = 'x' * line_length
+    lines_per_block = max(progress_every, 1)
+    num_lines = 0
+    num_bytes = 0
+    target_bytes = size_mb * 1024 * 1024
+    with open(file_name, 'w') as output_file:
+        while num_bytes < target_bytes:
+            block = ['{} {}\n'.format(num_lines + i, filler)[-line_length:] for i in range(lines_per_block - 1)]
+            block.append('progress: {}, completed {} lines\n'.format(int(100 * num_bytes / target_bytes),
+                                                                     num_lines + lines_per_block))
+            data = ''.join(block)
+            output_file.write(data)
+            num_lines += lines_per_block
+            num_bytes += len(data)
+    return num_lines
+
+
+def consume_progress_states(watcher, num_lines):
+    """Retrieves all progress states from watcher, the task is marked completed once num_lines have been read.
+
+    Returns
+    -------
+    the number of progress states generated.
+    """
+    completed_signal = watcher.task_completed_signal
+
+    def await_all_lines():
+        while watcher.line_count < num_lines:
+            time.sleep(0.01)
+        completed_signal.set()
+        watcher.wake_up()
+
+    completion_thread = Thread(target=await_all_lines, args=())
+    completion_thread.daemon = True
+    completion_thread.start()
+    return sum(1 for _ in watcher.retrieve_progress_states())
+
+
+def report(name, num_lines, num_bytes, wall_time_secs, cpu_time_secs, **extra):
+    """Prints the throughput numbers of a benchmark run."""
+    details = ''.join(', {}={}'.format(key, value) for key, value in sorted(extra.items()))
+    print('{}: {:,.0f} lines/sec, {:,.1f} MB/sec, wall={:.2f}s, cpu={:.2f}s{}'.format(
+        name, num_lines / wall_time_secs, num_bytes / (1024 * 1024) / wall_time_secs, wall_time_secs,
+        cpu_time_secs, details))
+
+
+class FindallProgressWatcher(cp.ProgressWatcher):
+    """ProgressWatcher that runs findall() on every line, i.e. the matching strategy without the literal pre-filter."""
+
+    def match_progress_update(self, input_data):
+        matches = self.progress_regex_pattern.findall(input_data)
+        return matches[0] if len(matches) >= 1 else None
+
+
+def run_progress_match_benchmark(args):
+    """Compares the throughput of matching progress messages with and without the required literal pre-filter."""
+    file_name = tu.ensure_directory('build/benchmark_progress_match.{}'.format(tu.get_random_task_id()))
+    try:
+        num_lines = generate_output_file(file_name, args.size_mb, args.line_length, args.progress_every)
+        num_bytes = os.path.getsize(file_name)
+        print('Generated {:,} lines ({:,} bytes) in {}'.format(num_lines, num_bytes, file_name))
+        print('Required literal of {} is {}'.format(args.regex, repr(cp.extract_required_literal(args.regex))))
+        for name, watcher_class in [('findall', FindallProgressWatcher), ('prefilter', cp.ProgressWatcher)]:
+            watcher = watcher_class(file_name, name, cp.ProgressSequenceCounter(), args.max_bytes_read_per_line,
+                                    args.regex, Event(), Event(), Event())
+            start_wall_time = time.perf_counter()
+            start_cpu_time = time.process_time()
+            num_states = consume_progress_states(watcher, num_lines)
+            report(name, num_lines, num_bytes, time.perf_counter() - start_wall_time,
+                   time.process_time() - start_cpu_time, progress_states=num_states)
+    finally:
+        tu.cleanup_file(file_name)
+
+
+class SyntheticOutputWriter(object):
+    """Appends lines to a file at a configurable rate, every progress message carries the time it was written."""
+
+    def __init__(self, file_name, duration_secs, lines_per_sec, line_length, progress_every):
+        self.file_name = file_name
+        self.duration_secs = duration_secs
+        self.lines_per_sec = lines_per_sec
+        self.line_length = line_length
+        self.progress_every = max(progress_every, 1)
+        self.num_lines = 0
+        self.num_bytes = 0
+        self.cpu_time_secs = 0
+        self.completed_event = Event()
+
+    def next_lines(self, count, elapsed_secs):
+        """Returns the next count lines, every progress_every-th line is a progress message."""
+        percent = min(int(100 * elapsed_secs / self.duration_secs), 100)
+        lines = []
+        for line_number in range(self.num_lines, self.num_lines + count):
+            if (line_number + 1) % self.progress_every == 0:
+                lines.append('progress: {}, written-at {:.6f}\n'.format(percent, time.time()))
+            else:
+                lines.append('{} {}\n'.format(line_number, 'x' * self.line_length)[-self.line_length - 1:])
+        return ''.join(lines)
+
+    def write(self):
+        """Writes lines in batches every 10 ms until duration_secs have elapsed, lines_per_sec of 0 means unlimited."""
+        batch_interval_secs = 0.01
+        start_time = time.perf_counter()
+        with open(self.file_name, 'a') as output_file:
+            elapsed_secs = 0
+            while elapsed_secs < self.duration_secs:
+                if self.lines_per_sec > 0:
+                    batch_size = int(self.lines_per_sec * elapsed_secs) + 1 - self.num_lines
+                else:
+                    batch_size = self.progress_every * 10
+                if batch_size > 0:
+                    data = self.next_lines(batch_size, elapsed_secs)
+                    output_file.write(data)
+                    output_file.flush()
+                    self.num_lines += batch_size
+                    self.num_bytes += len(data)
+                if self.lines_per_sec > 0:
+                    time.sleep(batch_interval_secs)
+                elapsed_secs = time.perf_counter() - start_time
+        self.cpu_time_secs = time.thread_time()
+        self.completed_event.set()
+
+    def start(self):
+        writer_thread = Thread(target=self.write, args=())
+        writer_thread.daemon = True
+        writer_thread.start()
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at fraction (between 0 and 1) of sorted_values using the nearest-rank method."""
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def run_progress_pipeline_benchmark(args):
+    """Measures the throughput, cpu time, memory and progress latency of tracking progress from synthetic files."""
+    file_names = [tu.ensure_directory('build/benchmark_progress_pipeline.{}'.format(tu.get_random_task_id()))
+                  for _ in range(args.locations)]
+    latencies_ms = []
+    messages = []
+
+    def send_progress_message(message):
+        written_at = message['progress-message'].rpartition('written-at ')[2]
+        latencies_ms.append(1000 * (time.time() - float(written_at)))
+        messages.append(message)
+        return True
+
+    try:
+        for file_name in file_names:
+            open(file_name, 'w').close()
+        config = tu.FakeExecutorConfig({'max_bytes_read_per_line': args.max_bytes_read_per_line,
+                                        'progress_coalesce': args.coalesce,
+                                        'progress_format': cp.PROGRESS_FORMAT_REGEX,
+                                        'progress_regex_string': args.regex,
+                                        'progress_tail_mode': args.tail_mode})
+        stop_signal = Event()
+        task_completed_signal = Event()
+        progress_updater = cp.ProgressUpdater('benchmark-task', 512, args.sample_interval_ms, send_progress_message)
+        locations = [(file_name, 'location-{}'.format(index)) for index, file_name in enumerate(file_names)]
+        tracker = cp.MultiplexedProgressTracker(config, stop_signal, task_completed_signal,
+                                                cp.ProgressSequenceCounter(), progress_updater, Event(), locations,
+                                                lambda os_error: stop_signal.set())
+        writers = [SyntheticOutputWriter(file_name, args.duration_secs, args.lines_per_sec, args.line_length,
+                                         args.progress_every)
+                   for file_name in file_names]
+
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        tracker.start()
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.completed_event.wait()
+        num_lines = sum(writer.num_lines for writer in writers)
+        while sum(watcher.line_count for watcher in tracker.watchers) < num_lines and not stop_signal.is_set():
+            time.sleep(0.01)
+        task_completed_signal.set()
+        tracker.wake_up()
+        tracker.wait()
+        wall_time_secs = time.perf_counter() - start_wall_time
+        # the cpu time of the writer threads is not part of the cost of tracking progress
+        cpu_time_secs = time.process_time() - start_cpu_time - sum(writer.cpu_time_secs for writer in writers)
+
+        latencies_ms.sort()
+        lines_per_sec = num_lines / wall_time_secs
+        report('progress-pipeline', num_lines, sum(writer.num_bytes for writer in writers), wall_time_secs,
+               cpu_time_secs, locations=args.locations, messages_sent=len(messages),
+               peak_rss_mb='{:.1f}'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        print('progress latency ({} messages): median={:.1f} ms, p99={:.1f} ms, max={:.1f} ms'.format(
+            len(latencies_ms), percentile(latencies_ms, 0.5), percentile(latencies_ms, 0.99),
+            percentile(latencies_ms, 1)))
+        print('progress updater counters: {}'.format(progress_updater.counters.snapshot()))
+
+        failures = []
+        if args.min_lines_per_sec and lines_per_sec < args.min_lines_per_sec:
+            failures.append('{:,.0f} lines/sec is below {:,}'.format(lines_per_sec, args.min_lines_per_sec))
+        if args.max_latency_ms and latencies_ms and percentile(latencies_ms, 0.99) > args.max_latency_ms:
+            failures.append('p99 latency of {:.1f} ms exceeds {} ms'.format(percentile(latencies_ms, 0.99),
+                                                                         args.max_latency_ms))
+        if failures:
+            print('FAILED: {}'.format('; '.join(failures)))
+            sys.exit(1)
+    finally:
+        for file_name in file_names:
+            tu.cleanup_file(file_name)
+
+
+# Launches a task in a fresh interpreter, with the imports of cook.__main__, and prints when TASK_RUNNING is sent
+STARTUP_CHILD_SCRIPT = '''
+import json
+import os
+import time
+from threading import Event
+
+import cook.__main__
+import cook
+import cook.config as cc
+import cook.executor as ce
+import pymesos as pm
+
+
+class TimingDriver(object):
+    def sendFrameworkMessage(self, message):
+        pass
+
+    def sendStatusUpdate(self, status):
+        if status['state'] == cook.TASK_RUNNING:
+            os.write(2, 'task-running-time={}\\n'.format(time.time()).encode())
+
+
+config = cc.initialize_config(os.environ)
+executor = ce.CookExecutor(Event(), config)
+task = {'task_id': {'value': 'startup-benchmark'},
+        'data': pm.encode_data(json.dumps({'command': 'true'}).encode('utf8'))}
+executor.launchTask(TimingDriver(), task)
+executor.await_completion()
+'''
+
+
+def measure_time_to_task_running(environment):
+    """Runs the startup child script and returns the secs from launching its interpreter until TASK_RUNNING."""
+    start_time = time.time()
+    completed = subprocess.run([sys.executable, '-c', STARTUP_CHILD_SCRIPT], env=environment,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    for line in completed.stderr.decode().splitlines():
+        if line.startswith('task-running-time='):
+            return float(line.split('=', 1)[1]) - start_time
+    raise Exception('TASK_RUNNING was not sent: {}'.format(completed.stderr.decode()))
+
+
+def run_startup_benchmark(args):
+    """Measures the time from starting the executor's interpreter until the task is reported as TASK_RUNNING."""
+    sandbox_directory = tu.ensure_directory('build/benchmark_startup.{}/'.format(tu.get_random_task_id()))
+    environment = dict(os.environ,
+                       MESOS_SANDBOX=sandbox_directory,
+                       PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get('PYTHONPATH')])))
+    try:
+        times_ms = [1000 * measure_time_to_task_running(environment) for _ in range(args.runs)]
+        print('time-to-TASK_RUNNING ({} runs): min={:.1f} ms, median={:.1f} ms, max={:.1f} ms'.format(
+            args.runs, min(times_ms), statistics.median(times_ms), max(times_ms)))
+    finally:
+        shutil.rmtree(sandbox_directory, ignore_errors=True)
+
+
+def run_launch_benchmark(args):
+    """Measures the number of short tasks per sec the executor can launch, and reap, while holding ballast memory."""
+    # the executor's memory footprint determines the cost of forking it, the ballast emulates a larger executor
+    ballast = bytearray(args.ballast_mb * 1024 * 1024)
+    for index in range(0, len(ballast), 4096):
+        ballast[index] = 1
+
+    def launch_with_preexec_fn(command, environment):
+        return subprocess.Popen(command, bufsize=0, env=environment, preexec_fn=os.setsid, shell=True,
+                                stderr=sys.stderr, stdout=sys.stdout)
+
+    environment = dict(os.environ)
+    for name, launch_fn in [('preexec-setsid', launch_with_preexec_fn), ('launch-process', cs.launch_process)]:
+        start_wall_time = time.perf_counter()
+        start_cpu_time = time.process_time()
+        running_processes = []
+        for _ in range(args.tasks):
+            running_processes.append(launch_fn(args.command, environment))
+            if len(running_processes) >= args.concurrency:
+                running_processes.pop(0).wait()
+        for process in running_processes:
+            process.wait()
+        wall_time_secs = time.perf_counter() - start_wall_time
+        print('{}: {:,.0f} tasks/sec, wall={:.2f}s, cpu={:.2f}s, ballast={} MB'.format(
+            name, args.tasks / wall_time_secs, wall_time_secs, time.process_time() - start_cpu_time, args.ballast_mb))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs benchmarks for the cook executor.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    match_parser = subparsers.add_parser('progress-match', help=run_progress_match_benchmark.__doc__)
+    match_parser.add_argument('--size-mb', type=int, default=256, help='size of the synthetic stdout file')
+    match_parser.add_argument('--line-length', type=int, default=80, help='length of the non-progress lines')
+    match_parser.add_argument('--progress-every', type=int, default=1000, help='lines between progress messages')
+    match_parser.add_argument('--max-bytes-read-per-line', type=int, default=4 * 1024)
+    match_parser.add_argument('--regex', default=DEFAULT_PROGRESS_REGEX, help='the progress regex')
+    match_parser.set_defaults(run=run_progress_match_benchmark)
+
+    pipeline_parser = subparsers.add_parser('progress-pipeline', help=run_progress_pipeline_benchmark.__doc__)
+    pipeline_parser.add_argument('--duration-secs', type=float, default=10, help='time spent writing output')
+    pipeline_parser.add_argument('--lines-per-sec', type=int, default=100000,
+                                 help='lines written per sec to each location, 0 writes as fast as possible')
+    pipeline_parser.add_argument('--line-length', type=int, default=80, help='length of the non-progress lines')
+    pipeline_parser.add_argument('--progress-every', type=int, default=1000, help='lines between progress messages')
+    pipeline_parser.add_argument('--locations', type=int, default=3, help='number of files written and tracked')
+    pipeline_parser.add_argument('--max-bytes-read-per-line', type=int, default=4 * 1024)
+    pipeline_parser.add_argument('--sample-interval-ms', type=int, default=1000,
+                                 help='min interval between progress messages sent to the driver')
+    pipeline_parser.add_argument('--no-coalesce', dest='coalesce', action='store_false',
+                                 help='create a progress state for every match')
+    pipeline_parser.add_argument('--tail-mode', default=ci.TAIL_MODE_INOTIFY,
+                                 choices=[ci.TAIL_MODE_INOTIFY, ci.TAIL_MODE_POLL])
+    pipeline_parser.add_argument('--regex', default=DEFAULT_PROGRESS_REGEX, help='the progress regex')
+    pipeline_parser.add_argument('--min-lines-per-sec', type=int, default=0,
+                                 help='fail when the throughput is lower, 0 disables the check')
+    pipeline_parser.add_argument('--max-latency-ms', type=float, default=0,
+                                 help='fail when the p99 progress latency is higher, 0 disables the check')
+    pipeline_parser.set_defaults(run=run_progress_pipeline_benchmark)
+
+    startup_parser = subparsers.add_parser('startup', help=run_startup_benchmark.__doc__)
+    startup_parser.add_argument('--runs', type=int, default=20, help='number of executor startups to measure')
+    startup_parser.set_defaults(run=run_startup_benchmark)
+
+    launch_parser = subparsers.add_parser('launch', help=run_launch_benchmark.__doc__)
+    launch_parser.add_argument('--tasks', type=int, default=1000, help='number of tasks to launch')
+    launch_parser.add_argument('--concurrency', type=int, default=16, help='max number of tasks running at once')
+    launch_parser.add_argument('--command', default='true', help='the command run by every task')
+    launch_parser.add_argument('--ballast-mb', type=int, default=256, help='memory held by the launching process')
+    launch_parser.set_defaults(run=run_launch_benchmark)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
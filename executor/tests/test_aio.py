@@ -0,0 +1,168 @@
+import json
+import time
+import unittest
+from threading import Event
+
+import pymesos as pm
+
+import cook
+import cook.aio as ca
+import cook.config as cc
+import cook.inotify as ci
+import cook.subprocess as cs
+import cook.util as cu
+import tests.utils as tu
+
+
+class AioTest(unittest.TestCase):
+    def setUp(self):
+        self.runtime = ca.AsyncRuntime()
+        self.runtime.start()
+
+    def tearDown(self):
+        self.runtime.stop()
+
+    def run_coroutine(self, coroutine, timeout_secs=10):
+        return self.runtime.submit(coroutine).result(timeout_secs)
+
+    def test_loop_timer_service(self):
+        timer_service = self.runtime.timer_service
+        runs = []
+        completed = Event()
+        timer_service.schedule(0.1, lambda: (runs.append('b'), completed.set()), 'b')
+        timer_service.schedule(0, lambda: runs.append('a'), 'a')
+        timer_service.schedule(0.05, lambda: runs.append('cancelled'), 'cancelled').cancel()
+
+        periodic_runs = []
+        periodic_task = timer_service.schedule_periodic(0.01, lambda: periodic_runs.append(1), 'periodic',
+                                                        initial_delay_secs=0)
+
+        self.assertTrue(completed.wait(timeout=5))
+        periodic_task.cancel()
+        self.assertEqual(['a', 'b'], runs)
+        self.assertGreater(len(periodic_runs), 1)
+        self.assertNotIn('cancelled', timer_service.statistics)
+        self.assertEqual(1, timer_service.statistics['a'].runs)
+
+        event = cu.NotifyingEvent()
+        watched = Event()
+        timer_service.watch_event(event, watched.set, 'watch')
+        self.assertFalse(watched.wait(timeout=0.05))
+        event.set()
+        self.assertTrue(watched.wait(timeout=5))
+
+    def test_await_process_exit(self):
+        process = cs.launch_process('sleep 0.2; exit 3', {})
+        start_time = time.time()
+        self.assertEqual(3, self.run_coroutine(ca.await_process_exit(process)))
+        self.assertGreaterEqual(time.time() - start_time, 0.15)
+        self.assertEqual(3, process.returncode)
+
+    def test_await_process_exit_without_pidfd(self):
+        process = cs.launch_process('sleep 0.2; exit 4', {})
+        open_pidfd = cs.open_pidfd
+        try:
+            cs.open_pidfd = lambda _: None
+            self.assertEqual(4, self.run_coroutine(ca.await_process_exit(process)))
+        finally:
+            cs.open_pidfd = open_pidfd
+
+    def test_await_notifier_change(self):
+        notifier = ci.create_notifier(ci.TAIL_MODE_INOTIFY, 100)
+        try:
+            start_time = time.time()
+            self.run_coroutine(ca.await_notifier_change(notifier, timeout_ms=50))
+            self.assertGreaterEqual(time.time() - start_time, 0.04)
+
+            # wake() interrupts the wait without waiting for the timeout
+            notifier.wake()
+            start_time = time.time()
+            self.run_coroutine(ca.await_notifier_change(notifier, timeout_ms=5000))
+            self.assertLess(time.time() - start_time, 1)
+            self.assertEqual(2, notifier.wakeup_count)
+        finally:
+            notifier.close()
+
+    def test_message_sender(self):
+        messages = []
+        message_sender = ca.AsyncMessageSender(lambda message: messages.append(message) or True, 2,
+                                               self.runtime.loop)
+        message_sender.start()
+
+        async def send_messages():
+            message_sender.send({'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'})
+            # queued progress messages are superseded before the sending coroutine runs
+            for sequence in range(1, 4):
+                message_sender.send({'progress-sequence': sequence, 'task-id': 'a'})
+            message_sender.send({'exit-code': 0, 'task-id': 'a'})
+            return await message_sender.stop_async(timeout_secs=5)
+
+        self.assertTrue(self.run_coroutine(send_messages()))
+        self.assertEqual([{'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'},
+                          {'progress-sequence': 3, 'task-id': 'a'},
+                          {'exit-code': 0, 'task-id': 'a'}],
+                         messages)
+        self.assertEqual(2, message_sender.counters.get('superseded'))
+        self.assertFalse(message_sender.send({'exit-code': 1, 'task-id': 'a'}))
+
+    def manage_task_runner(self, command, stop_signal=None):
+        driver = tu.FakeMesosExecutorDriver()
+        stop_signal = stop_signal or cu.NotifyingEvent()
+        task_id = tu.get_random_task_id()
+        task = {'task_id': {'value': task_id},
+                'data': pm.encode_data(json.dumps({'command': command}).encode('utf8'))}
+
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        config = cc.ExecutorConfig(max_message_length=300,
+                                   progress_output_name=stdout_name,
+                                   progress_regex_string=r'\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)',
+                                   progress_sample_interval_ms=100,
+                                   sandbox_directory='/location/to/task/sandbox/{}'.format(task_id))
+        try:
+            executor = ca.AsyncCookExecutor(stop_signal, config, self.runtime)
+            executor.launchTask(driver, task)
+            self.assertTrue(executor.completed_signal.wait(timeout=30))
+            return driver, task_id, config.sandbox_directory
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
+
+    def test_manage_task_successful_exit_with_progress_message(self):
+        command = 'echo "Hello World"; ' \
+                  'echo "^^^^JOB-PROGRESS: 50 Fifty percent"; ' \
+                  'sleep 0.2; ' \
+                  'echo "^^^^JOB-PROGRESS: 54.8 Fifty-five percent"; ' \
+                  'sleep 0.1; ' \
+                  'exit 0'
+        driver, task_id, sandbox_directory = self.manage_task_runner(command)
+
+        expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_STARTING},
+                             {'task_id': {'value': task_id}, 'state': cook.TASK_RUNNING},
+                             {'task_id': {'value': task_id}, 'state': cook.TASK_FINISHED}]
+        tu.assert_statuses(self, expected_statuses, driver.statuses)
+
+        expected_core_messages = [{'sandbox-directory': sandbox_directory, 'task-id': task_id, 'type': 'directory'},
+                                  {'exit-code': 0, 'task-id': task_id}]
+        expected_progress_messages = [{'progress-message': 'Fifty percent',
+                                       'progress-percent': 50, 'progress-sequence': 1, 'task-id': task_id},
+                                      {'progress-message': 'Fifty-five percent',
+                                       'progress-percent': 55, 'progress-sequence': 2, 'task-id': task_id}]
+        tu.assert_messages(self, expected_core_messages, expected_progress_messages, driver.messages)
+
+    def test_manage_task_terminated(self):
+        stop_signal = cu.NotifyingEvent()
+        self.runtime.timer_service.schedule(1, stop_signal.set, 'stop')
+        driver, task_id, sandbox_directory = self.manage_task_runner('sleep 100', stop_signal=stop_signal)
+
+        expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_STARTING},
+                             {'task_id': {'value': task_id}, 'state': cook.TASK_RUNNING},
+                             {'task_id': {'value': task_id}, 'state': cook.TASK_KILLED}]
+        tu.assert_statuses(self, expected_statuses, driver.statuses)
+
+        expected_messages = [{'sandbox-directory': sandbox_directory, 'task-id': task_id, 'type': 'directory'},
+                             {'exit-code': -15, 'task-id': task_id}]
+        tu.assert_messages(self, expected_messages, [], driver.messages)
+        self.assertIn('stop-signal-watch', self.runtime.timer_service.statistics)
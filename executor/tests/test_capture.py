@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import unittest
+from threading import Event
+
+import cook.capture as ccap
+import cook.config as cc
+import cook.progress as cp
+import cook.subprocess as cs
+import tests.utils as tu
+
+
+class CaptureTest(unittest.TestCase):
+    def create_watcher(self, location_tag, progress_regex_string='progress: ([0-9]+) (.*)'):
+        return cp.ProgressWatcher('<{} pipe>'.format(location_tag), location_tag, cp.ProgressSequenceCounter(), 16,
+                                  progress_regex_string, Event(), Event(), Event())
+
+    def test_captured_stream(self):
+        read_fd, write_fd = os.pipe()
+        copied_chunks = []
+        stream = ccap.CapturedStream(os.fdopen(read_fd, 'rb', buffering=0), copied_chunks.append,
+                                     self.create_watcher('stdout'), 64)
+        try:
+            self.assertIsNone(next(stream.progress_states))
+
+            os.write(write_fd, b'hello\nprogress: 25 quarter\n')
+            self.assertTrue(stream.read())
+            progress = next(stream.progress_states)
+            self.assertEqual(25, progress.percent)
+            self.assertEqual(b'quarter', progress.message)
+            self.assertIsNone(next(stream.progress_states))
+
+            os.write(write_fd, b'progress: 50 half\n')
+            os.close(write_fd)
+            write_fd = None
+            self.assertTrue(stream.read())
+            self.assertFalse(stream.read())
+            progress_states = list(stream.progress_states)
+            self.assertEqual([(50, b'half')], [(progress.percent, progress.message) for progress in progress_states])
+
+            self.assertEqual(b'hello\nprogress: 25 quarter\nprogress: 50 half\n', b''.join(copied_chunks))
+            self.assertEqual(45, stream.byte_count)
+            self.assertEqual(3, stream.watcher.line_count)
+        finally:
+            if write_fd is not None:
+                os.close(write_fd)
+            stream.close()
+
+    def test_is_captured_location(self):
+        task_id = tu.get_random_task_id()
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+        other_name = tu.ensure_directory('build/other.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+        try:
+            with open(other_name, 'w'):
+                pass
+            config = cc.ExecutorConfig(sandbox_directory='/sandbox/{}'.format(task_id))
+            self.assertTrue(ccap.is_captured_location(config.stdout_file(), config))
+            self.assertTrue(ccap.is_captured_location(config.stderr_file(), config))
+            self.assertTrue(ccap.is_captured_location(stdout_name, config))
+            self.assertTrue(ccap.is_captured_location(stderr_name, config))
+            self.assertFalse(ccap.is_captured_location(other_name, config))
+            self.assertFalse(ccap.is_captured_location('build/missing.{}'.format(task_id), config))
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
+            tu.cleanup_file(other_name)
+
+    def test_output_capture(self):
+        task_id = tu.get_random_task_id()
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+        try:
+            progress_messages = []
+            progress_updater = cp.ProgressUpdater(task_id, 100, 10, lambda message: progress_messages.append(message)
+                                                                                    or True)
+            config = cc.ExecutorConfig(progress_regex_string='progress: ([0-9]+) (.*)')
+            command = 'for i in $(seq 1000); do echo "line $i"; done; echo "progress: 40 forty" 1>&2; ' \
+                      'sleep 0.1; echo "progress: 60 sixty"'
+            process = cs.launch_process(command, {}, capture_output=True)
+            output_capture = ccap.OutputCapture(process, config, Event(), Event(), cp.ProgressSequenceCounter(),
+                                                progress_updater, Event(), tu.fake_os_error_handler)
+            output_capture.start()
+            process.wait()
+            output_capture.wait(timeout=10)
+
+            self.assertTrue(output_capture.progress_complete_event.is_set())
+            self.assertEqual([(40, 'forty', 1), (60, 'sixty', 2)],
+                             [(message['progress-percent'], message['progress-message'], message['progress-sequence'])
+                              for message in progress_messages])
+            sys.stdout.flush()
+            sys.stderr.flush()
+            with open(stdout_name) as stdout_file:
+                stdout_lines = stdout_file.read().splitlines()
+                self.assertEqual(['line {}'.format(i) for i in range(1, 1001)] + ['progress: 60 sixty'], stdout_lines)
+            with open(stderr_name) as stderr_file:
+                self.assertEqual('progress: 40 forty\n', stderr_file.read())
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
+
+    def test_output_capture_woken_up_by_termination(self):
+        task_id = tu.get_random_task_id()
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+        process = None
+        try:
+            progress_updater = cp.ProgressUpdater(task_id, 100, 10, lambda message: True)
+            config = cc.ExecutorConfig(progress_regex_string='progress: ([0-9]+) (.*)')
+            process = cs.launch_process('sleep 100', {}, capture_output=True)
+            progress_termination_signal = Event()
+            output_capture = ccap.OutputCapture(process, config, Event(), Event(), cp.ProgressSequenceCounter(),
+                                                progress_updater, progress_termination_signal,
+                                                tu.fake_os_error_handler)
+            output_capture.start()
+            time.sleep(0.2)
+            self.assertFalse(output_capture.progress_complete_event.is_set())
+
+            # the task still holds the pipes open, the thread only returns as it is woken up
+            progress_termination_signal.set()
+            start_time = time.time()
+            output_capture.wake_up()
+            output_capture.wait(timeout=5)
+            self.assertTrue(output_capture.progress_complete_event.is_set())
+            self.assertLess(time.time() - start_time, 0.5)
+            # the wakeup pipe has been released
+            output_capture.wake_up()
+        finally:
+            if process:
+                process.kill()
+                process.wait()
+            tu.cleanup_output(stdout_name, stderr_name)
@@ -57,11 +57,120 @@ class ConfigTest(unittest.TestCase):
 
         self.assertEqual(4 * 1024, config.max_bytes_read_per_line)
         self.assertEqual(512, config.max_message_length)
+        self.assertEqual(64, config.message_queue_size)
+        self.assertEqual('', config.metrics_socket_path)
+        self.assertFalse(config.multi_task)
+        self.assertEqual(60, config.multi_task_idle_timeout_secs)
+        self.assertEqual('inherit', config.output_capture_mode)
+        self.assertEqual(100, config.output_flush_interval_ms)
+        self.assertTrue(config.progress_coalesce)
         self.assertEqual('executor.progress', config.progress_output_name)
         self.assertEqual('progress: ([0-9]*\\.?[0-9]+), (.*)', config.progress_regex_string)
         self.assertEqual(1000, config.progress_sample_interval_ms)
+        self.assertEqual(30000, config.progress_max_sample_interval_ms)
+        self.assertEqual(0, config.progress_max_updates_per_sec)
+        self.assertEqual(0, config.progress_min_percent_delta)
+        self.assertEqual('inotify', config.progress_tail_mode)
+        self.assertEqual(300, config.resource_report_interval_secs)
+        self.assertEqual(360, config.resource_sample_buffer_size)
+        self.assertEqual(10, config.resource_sample_interval_secs)
+        self.assertEqual('process-tree', config.resource_sample_source)
+        self.assertEqual('threads', config.runtime)
         self.assertEqual('', config.sandbox_directory)
         self.assertEqual(2000, config.shutdown_grace_period_ms)
+        self.assertEqual('', config.trace_file_path)
+
+    def test_initialize_config_progress_tail_mode(self):
+        self.assertEqual('poll', cc.initialize_config({'EXECUTOR_PROGRESS_TAIL_MODE': 'poll'}).progress_tail_mode)
+        self.assertEqual('inotify', cc.initialize_config({'EXECUTOR_PROGRESS_TAIL_MODE': 'inotify'}).progress_tail_mode)
+        self.assertEqual('inotify', cc.initialize_config({'EXECUTOR_PROGRESS_TAIL_MODE': 'unknown'}).progress_tail_mode)
+
+    def test_initialize_config_progress_coalesce(self):
+        self.assertTrue(cc.initialize_config({'EXECUTOR_PROGRESS_COALESCE': 'TRUE'}).progress_coalesce)
+        self.assertFalse(cc.initialize_config({'EXECUTOR_PROGRESS_COALESCE': 'false'}).progress_coalesce)
+
+    def test_initialize_config_resource_sample_source(self):
+        self.assertEqual('cgroup', cc.initialize_config({'EXECUTOR_RESOURCE_SAMPLE_SOURCE': 'cgroup'})
+                         .resource_sample_source)
+        self.assertEqual('process-tree', cc.initialize_config({'EXECUTOR_RESOURCE_SAMPLE_SOURCE': 'unknown'})
+                         .resource_sample_source)
+
+    def test_initialize_config_output_capture_mode(self):
+        self.assertEqual('pipe', cc.initialize_config({'EXECUTOR_OUTPUT_CAPTURE_MODE': 'pipe'}).output_capture_mode)
+        self.assertEqual('inherit', cc.initialize_config({'EXECUTOR_OUTPUT_CAPTURE_MODE': 'unknown'})
+                         .output_capture_mode)
+
+    def test_initialize_config_output_flush_interval(self):
+        self.assertEqual(0, cc.initialize_config({'EXECUTOR_OUTPUT_FLUSH_INTERVAL_MS': '0'}).output_flush_interval_ms)
+        self.assertEqual(250, cc.initialize_config({'EXECUTOR_OUTPUT_FLUSH_INTERVAL_MS': '250'})
+                         .output_flush_interval_ms)
+        self.assertEqual(0, cc.initialize_config({'EXECUTOR_OUTPUT_FLUSH_INTERVAL_MS': '-5'}).output_flush_interval_ms)
+        # the environment and the constructor share the default
+        self.assertEqual(cc.ExecutorConfig().output_flush_interval_ms,
+                         cc.initialize_config({}).output_flush_interval_ms)
+
+    def test_initialize_config_progress_format(self):
+        self.assertEqual('regex', cc.initialize_config({}).progress_format)
+        self.assertEqual('json', cc.initialize_config({'EXECUTOR_PROGRESS_FORMAT': 'json'}).progress_format)
+        self.assertEqual('regex', cc.initialize_config({'EXECUTOR_PROGRESS_FORMAT': 'unknown'}).progress_format)
+
+    def test_initialize_config_metrics_socket(self):
+        self.assertEqual('metrics.sock', cc.initialize_config({'EXECUTOR_METRICS_SOCKET': 'metrics.sock'})
+                         .metrics_socket_path)
+        self.assertEqual('/sandbox/metrics.sock',
+                         cc.initialize_config({'EXECUTOR_METRICS_SOCKET': 'metrics.sock', 'MESOS_SANDBOX': '/sandbox'})
+                         .metrics_socket_path)
+        self.assertEqual('/tmp/metrics.sock',
+                         cc.initialize_config({'EXECUTOR_METRICS_SOCKET': '/tmp/metrics.sock',
+                                               'MESOS_SANDBOX': '/sandbox'}).metrics_socket_path)
+
+    def test_initialize_config_trace_file(self):
+        self.assertEqual('/sandbox/executor.trace',
+                         cc.initialize_config({'EXECUTOR_TRACE_FILE': 'executor.trace', 'MESOS_SANDBOX': '/sandbox'})
+                         .trace_file_path)
+
+    def test_initialize_config_multi_task(self):
+        config = cc.initialize_config({'EXECUTOR_MULTI_TASK': 'true',
+                                       'EXECUTOR_MULTI_TASK_IDLE_TIMEOUT_SECS': '30',
+                                       'EXECUTOR_OUTPUT_CAPTURE_MODE': 'inherit',
+                                       'EXECUTOR_RUNTIME': 'asyncio',
+                                       'MESOS_SANDBOX': '/sandbox/location'})
+        self.assertTrue(config.multi_task)
+        self.assertEqual(30, config.multi_task_idle_timeout_secs)
+        self.assertEqual('pipe', config.output_capture_mode)
+        self.assertEqual('threads', config.runtime)
+        self.assertEqual(0, cc.initialize_config({'EXECUTOR_MULTI_TASK_IDLE_TIMEOUT_SECS': '-5'})
+                         .multi_task_idle_timeout_secs)
+
+        task_config = config.task_config('task-1')
+        self.assertEqual('/sandbox/location/task-1.progress', task_config.progress_output_name)
+        self.assertEqual('/sandbox/location/executor.progress', config.progress_output_name)
+        self.assertEqual(config.sandbox_directory, task_config.sandbox_directory)
+
+    def test_initialize_config_adaptive_progress_sampling(self):
+        config = cc.initialize_config({'EXECUTOR_PROGRESS_MAX_SAMPLE_INTERVAL_MS': '60000',
+                                       'EXECUTOR_PROGRESS_MAX_UPDATES_PER_SEC': '2.5',
+                                       'EXECUTOR_PROGRESS_MIN_PERCENT_DELTA': '5'})
+        self.assertEqual(60000, config.progress_max_sample_interval_ms)
+        self.assertEqual(2.5, config.progress_max_updates_per_sec)
+        self.assertEqual(5, config.progress_min_percent_delta)
+        # the max sample interval is never smaller than the sample interval
+        self.assertEqual(5000, cc.initialize_config({'EXECUTOR_PROGRESS_MAX_SAMPLE_INTERVAL_MS': '10',
+                                                     'PROGRESS_SAMPLE_INTERVAL_MS': '5000'})
+                         .progress_max_sample_interval_ms)
+
+    def test_initialize_config_runtime(self):
+        self.assertEqual('asyncio', cc.initialize_config({'EXECUTOR_RUNTIME': 'asyncio'}).runtime)
+        self.assertEqual('threads', cc.initialize_config({'EXECUTOR_RUNTIME': 'threads'}).runtime)
+        self.assertEqual('threads', cc.initialize_config({'EXECUTOR_RUNTIME': 'unknown'}).runtime)
+
+        # output captured using pipes is only supported by the threads runtime
+        config = cc.initialize_config({'EXECUTOR_OUTPUT_CAPTURE_MODE': 'pipe', 'EXECUTOR_RUNTIME': 'asyncio'})
+        self.assertEqual('pipe', config.output_capture_mode)
+        self.assertEqual('threads', config.runtime)
+        config = cc.initialize_config({'EXECUTOR_OUTPUT_CAPTURE_MODE': 'inherit', 'EXECUTOR_RUNTIME': 'asyncio'})
+        self.assertEqual('inherit', config.output_capture_mode)
+        self.assertEqual('asyncio', config.runtime)
 
     def test_initialize_config_custom(self):
         environment = {'EXECUTOR_MAX_BYTES_READ_PER_LINE': '1234',
@@ -13,7 +13,10 @@ import pymesos as pm
 import cook
 import cook.config as cc
 import cook.executor as ce
+import cook.messaging as cm
+import cook.progress as cp
 import cook.subprocess as cs
+import cook.util as cu
 import tests.utils as tu
 
 
@@ -123,7 +126,7 @@ class ExecutorTest(unittest.TestCase):
         driver = tu.FakeMesosExecutorDriver()
         task_id = tu.get_random_task_id()
         status_updater = ce.StatusUpdater(driver, task_id)
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         inner_os_error_handler = functools.partial(ce.os_error_handler, stop_signal, status_updater)
 
         inner_os_error_handler(OSError(errno.ENOMEM, 'No Memory'))
@@ -138,7 +141,7 @@ class ExecutorTest(unittest.TestCase):
         driver = tu.FakeMesosExecutorDriver()
         task_id = tu.get_random_task_id()
         status_updater = ce.StatusUpdater(driver, task_id)
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         os_error = OSError(errno.ENOMEM, 'No Memory')
 
         ce.os_error_handler(stop_signal, status_updater, os_error)
@@ -153,7 +156,7 @@ class ExecutorTest(unittest.TestCase):
         driver = tu.FakeMesosExecutorDriver()
         task_id = tu.get_random_task_id()
         status_updater = ce.StatusUpdater(driver, task_id)
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         os_error = OSError(errno.EPERM, 'No Permission')
 
         ce.os_error_handler(stop_signal, status_updater, os_error)
@@ -162,6 +165,27 @@ class ExecutorTest(unittest.TestCase):
         expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_FAILED}]
         tu.assert_statuses(self, expected_statuses, driver.statuses)
 
+    def test_collect_task_metrics(self):
+        task_id = tu.get_random_task_id()
+        watcher = cp.ProgressWatcher('<fragments>', 'stdout', cp.ProgressSequenceCounter(), 1024, 'progress: ([0-9]+)',
+                                     Event(), Event(), Event())
+        fragments = [b'line 1\n', b'progress: 10\n', b'progress: 20\n']
+        watcher.fragment_count = watcher.line_count = len(fragments)
+        progress_states = list(watcher.retrieve_progress_states(fragments=fragments))
+        progress_updater = cp.ProgressUpdater(task_id, 512, 0, lambda message: True)
+        for progress_state in progress_states:
+            progress_updater.send_progress_update(progress_state)
+        message_sender = cm.MessageSender(lambda message: True)
+
+        samples = ce.collect_task_metrics(task_id, [watcher], progress_updater, message_sender)
+        sample_values = {(sample.name, tuple(sample.labels)): sample.value for sample in samples}
+        location_labels = (('task_id', task_id), ('location', 'stdout'))
+        self.assertEqual(3, sample_values[('progress_lines_read', location_labels)])
+        self.assertEqual(2, sample_values[('progress_lines_matched', location_labels)])
+        self.assertEqual(2, sample_values[('progress_updates', (('task_id', task_id), ('outcome', 'sent')))])
+        self.assertEqual(0, sample_values[('messages', (('task_id', task_id), ('outcome', 'sent')))])
+        self.assertEqual(0, sample_values[('message_queue_depth', (('task_id', task_id),))])
+
     def test_launch_task(self):
         task_id = tu.get_random_task_id()
         command = 'echo "Hello World"; echo "Error Message" >&2'
@@ -272,12 +296,15 @@ class ExecutorTest(unittest.TestCase):
             process = subprocess.Popen(command, preexec_fn=os.setpgrp, shell=True)
             shutdown_grace_period_ms = 1000
 
-            stop_signal = Event()
+            stop_signal = cu.NotifyingEvent()
 
-            ce.await_process_completion(process, stop_signal, shutdown_grace_period_ms)
+            start_time = time.time()
+            exit_time = ce.await_process_completion(process, stop_signal, shutdown_grace_period_ms)
 
             self.assertFalse(stop_signal.isSet())
             self.assertEqual(0, process.returncode)
+            self.assertGreaterEqual(exit_time - start_time, 2)
+            self.assertLessEqual(exit_time, time.time())
 
         finally:
             tu.cleanup_output(stdout_name, stderr_name)
@@ -296,7 +323,7 @@ class ExecutorTest(unittest.TestCase):
             process = subprocess.Popen(command, preexec_fn=os.setpgrp, shell=True)
             shutdown_grace_period_ms = 2000
 
-            stop_signal = Event()
+            stop_signal = cu.NotifyingEvent()
             sleep_and_set_stop_signal_task(stop_signal, 2)
 
             ce.await_process_completion(process, stop_signal, shutdown_grace_period_ms)
@@ -345,7 +372,7 @@ class ExecutorTest(unittest.TestCase):
         if driver is None:
             driver = tu.FakeMesosExecutorDriver()
         if stop_signal is None:
-            stop_signal = Event()
+            stop_signal = cu.NotifyingEvent()
         if task_id is None:
             task_id = tu.get_random_task_id()
 
@@ -380,7 +407,7 @@ class ExecutorTest(unittest.TestCase):
             tu.cleanup_output(stdout_name, stderr_name)
 
     def run_command_in_manage_task_runner(self, command, assertions, wait_time_secs):
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         sleep_and_set_stop_signal_task(stop_signal, wait_time_secs)
         self.manage_task_runner(command, assertions, stop_signal=stop_signal)
         stop_signal.set()
@@ -505,6 +532,77 @@ class ExecutorTest(unittest.TestCase):
                   'exit 0'
         self.manage_task_runner(command, assertions)
 
+    def test_manage_task_captured_output_with_progress_message(self):
+        def assertions(driver, task_id, sandbox_directory):
+            expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_STARTING},
+                                 {'task_id': {'value': task_id}, 'state': cook.TASK_RUNNING},
+                                 {'task_id': {'value': task_id}, 'state': cook.TASK_FINISHED}]
+            tu.assert_statuses(self, expected_statuses, driver.statuses)
+
+            expected_core_messages = [{'sandbox-directory': sandbox_directory, 'task-id': task_id, 'type': 'directory'},
+                                      {'exit-code': 0, 'task-id': task_id}]
+            expected_progress_messages = [{'progress-message': 'Fifty percent',
+                                           'progress-percent': 50, 'progress-sequence': 1, 'task-id': task_id},
+                                          {'progress-message': 'Fifty-five percent',
+                                           'progress-percent': 55, 'progress-sequence': 2, 'task-id': task_id}]
+            tu.assert_messages(self, expected_core_messages, expected_progress_messages, driver.messages)
+
+            with open(stdout_name) as stdout_file:
+                stdout_contents = stdout_file.read()
+                self.assertIn('Hello World', stdout_contents)
+                self.assertIn('^^^^JOB-PROGRESS: 50 Fifty percent', stdout_contents)
+                self.assertIn('Exiting...', stdout_contents)
+            with open(stderr_name) as stderr_file:
+                self.assertIn('Error output', stderr_file.read())
+
+        task_id = tu.get_random_task_id()
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+        config = cc.ExecutorConfig(max_message_length=300,
+                                   output_capture_mode='pipe',
+                                   progress_output_name=stdout_name,
+                                   progress_regex_string='\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)',
+                                   progress_sample_interval_ms=100,
+                                   sandbox_directory='/location/to/task/sandbox/{}'.format(task_id))
+        command = 'echo "Hello World"; ' \
+                  'echo "Error output" 1>&2; ' \
+                  'echo "^^^^JOB-PROGRESS: 50 Fifty percent"; ' \
+                  'sleep 0.2; ' \
+                  'echo "^^^^JOB-PROGRESS: 54.8 Fifty-five percent"; ' \
+                  'sleep 0.1; ' \
+                  'echo "Exiting..."; ' \
+                  'exit 0'
+        self.manage_task_runner(command, assertions, task_id=task_id, config=config)
+
+    def test_manage_task_reports_resource_usage(self):
+        def assertions(driver, task_id, sandbox_directory):
+            expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_STARTING},
+                                 {'task_id': {'value': task_id}, 'state': cook.TASK_RUNNING},
+                                 {'task_id': {'value': task_id}, 'state': cook.TASK_FINISHED}]
+            tu.assert_statuses(self, expected_statuses, driver.statuses)
+
+            messages = [tu.parse_message(message) for message in driver.messages]
+            resource_messages = [message for message in messages if message.get('type') == 'resource-usage']
+            self.assertEqual(1, len(resource_messages))
+            resource_usage = resource_messages[0]['resource-usage']
+            self.assertEqual(task_id, resource_messages[0]['task-id'])
+            self.assertEqual('process-tree', resource_usage['source'])
+            self.assertGreaterEqual(resource_usage['samples'], 2)
+            self.assertGreater(resource_usage['mem-mb-max'], 0)
+            self.assertGreaterEqual(resource_usage['processes-max'], 1)
+
+            expected_message_0 = {'sandbox-directory': sandbox_directory, 'task-id': task_id, 'type': 'directory'}
+            expected_message_1 = {'exit-code': 0, 'task-id': task_id}
+            self.assertEqual([expected_message_0, expected_message_1],
+                             [message for message in messages if message.get('type') != 'resource-usage'])
+
+        task_id = tu.get_random_task_id()
+        config = cc.ExecutorConfig(progress_output_name=tu.ensure_directory('build/stdout.{}'.format(task_id)),
+                                   resource_sample_interval_secs=1,
+                                   sandbox_directory='/location/to/task/sandbox/{}'.format(task_id))
+        command = 'echo "Hello World"; sleep 1.5'
+        self.manage_task_runner(command, assertions, task_id=task_id, config=config)
+
     def test_manage_task_erroneous_exit(self):
         def assertions(driver, task_id, sandbox_directory):
             expected_statuses = [{'task_id': {'value': task_id}, 'state': cook.TASK_STARTING},
@@ -542,7 +640,8 @@ class ExecutorTest(unittest.TestCase):
 
             expected_core_messages = [{'sandbox-directory': sandbox_directory, 'task-id': task_id, 'type': 'directory'},
                                       {'exit-code': 0, 'task-id': task_id}]
-            expected_progress_messages = [{'progress-message': '',
+            # the bytes which are not valid utf-8 are replaced in the progress message
+            expected_progress_messages = [{'progress-message': 'invalid \ufffd bytes',
                                            'progress-percent': 50, 'progress-sequence': 1, 'task-id': task_id}]
             tu.assert_messages(self, expected_core_messages, expected_progress_messages, driver.messages)
 
@@ -550,14 +649,13 @@ class ExecutorTest(unittest.TestCase):
             if not os.path.isfile(stdout_name):
                 self.fail('{} does not exist.'.format(stdout_name))
 
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         sleep_and_set_stop_signal_task(stop_signal, 60)
 
-        # progress string in file with binary data will be ignored
         command = 'echo "Hello"; ' \
                   'head -c 1000 /dev/random; ' \
                   'echo "force newline stage-1"; ' \
-                  'echo "^^^^JOB-PROGRESS: 50 `head -c 50 /dev/random`"; ' \
+                  'printf "^^^^JOB-PROGRESS: 50 invalid \\377 bytes\\n"; ' \
                   'echo "force newline stage-2"; ' \
                   'echo "Done"'
         self.manage_task_runner(command, assertions, stop_signal=stop_signal)
@@ -669,7 +767,7 @@ class ExecutorTest(unittest.TestCase):
             else:
                 self.fail('{} does not exist.'.format(stderr_name))
 
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         sleep_and_set_stop_signal_task(stop_signal, 60)
 
         # one order magnitude smaller than non-progress long tests above
@@ -699,7 +797,7 @@ class ExecutorTest(unittest.TestCase):
                                            'progress-percent': 65, 'progress-sequence': 4, 'task-id': task_id}]
             tu.assert_messages(self, expected_core_messages, expected_progress_messages, driver.messages)
 
-        stop_signal = Event()
+        stop_signal = cu.NotifyingEvent()
         sleep_and_set_stop_signal_task(stop_signal, 60)
 
         task_id = tu.get_random_task_id()
@@ -709,10 +807,19 @@ class ExecutorTest(unittest.TestCase):
 
         config = tu.FakeExecutorConfig({'max_bytes_read_per_line': 1024,
                                         'max_message_length': max_message_length,
+                                        'message_queue_size': 64,
+                                        'resource_sample_interval_secs': 0,
                                         'progress_output_env_variable': 'DEFAULT_PROGRESS_FILE_ENV_VARIABLE',
+                                        'output_capture_mode': 'inherit',
+                                        'progress_coalesce': True,
+                                        'progress_format': 'regex',
+                                        'progress_max_sample_interval_ms': 10,
+                                        'progress_max_updates_per_sec': 0,
+                                        'progress_min_percent_delta': 0,
                                         'progress_output_name': progress_name,
                                         'progress_regex_string': '\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)',
                                         'progress_sample_interval_ms': 10,
+                                        'progress_tail_mode': 'inotify',
                                         'sandbox_directory': '/sandbox/directory/for/{}'.format(task_id),
                                         'shutdown_grace_period_ms': 60000,
                                         'stderr_file': stderr_name,
@@ -748,7 +855,7 @@ class ExecutorTest(unittest.TestCase):
 
         try:
             config = cc.ExecutorConfig()
-            stop_signal = Event()
+            stop_signal = cu.NotifyingEvent()
             executor = ce.CookExecutor(stop_signal, config)
 
             driver = tu.FakeMesosExecutorDriver()
@@ -792,7 +899,7 @@ class ExecutorTest(unittest.TestCase):
 
         try:
             config = cc.ExecutorConfig()
-            stop_signal = Event()
+            stop_signal = cu.NotifyingEvent()
             executor = ce.CookExecutor(stop_signal, config)
 
             driver = tu.FakeMesosExecutorDriver()
@@ -837,3 +944,56 @@ class ExecutorTest(unittest.TestCase):
         finally:
             tu.cleanup_output(stdout_name, stderr_name)
             tu.cleanup_file(output_name)
+
+    def test_multi_task_executor_launch_and_kill_tasks(self):
+
+        task_id_1 = tu.get_random_task_id()
+        task_id_2 = tu.get_random_task_id()
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id_1))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id_1))
+        output_name = tu.ensure_directory('build/output.' + str(task_id_1))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        try:
+            config = cc.ExecutorConfig(multi_task=True, multi_task_idle_timeout_secs=1, output_capture_mode='pipe')
+            stop_signal = cu.NotifyingEvent()
+            executor = ce.MultiTaskCookExecutor(stop_signal, config)
+
+            driver = tu.FakeMesosExecutorDriver()
+            long_command = 'echo "Start" >> {}; sleep 100; echo "Done." >> {}; '.format(output_name, output_name)
+            for task_id, command in [(task_id_1, long_command), (task_id_2, 'echo "Short task"')]:
+                task = {'task_id': {'value': task_id},
+                        'data': pm.encode_data(json.dumps({'command': command}).encode('utf8'))}
+                executor.launchTask(driver, task)
+
+            def task_states(task_id):
+                return [status['state'] for status in driver.statuses if status['task_id']['value'] == task_id]
+
+            # the short task completes while the long task keeps running
+            for _ in range(1000):
+                time.sleep(0.01)
+                if cook.TASK_FINISHED in task_states(task_id_2) and cook.TASK_RUNNING in task_states(task_id_1):
+                    break
+            self.assertEqual([cook.TASK_STARTING, cook.TASK_RUNNING, cook.TASK_FINISHED], task_states(task_id_2))
+            self.assertEqual([cook.TASK_STARTING, cook.TASK_RUNNING], task_states(task_id_1))
+
+            executor.killTask(driver, {'value': task_id_1})
+            # the executor completes once its idle timeout expires after the killed task has completed
+            executor.await_completion()
+            self.assertTrue(executor.stop_signal.isSet())
+            self.assertEqual([cook.TASK_STARTING, cook.TASK_RUNNING, cook.TASK_KILLED], task_states(task_id_1))
+
+            with open(output_name) as f:
+                self.assertEqual('Start\n', f.read())
+
+            # tasks launched after the executor has completed are rejected
+            task_id_3 = tu.get_random_task_id()
+            task = {'task_id': {'value': task_id_3},
+                    'data': pm.encode_data(json.dumps({'command': 'true'}).encode('utf8'))}
+            executor.launchTask(driver, task)
+            self.assertEqual([cook.TASK_FAILED], task_states(task_id_3))
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
+            tu.cleanup_file(output_name)
@@ -0,0 +1,70 @@
+import time
+import unittest
+from threading import Thread
+
+import cook.inotify as ci
+import tests.utils as tu
+
+
+@unittest.skipUnless(ci.is_inotify_available(), 'inotify is not available')
+class InotifyTest(unittest.TestCase):
+    def test_await_change_on_creation_and_modification(self):
+        file_name = tu.ensure_directory('build/inotify_test.' + tu.get_random_task_id())
+        notifier = ci.InotifyNotifier(poll_interval_ms=10, idle_timeout_ms=5000)
+        try:
+            self.assertTrue(notifier.watch(file_name))
+            self.assertFalse(notifier.polling)
+
+            def create_and_modify_file():
+                time.sleep(0.05)
+                with open(file_name, 'w') as f:
+                    f.write('line\n')
+
+            Thread(target=create_and_modify_file, args=()).start()
+            start_time = time.time()
+            notifier.await_change()
+            self.assertLess(time.time() - start_time, 2)
+            self.assertEqual(1, len(notifier.file_watches))
+
+            Thread(target=create_and_modify_file, args=()).start()
+            start_time = time.time()
+            notifier.await_change()
+            self.assertLess(time.time() - start_time, 2)
+            self.assertEqual(2, notifier.wakeup_count)
+        finally:
+            notifier.close()
+            tu.cleanup_file(file_name)
+
+    def test_wake_interrupts_await_change(self):
+        file_name = tu.ensure_directory('build/inotify_test.' + tu.get_random_task_id())
+        notifier = ci.InotifyNotifier(poll_interval_ms=10, idle_timeout_ms=5000)
+        try:
+            self.assertTrue(notifier.watch(file_name))
+            notifier.wake()
+            start_time = time.time()
+            notifier.await_change()
+            self.assertLess(time.time() - start_time, 2)
+        finally:
+            notifier.close()
+        # waking up a closed notifier is a no-op
+        notifier.wake()
+
+    def test_watch_missing_directory_falls_back_to_polling(self):
+        notifier = ci.InotifyNotifier(poll_interval_ms=10, idle_timeout_ms=5000)
+        try:
+            self.assertFalse(notifier.watch('/path/does/not/exist/stdout'))
+            self.assertTrue(notifier.polling)
+            start_time = time.time()
+            notifier.await_change()
+            self.assertLess(time.time() - start_time, 2)
+        finally:
+            notifier.close()
+
+    def test_create_notifier(self):
+        polling_notifier = ci.create_notifier(ci.TAIL_MODE_POLL, 10)
+        self.assertIsInstance(polling_notifier, ci.PollingNotifier)
+        inotify_notifier = ci.create_notifier(ci.TAIL_MODE_INOTIFY, 10)
+        try:
+            self.assertIsInstance(inotify_notifier, ci.InotifyNotifier)
+        finally:
+            inotify_notifier.close()
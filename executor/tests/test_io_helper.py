@@ -0,0 +1,102 @@
+import io
+import os
+import time
+import unittest
+from threading import Thread
+
+import cook.io_helper as cio
+
+
+class CountingBuffer(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.write_count = 0
+        self.flush_count = 0
+
+    def write(self, data):
+        self.write_count += 1
+        return super().write(data)
+
+    def flush(self):
+        self.flush_count += 1
+        super().flush()
+
+
+class IoHelperTest(unittest.TestCase):
+    def test_encode_messages(self):
+        self.assertEqual(b'', cio.encode_messages([]))
+        self.assertEqual(b'abc', cio.encode_messages(['a', 'b', 'c']))
+        self.assertEqual(b'ab\x00c\xe2\x82\xac', cio.encode_messages(['a', b'b\x00', 'c', '€']))
+
+    def test_buffered_writer_flushes_every_write_without_interval(self):
+        buffer = CountingBuffer()
+        writer = cio.BufferedWriter(lambda: buffer, flush_interval_ms=0)
+        writer.write('line 1')
+        writer.write(b'line 2', newline=False)
+
+        self.assertEqual('line 1{}line 2'.format(os.linesep).encode(), buffer.getvalue())
+        self.assertEqual(2, buffer.write_count)
+        self.assertEqual(2, buffer.flush_count)
+
+    def test_buffered_writer_batches_writes_within_interval(self):
+        buffer = CountingBuffer()
+        writer = cio.BufferedWriter(lambda: buffer, flush_interval_ms=60000)
+        for index in range(10):
+            writer.write('line {}'.format(index))
+        self.assertEqual(b'', buffer.getvalue())
+        writer.flush_if_due()
+        self.assertEqual(b'', buffer.getvalue())
+
+        writer.write('line 10', flush=True)
+        expected_data = ''.join('line {}{}'.format(index, os.linesep) for index in range(11)).encode()
+        self.assertEqual(expected_data, buffer.getvalue())
+        self.assertEqual(1, buffer.write_count)
+        self.assertEqual(1, buffer.flush_count)
+        self.assertEqual(11, writer.write_count)
+        self.assertEqual(1, writer.flush_count)
+
+        writer.flush()
+        self.assertEqual(1, buffer.flush_count)
+
+    def test_buffered_writer_flushes_when_due(self):
+        buffer = CountingBuffer()
+        writer = cio.BufferedWriter(lambda: buffer, flush_interval_ms=50)
+        writer.write('line 1')
+        self.assertEqual(b'', buffer.getvalue())
+        time.sleep(0.1)
+        writer.flush_if_due()
+        self.assertEqual('line 1{}'.format(os.linesep).encode(), buffer.getvalue())
+
+    def test_buffered_writer_flushes_when_full(self):
+        buffer = CountingBuffer()
+        writer = cio.BufferedWriter(lambda: buffer, flush_interval_ms=60000, max_buffered_bytes=16)
+        writer.write(b'12345678', newline=False)
+        self.assertEqual(b'', buffer.getvalue())
+        writer.write(b'abcdefgh', newline=False)
+        self.assertEqual(b'12345678abcdefgh', buffer.getvalue())
+        self.assertEqual(1, buffer.flush_count)
+
+    def test_buffered_writer_keeps_messages_whole(self):
+        buffer = CountingBuffer()
+        writer = cio.BufferedWriter(lambda: buffer, flush_interval_ms=5, max_buffered_bytes=256)
+
+        def write_messages(prefix):
+            for index in range(200):
+                writer.write('{}-{}-{}'.format(prefix, index, prefix * 10))
+
+        threads = [Thread(target=write_messages, args=(prefix,)) for prefix in 'abcd']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+
+        lines = buffer.getvalue().decode().split(os.linesep)
+        self.assertEqual('', lines[-1])
+        self.assertEqual(800, len(lines) - 1)
+        for line in lines[:-1]:
+            prefix, index, suffix = line.split('-')
+            self.assertEqual(prefix * 10, suffix)
+        for prefix in 'abcd':
+            indices = [int(line.split('-')[1]) for line in lines[:-1] if line.startswith(prefix)]
+            self.assertEqual(list(range(200)), indices)
@@ -0,0 +1,45 @@
+import logging
+import time
+import unittest
+
+import cook.log_helper as clog
+
+
+class LogHelperTest(unittest.TestCase):
+    def test_rate_limited_logger(self):
+        rate_limited_logger = clog.RateLimitedLogger(interval_secs=0.2)
+        with self.assertLogs(level=logging.INFO) as captured_logs:
+            self.assertTrue(rate_limited_logger.info('key-1', 'First %s', 1))
+            self.assertFalse(rate_limited_logger.info('key-1', 'First %s', 2))
+            self.assertFalse(rate_limited_logger.info('key-1', 'First %s', 3))
+            self.assertTrue(rate_limited_logger.info('key-2', 'Second %s', 1))
+            time.sleep(0.25)
+            self.assertTrue(rate_limited_logger.info('key-1', 'First %s', 4))
+
+        self.assertEqual(['INFO:root:First 1',
+                          'INFO:root:Second 1',
+                          'INFO:root:First 4 (2 similar messages suppressed)'],
+                         captured_logs.output)
+
+    def test_rate_limited_logger_level_gated(self):
+        logger = logging.getLogger('test_rate_limited_logger_level_gated')
+        logger.setLevel(logging.WARNING)
+        rate_limited_logger = clog.RateLimitedLogger(logger=logger)
+
+        class FailingArgument(object):
+            def __str__(self):
+                raise AssertionError('Message should not be formatted')
+
+        self.assertFalse(rate_limited_logger.info('key', 'Message %s', FailingArgument()))
+        self.assertEqual({}, rate_limited_logger.last_logged_times)
+
+    def test_event_counters(self):
+        counters = clog.EventCounters()
+        self.assertEqual(0, counters.get('sent'))
+        counters.increment('sent')
+        counters.increment('throttled', 5)
+        counters.increment('sent')
+
+        self.assertEqual(2, counters.get('sent'))
+        self.assertEqual({'sent': 2, 'throttled': 5}, counters.snapshot())
+        self.assertEqual('sent=2, throttled=5', str(counters))
@@ -0,0 +1,117 @@
+import unittest
+from threading import Event
+
+import cook.messaging as cm
+
+
+class BlockingSender(object):
+    """Records sent messages, sends block until unblocked and fail for messages in fail_messages."""
+
+    def __init__(self, fail_messages=None):
+        self.fail_messages = fail_messages or []
+        self.messages = []
+        self.sending = Event()
+        self.unblocked = Event()
+
+    def send(self, message):
+        self.sending.set()
+        self.unblocked.wait()
+        self.messages.append(message)
+        return message not in self.fail_messages
+
+
+class MessagingTest(unittest.TestCase):
+    def test_is_progress_message(self):
+        self.assertTrue(cm.is_progress_message({'progress-sequence': 1, 'task-id': 'a'}))
+        self.assertFalse(cm.is_progress_message({'exit-code': 0, 'task-id': 'a'}))
+        self.assertFalse(cm.is_progress_message({'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'}))
+
+    def test_sends_messages_in_order(self):
+        sender = BlockingSender()
+        sender.unblocked.set()
+        message_sender = cm.MessageSender(sender.send)
+        message_sender.start()
+
+        messages = [{'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'},
+                    {'progress-sequence': 1, 'task-id': 'a'},
+                    {'exit-code': 0, 'task-id': 'a'}]
+        for message in messages:
+            self.assertTrue(message_sender.send(message))
+
+        self.assertTrue(message_sender.stop(timeout_secs=5))
+        self.assertEqual(messages, sender.messages)
+        self.assertEqual(3, message_sender.counters.get('sent'))
+        self.assertEqual(0, message_sender.queue_depth())
+        self.assertFalse(message_sender.send({'exit-code': 1, 'task-id': 'a'}))
+
+    def test_coalesces_superseded_progress_messages(self):
+        sender = BlockingSender()
+        message_sender = cm.MessageSender(sender.send)
+        message_sender.start()
+        try:
+            in_flight_message = {'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'}
+            message_sender.send(in_flight_message)
+            self.assertTrue(sender.sending.wait(timeout=5))
+
+            # the sender thread is blocked, progress for the same task is coalesced while queued
+            for sequence in range(1, 11):
+                self.assertTrue(message_sender.send({'progress-sequence': sequence, 'task-id': 'a'}))
+                self.assertTrue(message_sender.send({'progress-sequence': sequence, 'task-id': 'b'}))
+            message_sender.send({'exit-code': 0, 'task-id': 'a'})
+            self.assertEqual(3, message_sender.queue_depth())
+
+            sender.unblocked.set()
+            self.assertTrue(message_sender.flush(timeout_secs=5))
+            self.assertEqual([in_flight_message,
+                              {'progress-sequence': 10, 'task-id': 'a'},
+                              {'progress-sequence': 10, 'task-id': 'b'},
+                              {'exit-code': 0, 'task-id': 'a'}],
+                             sender.messages)
+            self.assertEqual(18, message_sender.counters.get('superseded'))
+            self.assertEqual(4, message_sender.counters.get('sent'))
+            self.assertEqual(3, message_sender.max_queue_depth)
+            self.assertGreater(message_sender.max_send_latency_ms, 0)
+        finally:
+            sender.unblocked.set()
+            message_sender.stop(timeout_secs=5)
+
+    def test_drops_progress_messages_when_queue_is_full(self):
+        sender = BlockingSender()
+        message_sender = cm.MessageSender(sender.send, max_queue_size=2)
+        message_sender.start()
+        try:
+            message_sender.send({'sandbox-directory': '/sandbox', 'task-id': 'a', 'type': 'directory'})
+            self.assertTrue(sender.sending.wait(timeout=5))
+
+            self.assertTrue(message_sender.send({'progress-sequence': 1, 'task-id': 'a'}))
+            self.assertTrue(message_sender.send({'progress-sequence': 1, 'task-id': 'b'}))
+            # progress for a new task is dropped, but the exit code is always queued
+            self.assertFalse(message_sender.send({'progress-sequence': 1, 'task-id': 'c'}))
+            self.assertTrue(message_sender.send({'exit-code': 0, 'task-id': 'a'}))
+            self.assertTrue(message_sender.send({'exit-code': 0, 'task-id': 'b'}))
+            self.assertEqual(4, message_sender.queue_depth())
+
+            sender.unblocked.set()
+            self.assertTrue(message_sender.flush(timeout_secs=5))
+            self.assertEqual(5, len(sender.messages))
+            self.assertNotIn({'progress-sequence': 1, 'task-id': 'c'}, sender.messages)
+            self.assertEqual(1, message_sender.counters.get('dropped'))
+        finally:
+            sender.unblocked.set()
+            message_sender.stop(timeout_secs=5)
+
+    def test_invokes_failure_callback(self):
+        failed_message = {'progress-sequence': 1, 'task-id': 'a'}
+        sender = BlockingSender(fail_messages=[failed_message])
+        sender.unblocked.set()
+        message_sender = cm.MessageSender(sender.send)
+        message_sender.start()
+
+        failures = []
+        message_sender.send(failed_message, on_failure=failures.append)
+        message_sender.send({'progress-sequence': 2, 'task-id': 'b'}, on_failure=failures.append)
+
+        self.assertTrue(message_sender.stop(timeout_secs=5))
+        self.assertEqual([failed_message], failures)
+        self.assertEqual(1, message_sender.counters.get('failed'))
+        self.assertEqual(1, message_sender.counters.get('sent'))
@@ -0,0 +1,85 @@
+import os
+import socket
+import tempfile
+import unittest
+
+import cook.metrics as cmet
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = cmet.Histogram(bounds=(1, 10))
+        for value in [0.5, 1, 5, 20]:
+            histogram.observe(value)
+
+        self.assertEqual([cmet.Sample('latency_bucket', 'histogram', [('le', '1')], 2),
+                          cmet.Sample('latency_bucket', 'histogram', [('le', '10')], 3),
+                          cmet.Sample('latency_bucket', 'histogram', [('le', '+Inf')], 4),
+                          cmet.Sample('latency_sum', 'histogram', [], 26.5),
+                          cmet.Sample('latency_count', 'histogram', [], 4)],
+                         histogram.samples('latency'))
+
+    def test_registry_render(self):
+        registry = cmet.MetricsRegistry()
+        registry.register_collector('task-1', lambda: [
+            cmet.Sample('lines_read', 'counter', [('task_id', 'task-1'), ('location', 'stdout')], 10),
+            cmet.Sample('lines_read', 'counter', [('task_id', 'task-1'), ('location', 'std"err')], 2),
+            cmet.Sample('queue_depth', 'gauge', [], 0)])
+
+        def failing_collector():
+            raise Exception('collector failed')
+
+        registry.register_collector('failing', failing_collector)
+        registry.histogram('send_latency_ms').observe(3)
+
+        rendered = registry.render()
+        self.assertIn('# TYPE cook_executor_lines_read counter\n'
+                      'cook_executor_lines_read{task_id="task-1",location="stdout"} 10\n'
+                      'cook_executor_lines_read{task_id="task-1",location="std\\"err"} 2\n'
+                      '# TYPE cook_executor_queue_depth gauge\n'
+                      'cook_executor_queue_depth 0\n'
+                      '# TYPE cook_executor_send_latency_ms histogram\n'
+                      'cook_executor_send_latency_ms_bucket{le="1"} 0\n'
+                      'cook_executor_send_latency_ms_bucket{le="5"} 1\n', rendered)
+        self.assertTrue(rendered.endswith('cook_executor_send_latency_ms_sum 3\n'
+                                          'cook_executor_send_latency_ms_count 1\n'))
+
+        registry.unregister_collector('task-1')
+        self.assertNotIn('lines_read', registry.render())
+
+    def test_collect_process_metrics(self):
+        samples = {sample.name: sample.value for sample in cmet.collect_process_metrics()}
+        self.assertGreater(samples['resident_memory_bytes'], 0)
+        self.assertGreaterEqual(samples['threads'], 1)
+        self.assertGreaterEqual(samples['cpu_seconds'], 0)
+
+    def test_metrics_server(self):
+        registry = cmet.MetricsRegistry()
+        registry.register_collector('test', lambda: [cmet.Sample('lines_read', 'counter', [], 7)])
+        with tempfile.TemporaryDirectory() as directory:
+            socket_path = os.path.join(directory, 'metrics.sock')
+            server = cmet.MetricsServer(socket_path, registry)
+            self.assertTrue(server.start())
+            try:
+                def request(path):
+                    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    try:
+                        client.connect(socket_path)
+                        client.sendall('GET {} HTTP/1.0\r\n\r\n'.format(path).encode())
+                        response = b''
+                        while True:
+                            data = client.recv(4096)
+                            if not data:
+                                return response.decode()
+                            response += data
+                    finally:
+                        client.close()
+
+                response = request('/metrics')
+                self.assertTrue(response.startswith('HTTP/1.0 200'))
+                self.assertTrue(response.endswith('\r\n\r\n# TYPE cook_executor_lines_read counter\n'
+                                                  'cook_executor_lines_read 7\n'))
+                self.assertTrue(request('/unknown').startswith('HTTP/1.0 404'))
+            finally:
+                server.stop()
+            self.assertFalse(os.path.exists(socket_path))
@@ -2,11 +2,13 @@ import errno
 import json
 import logging
 import math
+import os
 import time
 import unittest
 from threading import Event, Thread
 
 import cook.executor as ce
+import cook.inotify as ci
 import cook.progress as cp
 import tests.utils as tu
 
@@ -50,6 +52,38 @@ class ProgressTest(unittest.TestCase):
         self.assertEqual((b'2.0', b'\tTwo percent complete'),
                          match_progress_update(b'^^^^JOB-PROGRESS: 2.0\tTwo percent complete'))
 
+    def test_extract_required_literal(self):
+        self.assertEqual('progress: ', cp.extract_required_literal('progress: ([0-9]*\.?[0-9]+), (.*)'))
+        self.assertEqual('^^^^JOB-PROGRESS:',
+                         cp.extract_required_literal('\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)'))
+        self.assertEqual('progress/regex', cp.extract_required_literal('progress/regex'))
+        self.assertEqual('abc', cp.extract_required_literal('^abc'))
+        self.assertEqual('ab', cp.extract_required_literal('abc*'))
+        self.assertEqual('ab', cp.extract_required_literal('abc?d'))
+        self.assertEqual('ab', cp.extract_required_literal('abc{2}'))
+        self.assertEqual('abc', cp.extract_required_literal('abc+d'))
+        self.assertEqual('foo', cp.extract_required_literal('foo\dbar'))
+        self.assertEqual('x|y', cp.extract_required_literal('x\|y'))
+        self.assertEqual('', cp.extract_required_literal(''))
+        self.assertEqual('', cp.extract_required_literal('a|b'))
+        self.assertEqual('', cp.extract_required_literal('abc|(def)'))
+        self.assertEqual('ab', cp.extract_required_literal('ab(c|d)'))
+        self.assertEqual('', cp.extract_required_literal('[|]|x'))
+        self.assertEqual('', cp.extract_required_literal('(?i)progress'))
+        self.assertEqual('', cp.extract_required_literal('.*progress'))
+
+    def test_match_progress_update_capture_groups(self):
+        def match_progress_update(progress_regex_string, input_string):
+            progress_watcher = cp.ProgressWatcher('', '', None, 1, progress_regex_string, None, None, None)
+            return progress_watcher.match_progress_update(input_string)
+
+        self.assertEqual(b'progress: 5', match_progress_update('progress: [0-9]+', b'progress: 5 percent'))
+        self.assertEqual(b'5', match_progress_update('progress: ([0-9]+)', b'progress: 5 percent'))
+        self.assertEqual((b'5', b''), match_progress_update('progress: ([0-9]+)(?: (.*))?', b'progress: 5'))
+        self.assertEqual((b'5', b'percent'), match_progress_update('progress: ([0-9]+) (.*)', b'progress: 5 percent'))
+        self.assertIsNone(match_progress_update('progress: ([0-9]+) (.*)', b'progress: five percent'))
+        self.assertIsNone(match_progress_update('progress: ([0-9]+) (.*)', b'Progress: 5 percent'))
+
     def send_progress_message_helper(self, driver, max_message_length):
 
         def send_progress_message(message):
@@ -68,28 +102,93 @@ class ProgressTest(unittest.TestCase):
 
         send_progress_message = self.send_progress_message_helper(driver, max_message_length)
         progress_updater = cp.ProgressUpdater(task_id, max_message_length, poll_interval_ms, send_progress_message)
-        progress_data_0 = {'progress-message': b' Progress message-0', 'progress-sequence': 1}
+        progress_data_0 = cp.ProgressState(b' Progress message-0', 10, 1)
         progress_updater.send_progress_update(progress_data_0)
 
         self.assertEqual(1, len(driver.messages))
         actual_encoded_message_0 = driver.messages[0]
-        expected_message_0 = {'progress-message': 'Progress message-0', 'progress-sequence': 1, 'task-id': task_id}
+        expected_message_0 = {'progress-message': 'Progress message-0', 'progress-percent': 10, 'progress-sequence': 1,
+                              'task-id': task_id}
         tu.assert_message(self, expected_message_0, actual_encoded_message_0)
 
-        progress_data_1 = {'progress-message': b' Progress message-1', 'progress-sequence': 2}
+        progress_data_1 = cp.ProgressState(b' Progress message-1', 20, 2)
         progress_updater.send_progress_update(progress_data_1)
 
         self.assertEqual(1, len(driver.messages))
 
         time.sleep(poll_interval_ms / 1000.0)
-        progress_data_2 = {'progress-message': b' Progress message-2', 'progress-sequence': 3}
+        progress_data_2 = cp.ProgressState(b' Progress message-2', 30, 3)
         progress_updater.send_progress_update(progress_data_2)
 
         self.assertEqual(2, len(driver.messages))
         actual_encoded_message_2 = driver.messages[1]
-        expected_message_2 = {'progress-message': 'Progress message-2', 'progress-sequence': 3, 'task-id': task_id}
+        expected_message_2 = {'progress-message': 'Progress message-2', 'progress-percent': 30, 'progress-sequence': 3,
+                              'task-id': task_id}
         tu.assert_message(self, expected_message_2, actual_encoded_message_2)
 
+        progress_updater.send_progress_update(progress_data_1)
+        self.assertEqual({'outdated': 1, 'sent': 2, 'throttled': 1}, progress_updater.counters.snapshot())
+
+    def test_send_progress_update_adaptive_backoff(self):
+        messages = []
+
+        def send_progress_message(message):
+            messages.append(message)
+            return True
+
+        progress_updater = cp.ProgressUpdater('task-1', 512, 20, send_progress_message, min_percent_delta=5,
+                                              max_poll_interval_ms=50)
+
+        def send_after(elapsed_secs, percent, sequence):
+            if progress_updater.last_reported_time is not None:
+                progress_updater.last_reported_time = time.time() - elapsed_secs
+            progress_updater.send_progress_update(cp.ProgressState(b'message', percent, sequence))
+            return [message['progress-sequence'] for message in messages]
+
+        self.assertEqual([1], send_after(0, 10, 1))
+        # the percent changed too little, the update is sent once the backoff interval has elapsed
+        self.assertEqual([1, 2], send_after(0.03, 12, 2))
+        self.assertEqual(40, progress_updater.backoff_interval_ms)
+        self.assertEqual([1, 2], send_after(0.03, 13, 3))
+        self.assertEqual([1, 2, 4], send_after(0.045, 14, 4))
+        self.assertEqual(50, progress_updater.backoff_interval_ms)
+        # a large enough change in the percent is sent after poll_interval_ms and resets the backoff interval
+        self.assertEqual([1, 2, 4], send_after(0.01, 30, 5))
+        self.assertEqual([1, 2, 4, 6], send_after(0.03, 30, 6))
+        self.assertEqual(20, progress_updater.backoff_interval_ms)
+        self.assertEqual([1, 2, 4, 6, 7], send_after(0.03, 30, 7))
+        self.assertEqual(40, progress_updater.backoff_interval_ms)
+        self.assertEqual({'sent': 5, 'throttled': 2}, progress_updater.counters.snapshot())
+
+    def test_send_progress_update_token_bucket(self):
+        messages = []
+
+        def send_progress_message(message):
+            messages.append(message)
+            return True
+
+        token_bucket = cp.TokenBucket(0.001, 1)
+        progress_updaters = [cp.ProgressUpdater(task_id, 512, 0, send_progress_message, token_bucket=token_bucket)
+                             for task_id in ['task-1', 'task-2']]
+        progress_updaters[0].send_progress_update(cp.ProgressState(b'message', 10, 1))
+        progress_updaters[1].send_progress_update(cp.ProgressState(b'message', 10, 1))
+        progress_updaters[0].send_progress_update(cp.ProgressState(b'message', 20, 2))
+        # forced updates are not rate-limited
+        progress_updaters[1].send_progress_update(cp.ProgressState(b'message', 20, 2), force_send=True)
+
+        self.assertEqual([('task-1', 1), ('task-2', 2)],
+                         [(message['task-id'], message['progress-sequence']) for message in messages])
+        self.assertEqual({'rate-limited': 1, 'sent': 1}, progress_updaters[0].counters.snapshot())
+        self.assertEqual({'rate-limited': 1, 'sent': 1}, progress_updaters[1].counters.snapshot())
+
+    def test_token_bucket(self):
+        token_bucket = cp.TokenBucket(100, 2)
+        self.assertTrue(token_bucket.try_acquire())
+        self.assertTrue(token_bucket.try_acquire())
+        self.assertFalse(token_bucket.try_acquire())
+        time.sleep(0.02)
+        self.assertTrue(token_bucket.try_acquire())
+
     def test_send_progress_update_trims_progress_message(self):
         driver = tu.FakeMesosExecutorDriver()
         task_id = tu.get_random_task_id()
@@ -98,37 +197,108 @@ class ProgressTest(unittest.TestCase):
 
         send_progress_message = self.send_progress_message_helper(driver, max_message_length)
         progress_updater = cp.ProgressUpdater(task_id, max_message_length, poll_interval_ms, send_progress_message)
-        progress_data_0 = {'progress-message': b' Progress message-0 is really long lorem ipsum dolor sit amet text',
-                           'progress-sequence': 1}
+        progress_data_0 = cp.ProgressState(b' Progress message-0 is really long lorem ipsum dolor sit amet text', 5, 1)
         progress_updater.send_progress_update(progress_data_0)
 
         self.assertEqual(1, len(driver.messages))
         actual_encoded_message_0 = driver.messages[0]
         expected_message_0 = {'progress-message': 'Progress message-0 is reall...',
+                              'progress-percent': 5,
                               'progress-sequence': 1,
                               'task-id': task_id}
         tu.assert_message(self, expected_message_0, actual_encoded_message_0)
 
-    def test_send_progress_does_not_trim_unknown_field(self):
+    def test_send_progress_update_utf8_message_and_metrics(self):
         driver = tu.FakeMesosExecutorDriver()
         task_id = tu.get_random_task_id()
-        max_message_length = 30
-        poll_interval_ms = 10
+        max_message_length = 12
 
         send_progress_message = self.send_progress_message_helper(driver, max_message_length)
-        progress_updater = cp.ProgressUpdater(task_id, max_message_length, poll_interval_ms, send_progress_message)
-        progress_data_0 = {'progress-message': b' pm',
-                           'progress-sequence': 1,
-                           'unknown': 'Unknown field has a really long lorem ipsum dolor sit amet exceed limit text'}
-        progress_updater.send_progress_update(progress_data_0)
+        progress_updater = cp.ProgressUpdater(task_id, max_message_length, 0, send_progress_message)
+        progress_updater.send_progress_update(cp.ProgressState(' Fünf'.encode(), 5, 1))
+        progress_updater.send_progress_update(cp.ProgressState(b' bad \xff byte', 6, 2))
+        progress_updater.send_progress_update(cp.ProgressState('ééééééé', 7, 3, {'rows': 10}))
+
+        self.assertEqual(3, len(driver.messages))
+        tu.assert_message(self, {'progress-message': 'Fünf', 'progress-percent': 5, 'progress-sequence': 1,
+                                 'task-id': task_id}, driver.messages[0])
+        tu.assert_message(self, {'progress-message': 'bad \ufffd byte', 'progress-percent': 6,
+                                 'progress-sequence': 2, 'task-id': task_id}, driver.messages[1])
+        # the message is trimmed to 12 utf-8 encoded bytes without splitting a character
+        tu.assert_message(self, {'progress-message': 'éééé...', 'progress-metrics': {'rows': 10},
+                                 'progress-percent': 7, 'progress-sequence': 3, 'task-id': task_id},
+                          driver.messages[2])
+        self.assertEqual({'sent': 3, 'trimmed': 1, 'undecodable': 1}, progress_updater.counters.snapshot())
+
+    def test_parse_percent(self):
+        self.assertEqual(0, cp.parse_percent(b'0'))
+        self.assertEqual(42, cp.parse_percent(b'42'))
+        self.assertEqual(100, cp.parse_percent(b'100'))
+        self.assertEqual(100, cp.parse_percent(b' 99.5'))
+        self.assertEqual(2, cp.parse_percent(b'2.5'))
+        self.assertEqual(3, cp.parse_percent(b'2.51'))
+        self.assertEqual(50, cp.parse_percent(b'50.'))
+        self.assertEqual(100, cp.parse_percent(b'1e2'))
+        self.assertIsNone(cp.parse_percent(b'100.4'))
+        self.assertIsNone(cp.parse_percent(b'101'))
+        self.assertIsNone(cp.parse_percent(b'-5'))
+        for invalid_data in [b'', b'.', b'abc']:
+            with self.assertRaises(ValueError):
+                cp.parse_percent(invalid_data)
+
+    def test_parse_json_progress(self):
+        self.assertEqual({'percent': 50, 'message': 'half'},
+                         cp.parse_json_progress(b' {"percent": 50, "message": "half"}\n'))
+        self.assertIsNone(cp.parse_json_progress(b'percent: 50'))
+        self.assertIsNone(cp.parse_json_progress(b'{"percent": 50'))
+        self.assertIsNone(cp.parse_json_progress(b'{"message": "no percent"}'))
+
+        self.assertEqual((50, 'half', {'rows': 1}),
+                         cp.parse_json_progress_report({'percent': 50.2, 'message': 'half', 'metrics': {'rows': 1}}))
+        self.assertEqual((10, '', None), cp.parse_json_progress_report({'percent': 10, 'metrics': []}))
+        self.assertIsNone(cp.parse_json_progress_report({'percent': 101}))
+        with self.assertRaises(ValueError):
+            cp.parse_json_progress_report({'percent': '50'})
+
+    def test_watcher_json_progress_format(self):
+        counter = cp.ProgressSequenceCounter()
+        watcher = cp.ProgressWatcher('<fragments>', 'test', counter, 1024, '', Event(), Event(), Event(),
+                                     progress_format=cp.PROGRESS_FORMAT_JSON)
+        lines = [b'plain output\n',
+                 b'{"percent": 25, "message": "quarter"}\n',
+                 b'{"percent": "invalid"}\n',
+                 b'{"percent": 150}\n',
+                 b'{"other": 1, "note": "no percent"}\n',
+                 '{"percent": 50, "message": "hälfte", "metrics": {"rows": 500}}\n'.encode()]
+        self.assertEqual([cp.ProgressState('quarter', 25, 1), cp.ProgressState('hälfte', 50, 2, {'rows': 500})],
+                         list(watcher.retrieve_progress_states(fragments=lines)))
+
+    def test_progress_state_is_immutable(self):
+        progress_state = cp.ProgressState(b' pm', 50, 1)
+        with self.assertRaises(AttributeError):
+            progress_state.percent = 60
+        self.assertFalse(hasattr(progress_state, '__dict__'))
+        self.assertEqual(cp.ProgressState(b' pm', 50, 1), progress_state)
+
+    def test_progress_sequence_counter(self):
+        counter = cp.ProgressSequenceCounter()
+        self.assertEqual(0, counter.value)
+        self.assertEqual([1, 2, 3], [counter.increment_and_get() for _ in range(3)])
+        self.assertEqual(3, counter.value)
 
-        self.assertEqual(1, len(driver.messages))
-        actual_encoded_message_0 = driver.messages[0]
-        expected_message_0 = {'progress-message': 'pm',
-                              'progress-sequence': 1,
-                              'task-id': task_id,
-                              'unknown': 'Unknown field has a really long lorem ipsum dolor sit amet exceed limit text'}
-        tu.assert_message(self, expected_message_0, actual_encoded_message_0)
+        counter = cp.ProgressSequenceCounter(initial=10)
+        values = []
+
+        def increment():
+            for _ in range(1000):
+                values.append(counter.increment_and_get())
+
+        threads = [Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(list(range(11, 4011)), sorted(values))
 
     def test_watcher_tail(self):
         file_name = tu.ensure_directory('build/tail_progress_test.' + tu.get_random_task_id())
@@ -163,6 +333,89 @@ class ProgressTest(unittest.TestCase):
         finally:
             tu.cleanup_file(file_name)
 
+    def test_watcher_tail_inotify(self):
+        file_name = tu.ensure_directory('build/tail_progress_test.' + tu.get_random_task_id())
+        items_to_write = 12
+        stop = Event()
+        completed = Event()
+        termination = Event()
+        write_sleep_ms = 50
+        tail_sleep_ms = 25
+
+        counter = cp.ProgressSequenceCounter()
+        watcher = cp.ProgressWatcher(file_name, 'test', counter, 1024, '', stop, completed, termination,
+                                     tail_mode='inotify')
+
+        try:
+            def write_to_file():
+                file = open(file_name, 'w+')
+                for item in range(items_to_write):
+                    time.sleep(write_sleep_ms / 1000.0)
+                    file.write('{}\n'.format(item))
+                    file.flush()
+                file.close()
+                time.sleep(0.15)
+                completed.set()
+                watcher.wake_up()
+
+            Thread(target=write_to_file, args=()).start()
+
+            collected_data = []
+            for line in watcher.tail(tail_sleep_ms):
+                collected_data.append(line.strip())
+
+            self.assertEqual(items_to_write, len(collected_data))
+            self.assertEqual(list(map(lambda x: str.encode(str(x)), range(items_to_write))), collected_data)
+            # polling would have woken up at least (items_to_write * write_sleep_ms) / tail_sleep_ms times
+            self.assertLess(watcher.wakeup_count, (items_to_write * write_sleep_ms) / tail_sleep_ms)
+        finally:
+            tu.cleanup_file(file_name)
+
+    def test_watcher_tail_truncation_and_rotation(self):
+        for tail_mode in ['poll', 'inotify']:
+            file_name = tu.ensure_directory('build/tail_progress_test.' + tu.get_random_task_id())
+            rotated_file_name = file_name + '.1'
+            stop = Event()
+            completed = Event()
+            termination = Event()
+
+            counter = cp.ProgressSequenceCounter()
+            watcher = cp.ProgressWatcher(file_name, 'test', counter, 1024, '', stop, completed, termination,
+                                         tail_mode=tail_mode)
+
+            try:
+                def write_to_file():
+                    with open(file_name, 'w') as file:
+                        file.write('line-0\nline-1\nline-2\n')
+                    time.sleep(0.2)
+                    # truncate in place, e.g. by a copytruncate log rotation
+                    with open(file_name, 'w') as file:
+                        file.write('line-3\n')
+                    time.sleep(0.2)
+                    with open(file_name, 'a') as file:
+                        file.write('line-4\n')
+                    time.sleep(0.2)
+                    # rotate by moving the file and creating a new one
+                    os.rename(file_name, rotated_file_name)
+                    time.sleep(0.2)
+                    with open(file_name, 'w') as file:
+                        file.write('line-5\nline-6\n')
+                    time.sleep(0.2)
+                    completed.set()
+                    watcher.wake_up()
+
+                Thread(target=write_to_file, args=()).start()
+
+                collected_data = [line.strip() for line in watcher.tail(25)]
+
+                self.assertEqual(['line-{}'.format(i).encode() for i in range(7)], collected_data, tail_mode)
+                self.assertEqual(1, watcher.truncation_count, tail_mode)
+                self.assertEqual(1, watcher.rotation_count, tail_mode)
+            finally:
+                completed.set()
+                tu.cleanup_file(file_name)
+                tu.cleanup_file(rotated_file_name)
+
     def test_watcher_tail_lot_of_writes(self):
         file_name = tu.ensure_directory('build/tail_progress_test.' + tu.get_random_task_id())
         items_to_write = 250000
@@ -270,11 +523,11 @@ class ProgressTest(unittest.TestCase):
             print_thread = Thread(target=print_to_file, args=())
             print_thread.start()
 
-            progress_states = [{'progress-message': b'', 'progress-percent': 50, 'progress-sequence': 1},
-                               {'progress-message': b'', 'progress-percent': 55, 'progress-sequence': 2},
-                               {'progress-message': b'', 'progress-percent': 99, 'progress-sequence': 3},
-                               {'progress-message': b'', 'progress-percent': 100, 'progress-sequence': 4},
-                               {'progress-message': b'', 'progress-percent': 100, 'progress-sequence': 5}]
+            progress_states = [cp.ProgressState(b'', 50, 1),
+                               cp.ProgressState(b'', 55, 2),
+                               cp.ProgressState(b'', 99, 3),
+                               cp.ProgressState(b'', 100, 4),
+                               cp.ProgressState(b'', 100, 5)]
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
@@ -317,11 +570,11 @@ class ProgressTest(unittest.TestCase):
             print_thread = Thread(target=print_to_file, args=())
             print_thread.start()
 
-            progress_states = [{'progress-message': b' Twenty-Five', 'progress-percent': 25, 'progress-sequence': 1},
-                               {'progress-message': b' Fifty', 'progress-percent': 50, 'progress-sequence': 2},
-                               {'progress-message': b' Fifty-five', 'progress-percent': 55, 'progress-sequence': 3},
-                               {'progress-message': b' Sixty-six', 'progress-percent': 66, 'progress-sequence': 4},
-                               {'progress-message': b' Hundred', 'progress-percent': 100, 'progress-sequence': 5}]
+            progress_states = [cp.ProgressState(b' Twenty-Five', 25, 1),
+                               cp.ProgressState(b' Fifty', 50, 2),
+                               cp.ProgressState(b' Fifty-five', 55, 3),
+                               cp.ProgressState(b' Sixty-six', 66, 4),
+                               cp.ProgressState(b' Hundred', 100, 5)]
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
@@ -372,13 +625,13 @@ class ProgressTest(unittest.TestCase):
             print_thread.daemon = True
             print_thread.start()
 
-            progress_states = [{'progress-message': b' Twenty-Five', 'progress-percent': 25, 'progress-sequence': 1},
-                               {'progress-message': b' Fifty', 'progress-percent': 50, 'progress-sequence': 2}]
+            progress_states = [cp.ProgressState(b' Twenty-Five', 25, 1),
+                               cp.ProgressState(b' Fifty', 50, 2)]
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
                 self.assertEqual(expected_progress_state, watcher.current_progress())
-                if expected_progress_state['progress-percent'] == 50:
+                if expected_progress_state.percent == 50:
                     termination_trigger.set()
             self.assertFalse(progress_states)
 
@@ -413,7 +666,7 @@ class ProgressTest(unittest.TestCase):
             print_thread = Thread(target=print_to_file, args=())
             print_thread.start()
 
-            progress_states = [{'progress-message': b' 75% percent', 'progress-percent': 75, 'progress-sequence': 1}]
+            progress_states = [cp.ProgressState(b' 75% percent', 75, 1)]
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
@@ -450,7 +703,7 @@ class ProgressTest(unittest.TestCase):
             print_thread = Thread(target=print_to_file, args=())
             print_thread.start()
 
-            progress_states = [{'progress-message': b'75% percent', 'progress-percent': 75, 'progress-sequence': 1}]
+            progress_states = [cp.ProgressState(b'75% percent', 75, 1)]
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
@@ -487,7 +740,7 @@ class ProgressTest(unittest.TestCase):
             print_thread = Thread(target=print_to_file, args=())
             print_thread.start()
 
-            progress_states = [{'progress-message': b' 100-percent', 'progress-percent': 100, 'progress-sequence': 1}]
+            progress_states = [cp.ProgressState(b' 100-percent', 100, 1)]
             for actual_progress_state in out_watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
                 self.assertEqual(expected_progress_state, actual_progress_state)
@@ -536,9 +789,7 @@ class ProgressTest(unittest.TestCase):
         watcher = cp.ProgressWatcher(file_name, 'test', counter, 1024, progress_regex, stop, completed, termination)
 
         try:
-            progress_states = list(map(lambda x: {'progress-message': 'completed-{}-percent'.format(x).encode(),
-                                                  'progress-percent': x,
-                                                  'progress-sequence': x},
+            progress_states = list(map(lambda x: cp.ProgressState('completed-{}-percent'.format(x).encode(), x, x),
                                        range(1, 101)))
             for actual_progress_state in watcher.retrieve_progress_states():
                 expected_progress_state = progress_states.pop(0)
@@ -626,9 +877,9 @@ class ProgressTest(unittest.TestCase):
                                  progress_regex_string, stop_signal, task_completed_signal, progress_termination_signal)
 
             def tail(self, sleep_time_ms):
-                yield (b'Stage One complete')
-                yield (b'progress: 25 Twenty-Five percent')
-                yield (b'Stage Two complete')
+                yield (b'Stage One complete\n')
+                yield (b'progress: 25 Twenty-Five percent\n')
+                yield (b'Stage Two complete\n')
 
             def match_progress_update(self, input_data):
                 if self.current_progress() is not None:
@@ -646,3 +897,279 @@ class ProgressTest(unittest.TestCase):
         self.assertEqual('No Memory', context.exception.strerror)
 
 
+    def test_multiplexed_progress_tracker(self):
+        file_name_1 = tu.ensure_directory('build/multiplexed_progress_test.' + tu.get_random_task_id())
+        file_name_2 = tu.ensure_directory('build/multiplexed_progress_test.' + tu.get_random_task_id())
+        missing_file_name = tu.ensure_directory('build/multiplexed_progress_test.' + tu.get_random_task_id())
+        progress_regex = '\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)'
+        stop = Event()
+        completed = Event()
+        termination = Event()
+        config = tu.FakeExecutorConfig({'max_bytes_read_per_line': 1024,
+                                        'progress_coalesce': False,
+                                        'progress_format': 'regex',
+                                        'progress_regex_string': progress_regex,
+                                        'progress_tail_mode': 'inotify'})
+
+        class FakeProgressUpdater(object):
+            def __init__(self):
+                self.progress_states = []
+                self.forced_progress_states = []
+
+            def send_progress_update(self, progress_data, force_send=False):
+                if force_send:
+                    self.forced_progress_states.append(progress_data)
+                else:
+                    self.progress_states.append(progress_data)
+
+        updater = FakeProgressUpdater()
+        counter = cp.ProgressSequenceCounter()
+        locations = [(file_name_1, 'first'), (file_name_2, 'second'), (missing_file_name, 'missing')]
+        tracker = cp.MultiplexedProgressTracker(config, stop, completed, counter, updater, termination, locations,
+                                                tu.fake_os_error_handler)
+        try:
+            tracker.start()
+            for index, percent in enumerate([10, 20, 30, 40]):
+                with open([file_name_1, file_name_2][index % 2], 'a') as file:
+                    file.write('Stage {} complete\n'.format(index))
+                    file.write('^^^^JOB-PROGRESS: {} Percent {}\n'.format(percent, percent))
+                time.sleep(0.1)
+            completed.set()
+            tracker.wake_up()
+            tracker.wait(timeout=5)
+
+            self.assertTrue(tracker.progress_complete_event.isSet())
+            expected_progress_states = [cp.ProgressState(' Percent {}'.format(p).encode(), p, s)
+                                        for s, p in enumerate([10, 20, 30, 40], start=1)]
+            self.assertEqual(expected_progress_states, updater.progress_states)
+
+            tracker.force_send_progress_update()
+            self.assertEqual([expected_progress_states[2], expected_progress_states[3], None],
+                             updater.forced_progress_states)
+        finally:
+            completed.set()
+            tu.cleanup_file(file_name_1)
+            tu.cleanup_file(file_name_2)
+
+    def test_watcher_coalesces_progress_updates(self):
+        file_name = tu.ensure_directory('build/coalesce_progress_test.' + tu.get_random_task_id())
+        progress_regex = '\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)'
+        stop = Event()
+        completed = Event()
+        termination = Event()
+        update_due = Event()
+        counter = cp.ProgressSequenceCounter()
+        watcher = cp.ProgressWatcher(file_name, 'test', counter, 1024, progress_regex, stop, completed, termination,
+                                     is_progress_update_due=lambda percent: update_due.is_set())
+        try:
+            with open(file_name, 'w') as file:
+                for percent in range(1, 51):
+                    file.write('^^^^JOB-PROGRESS: {} Percent {}\n'.format(percent, percent))
+                file.write('^^^^JOB-PROGRESS: invalid Percent\n')
+            progress_states = watcher.retrieve_progress_states(shared_notifier=ci.PollingNotifier(10))
+
+            # no progress state is materialized until an update is due
+            while watcher.line_count < 51:
+                self.assertIsNone(next(progress_states))
+            self.assertIsNotNone(watcher.pending_progress)
+            self.assertEqual(0, counter.value)
+
+            with open(file_name, 'a') as file:
+                file.write('^^^^JOB-PROGRESS: 75 Percent 75\n')
+            update_due.set()
+            progress_state = next(state for state in progress_states if state is not None)
+            self.assertEqual(cp.ProgressState(b' Percent 75', 75, 1),
+                             progress_state)
+            self.assertIsNone(watcher.pending_progress)
+
+            # the latest report is flushed on completion even when no update is due
+            update_due.clear()
+            with open(file_name, 'a') as file:
+                file.write('^^^^JOB-PROGRESS: 80 Percent 80\n')
+                file.write('^^^^JOB-PROGRESS: 90 Percent 90\n')
+            while watcher.line_count < 54:
+                self.assertIsNone(next(progress_states))
+            completed.set()
+            remaining_states = [state for state in progress_states if state is not None]
+            self.assertEqual([cp.ProgressState(b' Percent 90', 90, 2)],
+                             remaining_states)
+        finally:
+            completed.set()
+            tu.cleanup_file(file_name)
+
+    def test_tracker_coalescing_with_adaptive_backoff(self):
+        file_name = tu.ensure_directory('build/coalesce_backoff_test.' + tu.get_random_task_id())
+        progress_regex = r'\^\^\^\^JOB-PROGRESS:\s+([0-9]*\.?[0-9]+)($|\s+.*)'
+        completed = Event()
+        config = tu.FakeExecutorConfig({'max_bytes_read_per_line': 1024,
+                                        'progress_coalesce': True,
+                                        'progress_format': 'regex',
+                                        'progress_regex_string': progress_regex,
+                                        'progress_tail_mode': 'inotify'})
+        messages = []
+
+        def send_progress_message(message):
+            messages.append(message)
+            return True
+
+        updater = cp.ProgressUpdater('task-1', 512, 100, send_progress_message, min_percent_delta=5,
+                                     max_poll_interval_ms=1000)
+        tracker = cp.MultiplexedProgressTracker(config, Event(), completed, cp.ProgressSequenceCounter(), updater,
+                                                Event(), [(file_name, 'progress')], tu.fake_os_error_handler)
+        try:
+            tracker.start()
+            for percent in [10, 11, 12]:
+                with open(file_name, 'a') as file:
+                    file.write('^^^^JOB-PROGRESS: {} Percent {}\n'.format(percent, percent))
+                time.sleep(0.15)
+            # 11 doubled the backoff interval, 12 remains pending until the backoff has elapsed instead of
+            # being throttled once poll_interval_ms has elapsed
+            deadline = time.time() + 5
+            while len(messages) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual([10, 11, 12], [message['progress-percent'] for message in messages])
+            self.assertNotIn('throttled', updater.counters.snapshot())
+        finally:
+            completed.set()
+            tracker.wake_up()
+            tracker.wait(timeout=5)
+            tu.cleanup_file(file_name)
+
+    def test_updater_time_until_next_update(self):
+        token_bucket = cp.TokenBucket(10, 1)
+        updater = cp.ProgressUpdater('task-1', 512, 100, lambda message: True, min_percent_delta=5,
+                                     max_poll_interval_ms=1000, token_bucket=token_bucket)
+        self.assertTrue(updater.is_progress_update_due(10))
+        updater.send_progress_update(cp.ProgressState(b'message', 10, 1))
+
+        # the bucket is empty and refills within 100 ms, as does the poll interval
+        self.assertFalse(updater.is_progress_update_due(20))
+        self.assertGreater(updater.time_until_next_update_ms(20), 50)
+        self.assertLessEqual(updater.time_until_next_update_ms(20), 100)
+        # a small change in the percent waits for the backoff interval
+        updater.backoff_interval_ms = 400
+        self.assertGreater(updater.time_until_next_update_ms(11), 300)
+        updater.last_reported_time -= 0.4
+        time.sleep(0.1)
+        self.assertTrue(updater.is_progress_update_due(11))
+        self.assertEqual(0, token_bucket.time_until_available_ms())
+
+    def test_watcher_coalescing_retains_latest_valid_progress(self):
+        progress_regex = 'progress: ([0-9]*\.?[0-9]+), (.*)'
+        update_due = Event()
+        watcher = cp.ProgressWatcher('', 'test', cp.ProgressSequenceCounter(), 1024, progress_regex, Event(), Event(),
+                                     Event(), is_progress_update_due=lambda percent: update_due.is_set())
+        fragments = [b'progress: 40, forty\n', b'progress: 50, fifty\n', b'progress: 150, invalid\n', None,
+                     b'progress: 60.5, sixty\n', b'progress: 200, invalid\n', None]
+
+        def generate_fragments():
+            for index, fragment in enumerate(fragments):
+                if index == 6:
+                    update_due.set()
+                yield fragment
+
+        progress_states = [state for state in watcher.retrieve_progress_states(fragments=generate_fragments())
+                           if state is not None]
+        self.assertEqual([cp.ProgressState(b'sixty', 60, 1, None)], progress_states)
+        self.assertIsNone(watcher.pending_progress)
+
+    def test_watcher_matches_progress_split_across_fragments(self):
+        def collect_progress_states(watcher, data):
+            fragments, _ = cp.split_fragments(data, watcher.max_bytes_read_per_line, False)
+            return [state for state in watcher.retrieve_progress_states(fragments=fragments) if state is not None]
+
+        progress_regex = 'progress: ([0-9]*\.?[0-9]+), (.*)'
+        counter = cp.ProgressSequenceCounter()
+
+        # the literal and the percent split across fragments
+        for data in [b'0123456789progress: 50, half\n', b'0123456789abcdefgprogress: 50, half\n']:
+            watcher = cp.ProgressWatcher('', 'test', counter, 16, progress_regex, Event(), Event(), Event())
+            self.assertEqual([50], [state.percent for state in collect_progress_states(watcher, data)])
+
+        # a match is not matched again with the next fragment of the line
+        watcher = cp.ProgressWatcher('', 'test', counter, 16, progress_regex, Event(), Event(), Event())
+        progress_states = collect_progress_states(watcher, b'progress: 20, ab' + b'X' * 64 + b'\nprogress: 30, c\n')
+        self.assertEqual([(20, b'ab'), (30, b'c')],
+                         [(state.percent, state.message) for state in progress_states])
+        self.assertEqual(b'', watcher.line_carry)
+
+        # the carried over data is bounded on a huge line
+        watcher = cp.ProgressWatcher('', 'test', counter, 16, progress_regex, Event(), Event(), Event())
+        fragments, _ = cp.split_fragments(b'progress: ' * 1000 + b'progress: 70, done', 16, False)
+        carry_lengths = []
+
+        def generate_fragments():
+            for fragment in fragments:
+                carry_lengths.append(len(watcher.line_carry))
+                yield fragment
+
+        progress_states = list(watcher.retrieve_progress_states(fragments=generate_fragments()))
+        self.assertEqual([70], [state.percent for state in progress_states])
+        self.assertLessEqual(max(carry_lengths), 16)
+
+    def test_watcher_skips_continuations_of_long_lines(self):
+        counter = cp.ProgressSequenceCounter()
+        data = b'X' * 100 + b'progress: 50, half\nprogress: 60, more\n'
+        fragments, _ = cp.split_fragments(data, 16, False)
+
+        watcher = cp.ProgressWatcher('', 'test', counter, 16, '^progress: ([0-9]+), (.*)', Event(), Event(), Event())
+        progress_states = [state for state in watcher.retrieve_progress_states(fragments=fragments) if state]
+        self.assertEqual([60], [state.percent for state in progress_states])
+        self.assertEqual(8, watcher.skipped_fragment_count)
+
+        watcher = cp.ProgressWatcher('', 'test', counter, 16, '', Event(), Event(), Event(),
+                                     progress_format=cp.PROGRESS_FORMAT_JSON)
+        fragments, _ = cp.split_fragments(b'X' * 100 + b'{"percent": 50}\n{"percent": 60}\n', 16, False)
+        progress_states = [state for state in watcher.retrieve_progress_states(fragments=fragments) if state]
+        self.assertEqual([60], [state.percent for state in progress_states])
+        self.assertEqual(7, watcher.skipped_fragment_count)
+
+    def test_fragment_reader_matches_readline(self):
+        file_name = tu.ensure_directory('build/fragment_reader_test.' + tu.get_random_task_id())
+        contents = b'abcd\nabcdefghijkl\nabcdefghijklmnopqrstuvwxyz\n\n\nabcdefghij\nabcdefghi\nxyz'
+        try:
+            with open(file_name, 'wb') as file:
+                file.write(contents)
+
+            for max_bytes_per_fragment in [1, 5, 10, 11, 1024]:
+                with open(file_name, 'rb') as file:
+                    expected_fragments = list(iter(lambda: file.readline(max_bytes_per_fragment), b''))
+                for chunk_size in [1, 3, 7, 16, 64 * 1024]:
+                    with open(file_name, 'rb', buffering=0) as file:
+                        fragment_reader = cp.FragmentReader(file, max_bytes_per_fragment, chunk_size=chunk_size)
+                        actual_fragments = []
+                        fragments = fragment_reader.read_fragments()
+                        while fragments:
+                            actual_fragments.extend(fragments)
+                            fragments = fragment_reader.read_fragments()
+                    self.assertEqual(expected_fragments, actual_fragments,
+                                     'max_bytes_per_fragment={}, chunk_size={}'.format(max_bytes_per_fragment,
+                                                                                       chunk_size))
+        finally:
+            tu.cleanup_file(file_name)
+
+    def test_split_fragments(self):
+        self.assertEqual(([], b''), cp.split_fragments(b'', 10, True))
+        self.assertEqual(([b'abc\n', b'def'], b''), cp.split_fragments(b'abc\ndef', 10, False))
+        self.assertEqual(([b'abc\n'], b'def'), cp.split_fragments(b'abc\ndef', 10, True))
+        self.assertEqual(([b'abcde', b'fghij', b'k\n', b'lmnop'], b''), cp.split_fragments(b'abcdefghijk\nlmnop', 5, True))
+        self.assertEqual(([b'abcde', b'fghij'], b'k'), cp.split_fragments(b'abcdefghijk', 5, True))
+
+    def test_fragment_reader_partial_lines(self):
+        file_name = tu.ensure_directory('build/fragment_reader_test.' + tu.get_random_task_id())
+        try:
+            with open(file_name, 'wb') as writer, open(file_name, 'rb', buffering=0) as reader:
+                fragment_reader = cp.FragmentReader(reader, 10)
+                self.assertEqual([], fragment_reader.read_fragments())
+
+                writer.write(b'abc')
+                writer.flush()
+                self.assertEqual([b'abc'], fragment_reader.read_fragments())
+                self.assertEqual([], fragment_reader.read_fragments())
+
+                writer.write(b'def\nghi\n')
+                writer.flush()
+                self.assertEqual([b'def\n', b'ghi\n'], fragment_reader.read_fragments())
+                self.assertEqual([], fragment_reader.read_fragments())
+        finally:
+            tu.cleanup_file(file_name)
@@ -0,0 +1,81 @@
+import os
+import tempfile
+import unittest
+
+import cook.config as cc
+import cook.sampler as csa
+
+
+class ScriptedResourceSampler(csa.ResourceSampler):
+    """ResourceSampler that returns the provided samples instead of reading them."""
+
+    def __init__(self, samples, config, send_message_fn):
+        super().__init__('task-1', os.getpid(), config, send_message_fn)
+        self.scripted_samples = list(samples)
+
+    def read_sample(self):
+        return self.scripted_samples.pop(0) if self.scripted_samples else None
+
+
+class SamplerTest(unittest.TestCase):
+    def test_read_process_tree_sample(self):
+        resource_sample = csa.read_process_tree_sample(os.getpid())
+        self.assertIsNotNone(resource_sample)
+        self.assertGreater(resource_sample.cpu_secs, 0)
+        self.assertGreater(resource_sample.rss_bytes, 0)
+        self.assertGreaterEqual(resource_sample.num_processes, 1)
+
+    def test_read_process_tree_sample_missing_process(self):
+        self.assertIsNone(csa.read_process_tree_sample(2 ** 22 + 1))
+
+    def test_read_cgroup_sample(self):
+        with tempfile.TemporaryDirectory() as cgroup_directory:
+            file_contents = {'cgroup.procs': '10\n11\n12\n',
+                             'cpu.stat': 'usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n',
+                             'io.stat': '8:0 rbytes=1024 wbytes=2048 rios=1 wios=2\n8:16 rbytes=1024 wbytes=0\n',
+                             'memory.current': '4194304\n'}
+            for name, contents in file_contents.items():
+                with open(os.path.join(cgroup_directory, name), 'w') as cgroup_file:
+                    cgroup_file.write(contents)
+
+            resource_sample = csa.read_cgroup_sample(cgroup_directory)
+            self.assertEqual((2.5, 4194304, 2048, 2048, 3), resource_sample[1:])
+
+            os.remove(os.path.join(cgroup_directory, 'memory.current'))
+            self.assertIsNone(csa.read_cgroup_sample(cgroup_directory))
+
+    def test_resource_sampler_summary(self):
+        mb = csa.BYTES_PER_MB
+        samples = [csa.ResourceSample(100, 1.0, 10 * mb, 0, 0, 1),
+                   csa.ResourceSample(110, 6.0, 50 * mb, mb, 0, 3),
+                   csa.ResourceSample(120, 26.0, 30 * mb, 2 * mb, mb, 2),
+                   csa.ResourceSample(130, 31.0, 20 * mb, 4 * mb, mb, 2)]
+        config = cc.ExecutorConfig(resource_sample_buffer_size=2)
+        messages = []
+        sampler = ScriptedResourceSampler(samples, config, messages.append)
+        self.assertIsNone(sampler.summarize())
+
+        for _ in samples:
+            sampler.sample()
+        self.assertIsNone(sampler.sample())
+        # only the most recent samples are retained
+        self.assertEqual(samples[2:], list(sampler.samples))
+
+        self.assertEqual({'cpu-secs': 30.0,
+                          'cpus-avg': 1.0,
+                          'cpus-max': 2.0,
+                          'cpus-recent': 0.5,
+                          'duration-secs': 30,
+                          'io-read-mb': 4.0,
+                          'io-write-mb': 1.0,
+                          'mem-mb': 20.0,
+                          'mem-mb-max': 50.0,
+                          'processes-max': 3,
+                          'samples': 4,
+                          'source': 'process-tree'},
+                         sampler.summarize())
+
+        sampler.stop()
+        sampler.stop()
+        self.assertEqual([{'resource-usage': sampler.summarize(), 'task-id': 'task-1', 'type': 'resource-usage'}],
+                         messages)
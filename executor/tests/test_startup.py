@@ -0,0 +1,59 @@
+import builtins
+import sys
+import unittest
+
+import cook.startup as cst
+
+
+class StartupTest(unittest.TestCase):
+    def test_is_profiling_requested(self):
+        self.assertTrue(cst.is_profiling_requested(['cook-executor', '--profile-startup']))
+        self.assertFalse(cst.is_profiling_requested(['cook-executor']))
+        self.assertFalse(cst.is_profiling_requested(['cook-executor', '--version']))
+
+    def test_startup_profiler_times_first_imports(self):
+        sys.modules.pop('colorsys', None)
+        original_import = builtins.__import__
+        profiler = cst.StartupProfiler()
+        profiler.install_import_timer()
+        try:
+            import colorsys
+            import os
+        finally:
+            profiler.uninstall_import_timer()
+        self.assertIs(original_import, builtins.__import__)
+
+        self.assertIn('colorsys', profiler.import_times)
+        self.assertNotIn('os', profiler.import_times)
+        self.assertGreaterEqual(profiler.import_times['colorsys'], 0)
+
+    def test_startup_profiler_report_lines(self):
+        profiler = cst.StartupProfiler()
+        profiler.import_times = {'fast': 0.001, 'slow': 0.02}
+        profiler.mark('main')
+        profiler.mark('task-running')
+
+        lines = profiler.report_lines()
+        self.assertEqual(4, len(lines))
+        self.assertTrue(lines[0].startswith('Startup phase main reached at '))
+        self.assertTrue(lines[1].startswith('Startup phase task-running reached at '))
+        self.assertEqual('Startup import of slow took 20.0 ms', lines[2])
+        self.assertEqual('Startup import of fast took 1.0 ms', lines[3])
+
+    def test_report_once(self):
+        original_profiler = cst.__profiler__
+        try:
+            reported_lines = []
+            cst.__profiler__ = None
+            cst.mark('main')
+            cst.report(reported_lines.append)
+            self.assertEqual([], reported_lines)
+
+            cst.__profiler__ = cst.StartupProfiler()
+            cst.mark('main')
+            cst.report(reported_lines.append)
+            self.assertEqual(1, len(reported_lines))
+            cst.report(reported_lines.append)
+            self.assertEqual(1, len(reported_lines))
+        finally:
+            cst.__profiler__ = original_profiler
@@ -3,10 +3,14 @@ import signal
 import subprocess
 import time
 import unittest
+from threading import Timer
 
 import collections
+import os
 
 import cook.subprocess as cs
+import cook.timers as ct
+import cook.util as cu
 import tests.utils as tu
 
 
@@ -159,3 +163,184 @@ class SubprocessTest(unittest.TestCase):
 
     def test_process_group_assignment_and_killing_send_signal_term(self):
         self.process_launch_and_kill_helper(lambda pid: cs.send_signal(pid, signal.SIGTERM))
+
+    def test_launch_process_in_new_session(self):
+        process = cs.launch_process('sleep 0.2', {})
+        try:
+            self.assertEqual(process.pid, os.getsid(process.pid))
+            self.assertEqual(process.pid, os.getpgid(process.pid))
+        finally:
+            process.wait()
+        self.assertEqual(0, process.returncode)
+
+    def test_read_process_children_map(self):
+        children_map = cs._read_process_children_map()
+        self.assertIn(os.getpid(), children_map[os.getppid()])
+
+    def test_find_process_tree(self):
+        children_map = {1: [2, 3], 2: [4, 5], 3: [6], 5: [7], 8: [9]}
+        self.assertEqual([1, 2, 3, 4, 5, 6, 7], cs._find_process_tree(1, children_map))
+        self.assertEqual([2, 4, 5, 7], cs._find_process_tree(2, children_map))
+        self.assertEqual([10], cs._find_process_tree(10, children_map))
+        # cycles, e.g. due to process id reuse between reads, are ignored
+        self.assertEqual([1, 2], cs._find_process_tree(1, {1: [2], 2: [1]}))
+
+    def test_find_freezable_cgroup_excludes_executor_cgroup(self):
+        self.assertIsNone(cs._find_freezable_cgroup(os.getpid()))
+
+    def test_send_signal_to_wide_process_tree(self):
+        task_id = tu.get_random_task_id()
+
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        try:
+            num_children = 100
+            command = 'for i in $(seq {}); do sleep 30 & done; wait'.format(num_children)
+            process = cs.launch_process(command, {})
+            group_id = cs.find_process_group(process.pid)
+
+            child_process_ids = tu.wait_for(lambda: find_process_ids_in_group(group_id),
+                                            lambda data: len(data) > num_children,
+                                            default_value=[])
+            self.assertEqual(num_children + 1, len(child_process_ids))
+            self.assertEqual(num_children + 1, len(cs._find_process_tree(process.pid,
+                                                                         cs._read_process_children_map())))
+
+            self.assertTrue(cs._send_signal_to_process_tree(process.pid, signal.SIGKILL))
+
+            child_process_ids = tu.wait_for(lambda: find_process_ids_in_group(group_id),
+                                            lambda data: len(data) == 0,
+                                            default_value=[])
+            self.assertEqual(0, len(child_process_ids))
+            process.wait()
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
+
+    def test_send_signal_to_process_tree_with_exited_process(self):
+        exited_process = subprocess.Popen(['true'])
+        exited_process.wait()
+        process = cs.launch_process('sleep 30', {})
+        read_process_children_map = cs._read_process_children_map
+        try:
+            # the child exits between reading the process tree and signalling it
+            cs._read_process_children_map = lambda: {process.pid: [exited_process.pid]}
+            self.assertTrue(cs._send_signal_to_process_tree(process.pid, signal.SIGTERM))
+        finally:
+            cs._read_process_children_map = read_process_children_map
+        self.assertEqual(-signal.SIGTERM, process.wait(timeout=5))
+
+    def test_terminate_process_escalates_to_sigkill(self):
+        task_id = tu.get_random_task_id()
+
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        timer_service = ct.TimerService()
+        timer_service.start()
+        try:
+            # the process ignores SIGTERM and hence needs to be killed by the escalation
+            command = 'trap "" TERM; sleep 100'
+            process = cs.launch_process(command, {})
+            time.sleep(0.2)
+
+            start_time = time.time()
+            kill_escalation = cs.terminate_process(process, 600, timer_service)
+            self.assertIsNotNone(kill_escalation)
+            self.assertLess(time.time() - start_time, 0.5)
+
+            process.wait(timeout=10)
+            self.assertEqual(-signal.SIGKILL, process.returncode)
+            self.assertGreaterEqual(time.time() - start_time, 0.5)
+            self.assertIsNone(cs.terminate_process(process, 600, timer_service))
+        finally:
+            timer_service.stop()
+            tu.cleanup_output(stdout_name, stderr_name)
+
+    def test_process_exit_waiter(self):
+        process = cs.launch_process('sleep 0.3; exit 5', {})
+        start_time = time.time()
+        exit_waiter = cs.ProcessExitWaiter(process, cu.NotifyingEvent(), 1000)
+        exit_time = exit_waiter.wait()
+
+        self.assertEqual(5, process.returncode)
+        self.assertFalse(exit_waiter.terminated())
+        self.assertGreaterEqual(exit_time - start_time, 0.25)
+        self.assertLess(time.time() - exit_time, 0.1)
+        # the process has been reaped, waiting again returns immediately
+        self.assertIsNotNone(cs.ProcessExitWaiter(process, cu.NotifyingEvent(), 1000).wait())
+
+    def test_process_exit_waiter_without_pidfd(self):
+        open_pidfd = cs.open_pidfd
+        try:
+            cs.open_pidfd = lambda _: None
+            process = cs.launch_process('sleep 0.2; exit 6', {})
+            self.assertFalse(cs.has_process_exited(process))
+            exit_time = cs.ProcessExitWaiter(process, cu.NotifyingEvent(), 1000).wait()
+            self.assertEqual(6, process.returncode)
+            self.assertTrue(cs.has_process_exited(process))
+            self.assertLess(time.time() - exit_time, 0.1)
+        finally:
+            cs.open_pidfd = open_pidfd
+
+    def test_process_exit_waiter_woken_up_by_stop_signal(self):
+        task_id = tu.get_random_task_id()
+
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        open_pidfd = cs.open_pidfd
+        try:
+            for use_pidfd in [True, False]:
+                if not use_pidfd:
+                    cs.open_pidfd = lambda _: None
+                process = cs.launch_process('sleep 100', {})
+                stop_signal = cu.NotifyingEvent()
+                set_times = []
+                Timer(0.2, lambda: (set_times.append(time.time()), stop_signal.set())).start()
+                exit_waiter = cs.ProcessExitWaiter(process, stop_signal, 1000)
+                exit_waiter.wait()
+
+                self.assertEqual(-signal.SIGTERM, process.returncode)
+                self.assertTrue(exit_waiter.terminated())
+                self.assertLess(exit_waiter.sigterm_time - set_times[0], 0.05)
+                self.assertLess(exit_waiter.exit_time - exit_waiter.sigterm_time, 0.5)
+                self.assertIsNone(exit_waiter.sigkill_time)
+        finally:
+            cs.open_pidfd = open_pidfd
+            tu.cleanup_output(stdout_name, stderr_name)
+
+    def test_process_exit_waiter_escalates_to_sigkill(self):
+        task_id = tu.get_random_task_id()
+
+        stdout_name = tu.ensure_directory('build/stdout.{}'.format(task_id))
+        stderr_name = tu.ensure_directory('build/stderr.{}'.format(task_id))
+
+        tu.redirect_stdout_to_file(stdout_name)
+        tu.redirect_stderr_to_file(stderr_name)
+
+        try:
+            # the process ignores SIGTERM and hence needs to be killed by the escalation
+            process = cs.launch_process('trap "" TERM; sleep 100', {})
+            time.sleep(0.2)
+
+            stop_signal = cu.NotifyingEvent()
+            stop_signal.set()
+            exit_waiter = cs.ProcessExitWaiter(process, stop_signal, 600)
+            exit_waiter.wait()
+
+            self.assertEqual(-signal.SIGKILL, process.returncode)
+            self.assertTrue(exit_waiter.terminated())
+            self.assertGreaterEqual(exit_waiter.sigkill_time - exit_waiter.sigterm_time, 0.5)
+            self.assertGreaterEqual(exit_waiter.exit_time, exit_waiter.sigkill_time)
+        finally:
+            tu.cleanup_output(stdout_name, stderr_name)
@@ -0,0 +1,97 @@
+import time
+import unittest
+from threading import Event
+
+import cook.timers as ct
+import cook.util as cu
+
+
+class TimersTest(unittest.TestCase):
+    def setUp(self):
+        self.timer_service = ct.TimerService()
+        self.timer_service.start()
+
+    def tearDown(self):
+        self.timer_service.stop()
+
+    def test_schedule_runs_in_deadline_order(self):
+        runs = []
+        completed = Event()
+        self.timer_service.schedule(0.2, lambda: (runs.append('c'), completed.set()), 'c')
+        self.timer_service.schedule(0.1, lambda: runs.append('b'), 'b')
+        self.timer_service.schedule(0, lambda: runs.append('a'), 'a')
+
+        self.assertTrue(completed.wait(timeout=5))
+        self.assertEqual(['a', 'b', 'c'], runs)
+
+    def test_schedule_cancel(self):
+        runs = []
+        completed = Event()
+        cancelled_task = self.timer_service.schedule(0.05, lambda: runs.append('cancelled'), 'cancelled')
+        self.timer_service.schedule(0.1, lambda: completed.set(), 'completed')
+        cancelled_task.cancel()
+
+        self.assertTrue(completed.wait(timeout=5))
+        self.assertEqual([], runs)
+        self.assertNotIn('cancelled', self.timer_service.statistics)
+
+    def test_schedule_periodic(self):
+        runs = []
+        completed = Event()
+
+        def run():
+            runs.append(time.monotonic())
+            if len(runs) == 5:
+                periodic_task.cancel()
+                completed.set()
+
+        periodic_task = self.timer_service.schedule_periodic(0.02, run, 'periodic', initial_delay_secs=0)
+
+        self.assertTrue(completed.wait(timeout=5))
+        time.sleep(0.1)
+        self.assertEqual(5, len(runs))
+        self.assertTrue(all(later - earlier >= 0.02 for earlier, later in zip(runs, runs[1:])))
+        self.assertEqual(5, self.timer_service.statistics['periodic'].runs)
+
+    def test_failing_callbacks_are_counted(self):
+        completed = Event()
+
+        def fail():
+            raise Exception('Expected failure')
+
+        self.timer_service.schedule(0, fail, 'failing')
+        self.timer_service.schedule(0.05, lambda: completed.set(), 'completed')
+
+        self.assertTrue(completed.wait(timeout=5))
+        statistics = self.timer_service.statistics['failing']
+        self.assertEqual(1, statistics.runs)
+        self.assertEqual(1, statistics.failures)
+
+    def test_watch_event(self):
+        event = cu.NotifyingEvent()
+        runs = []
+        completed = Event()
+        self.timer_service.watch_event(event, lambda: (runs.append('set'), completed.set()), 'watch')
+        cancelled_watch = self.timer_service.watch_event(event, lambda: runs.append('cancelled'), 'cancelled')
+        cancelled_watch.cancel()
+        time.sleep(0.1)
+        self.assertEqual([], runs)
+        self.assertEqual([], self.timer_service.queue)
+
+        event.set()
+        self.assertTrue(completed.wait(timeout=5))
+        time.sleep(0.05)
+        self.assertEqual(['set'], runs)
+
+        # an event which has already been set runs fn right away
+        completed.clear()
+        self.timer_service.watch_event(event, completed.set, 'watch-set')
+        self.assertTrue(completed.wait(timeout=5))
+
+    def test_stop_drops_pending_callbacks(self):
+        runs = []
+        self.timer_service.schedule(0.1, lambda: runs.append('pending'), 'pending')
+        self.timer_service.stop()
+        time.sleep(0.2)
+        self.assertEqual([], runs)
+        self.assertFalse(self.timer_service.thread.is_alive())
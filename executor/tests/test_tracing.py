@@ -0,0 +1,47 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import cook.tracing as ctr
+
+
+class TracingTest(unittest.TestCase):
+    def test_start_span_is_noop_when_disabled(self):
+        self.assertIsNone(ctr.__tracer__)
+        span = ctr.start_span('launch-task', task_id='task-1')
+        self.assertIs(ctr.NOOP_SPAN, span)
+        with span:
+            span.finish()
+        ctr.flush()
+        ctr.close()
+
+    def test_tracer_writes_spans(self):
+        with tempfile.TemporaryDirectory() as directory:
+            trace_file_path = os.path.join(directory, 'executor.trace')
+            tracer = ctr.Tracer(trace_file_path)
+
+            with tracer.start_span('launch-task', {'task_id': 'task-1'}):
+                time.sleep(0.01)
+            span = tracer.start_span('terminate-process', {'pid': 1234})
+            span.finish(sigkill=True)
+            span.finish(sigkill=False)
+            with self.assertRaises(ValueError):
+                with tracer.start_span('send-message', {'task_id': 'task-1'}):
+                    raise ValueError('send failed')
+            tracer.close()
+            tracer.start_span('dropped', {}).finish()
+
+            with open(trace_file_path) as trace_file:
+                entries = [json.loads(line) for line in trace_file]
+
+        self.assertEqual(['launch-task', 'terminate-process', 'send-message'], [entry['name'] for entry in entries])
+        self.assertEqual('task-1', entries[0]['task_id'])
+        self.assertGreaterEqual(entries[0]['duration-ms'], 10)
+        self.assertEqual('MainThread', entries[0]['thread'])
+        self.assertLessEqual(entries[0]['start'], time.time())
+        self.assertEqual({'pid': 1234, 'sigkill': True},
+                         {key: entries[1][key] for key in ['pid', 'sigkill']})
+        self.assertEqual('ValueError', entries[2]['error'])
+        self.assertEqual(3, tracer.span_count)